@@ -0,0 +1,105 @@
+import argparse
+import time
+
+import pandas as pd
+import torch
+
+from src.models import get_ddg_model
+from src.utils.misc import load_config, seed_all
+from src.utils.train import autocast, recursive_to, sum_weighted_losses
+from src.utils.skempi import SkempiDatasetManager
+
+
+class SavedActivations(object):
+    """Bytes of the distinct tensors autograd keeps for backward (parameters excluded), the activation memory that checkpointing trades for recomputation."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.params = {p.untyped_storage().data_ptr() for p in model.parameters()}
+        self.storages = {}
+
+    def pack(self, t):
+        ptr = t.untyped_storage().data_ptr()
+        if ptr not in self.params:
+            self.storages[ptr] = t.untyped_storage().nbytes()
+        return t
+
+    def __enter__(self):
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(self.pack, lambda t: t)
+        self.hooks.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.hooks.__exit__(*args)
+
+    @property
+    def nbytes(self):
+        return sum(self.storages.values())
+
+
+def benchmark(config, batch, device, precision, iters):
+    seed_all(config.train.seed)
+    model = get_ddg_model(config.model)(config.model).to(device)
+    model.train()
+
+    def step():
+        with autocast(precision, device):
+            loss_dict, _ = model(batch)
+        sum_weighted_losses(loss_dict, config.train.loss_weights).float().backward()
+        model.zero_grad(set_to_none=True)
+
+    with SavedActivations(model) as saved:  # warm-up, also measures the activations of one step
+        with autocast(precision, device):
+            loss_dict, _ = model(batch)
+        activations = saved.nbytes
+    sum_weighted_losses(loss_dict, config.train.loss_weights).float().backward()
+    model.zero_grad(set_to_none=True)
+
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    time_start = time.time()
+    for _ in range(iters):
+        step()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    result = {'time_per_step': (time.time() - time_start) / iters, 'activations_mb': activations / 2 ** 20}
+    if device.startswith('cuda'):
+        result['peak_memory_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory and time of a training step with activation checkpointing of the GABlocks and EGNN layers.')
+    parser.add_argument('config', type=str)
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--batch_size', type=int, default=None, help='overrides `train.batch_size`')
+    parser.add_argument('--patch_size', type=int, default=None, help='overrides the patch size of the transforms')
+    parser.add_argument('--precision', type=str, default='fp32')
+    parser.add_argument('--iters', type=int, default=5)
+    parser.add_argument('-o', '--output', type=str, default=None, help='save the table as csv')
+    args = parser.parse_args()
+
+    config, _ = load_config(args.config)
+    if args.batch_size is not None:
+        config.train.batch_size = args.batch_size
+    if args.patch_size is not None:
+        for t in config.data.transform:
+            if 'patch_size' in t:
+                t.patch_size = args.patch_size
+    dataset_mgr = SkempiDatasetManager(config, num_cvfolds=3, num_workers=0)
+    batch = recursive_to(next(dataset_mgr.get_train_iterator(0)), args.device)
+
+    results = []
+    for ga, egnn in [(False, False), (True, False), (False, True), (True, True)]:
+        config.model.encoder.checkpoint_ga, config.model.encoder.checkpoint_egnn = ga, egnn
+        results.append({'checkpoint_ga': ga, 'checkpoint_egnn': egnn, **benchmark(config, batch, args.device, args.precision, args.iters)})
+        if args.device.startswith('cuda'):
+            torch.cuda.empty_cache()
+    results = pd.DataFrame(results)
+    results['time_ratio'] = results['time_per_step'] / results['time_per_step'][0]
+    results['activations_ratio'] = results['activations_mb'] / results['activations_mb'][0]
+    print('batch_size %d, patch_size %d' % tuple(batch['aa'].shape))
+    print(results.to_string(index=False))
+    if args.output is not None:
+        results.to_csv(args.output, index=False)
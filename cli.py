@@ -0,0 +1,38 @@
+import argparse
+import os
+import runpy
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Subcommand -> script (or module) and description. Scripts are only imported when run: `--help` does not import torch, the models or the datasets.
+COMMANDS = {
+    'train': ('train_skempi_abbind.py', 'train a ddG ensemble on SKEMPI (and ABbind) with cross-validation'),
+    'test': ('test_skempi.py', 'evaluate a ddG checkpoint on the cross-validation folds'),
+    'infer': ('infer.py', 'predict the ddG of mutations of a PDB structure'),
+    'scan': ('scan.py', 'saturation mutagenesis of a structure'),
+    'serve': ('serve.py', 'HTTP prediction service'),
+    'export': ('export_model.py', 'export a ddG ensemble to TorchScript or ONNX'),
+    'preprocess': ('preprocess_skempi.py', 'parse the SKEMPI structures and build the dataset caches'),
+    'embed': ('extract_embedding.py', 'extract ESM embeddings of the dataset sequences'),
+}
+
+
+def run(command, argv):
+    target, _ = COMMANDS[command]
+    sys.argv = [target] + list(argv)
+    if target.endswith('.py'):
+        runpy.run_path(os.path.join(ROOT, target), run_name='__main__')
+    else:
+        runpy.run_module(target, run_name='__main__', alter_sys=True)
+
+
+if __name__ == '__main__':
+    epilog = 'commands:\n' + '\n'.join('  %-12s %s' % (k, v[1]) for k, v in COMMANDS.items()) + '\n\nRun `%(prog)s <command> --help` for the options of a command.'
+    parser = argparse.ArgumentParser(description='PDC-Net command line.', epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=list(COMMANDS.keys()), metavar='command')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='arguments of the command')
+    args = parser.parse_args()
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    run(args.command, args.args)
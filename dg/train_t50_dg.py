@@ -13,6 +13,7 @@ torch.backends.cudnn.allow_tf32 = True
 
 from src.utils.misc import load_config, seed_all, get_logger, get_new_log_dir, current_milli_time
 from src.utils.train import *
+from src.utils.checkpoint import CheckpointManager
 from src.utils.t50 import T50DatasetManager
 
 if __name__ == '__main__':
@@ -23,6 +24,8 @@ if __name__ == '__main__':
     parser.add_argument('--device', type=str, default='cuda')
     parser.add_argument('--num_workers', type=int, default=4)
     parser.add_argument('--resume', type=str, default=None)
+    parser.add_argument('--keep_last', type=int, default=None, help='keep the last K checkpoints and the best one by Spearman, all by default')
+    parser.add_argument('--weights_only', action='store_true', default=False, help='also write inference checkpoints without the optimizer states')
     parser.add_argument('--pc', action='store_true', default=False)
     args = parser.parse_args()
 
@@ -49,6 +52,7 @@ if __name__ == '__main__':
             shutil.copyfile(args.config, os.path.join(log_dir, os.path.basename(args.config)))
     logger.info(args)
     logger.info(config)
+    ckpt_mgr = CheckpointManager(ckpt_dir, keep_last=args.keep_last, mode='max', weights_only=args.weights_only, logger=logger)
 
     logger.info('Loading datasets...')
     dataset_mgr = T50DatasetManager(config, num_workers=args.num_workers, logger=logger, )
@@ -153,8 +157,8 @@ if __name__ == '__main__':
                 if spearman_val > best_spearman_val:
                     best_spearman_val = spearman_val
                     best_i = i
-                if not args.debug:
-                    ckpt_path = os.path.join(ckpt_dir, '%d.pt' % i)
-                    torch.save({'config': config, 'model': cv_mgr.state_dict(), 'iteration': i, 'avg_val_loss': avg_val_loss, }, ckpt_path)
+                ckpt_mgr.save({'config': config, 'model': cv_mgr.state_dict(), 'iteration': i, 'avg_val_loss': avg_val_loss, }, i, metric=spearman_val)
     except KeyboardInterrupt:
         logger.info('Terminating...')
+    finally:
+        ckpt_mgr.close()
@@ -0,0 +1,63 @@
+import argparse
+import math
+import os
+import time
+import warnings
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export every fold of a ddG checkpoint and its pretrained encoder to a single TorchScript or ONNX file.')
+    parser.add_argument('checkpoint', type=str)
+    parser.add_argument('-o', '--output', type=str, default=None, help='*.pt (TorchScript) or *.onnx, defaults to the checkpoint path')
+    parser.add_argument('--format', type=str, default='torchscript', choices=['torchscript', 'onnx'])
+    parser.add_argument('--batch_size', type=int, default=16, help='samples per call of the exported model')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--num_batches', type=int, default=4, help='SKEMPI validation batches of the parity check')
+    parser.add_argument('--atol', type=float, default=1e-4)
+    args = parser.parse_args()
+
+    import torch  # after parsing, `--help` does not import torch
+    from src.utils.export import export_ensemble, load_exported, pad_batch
+    from src.utils.inference import load_ensemble
+    from src.utils.skempi import SkempiDatasetManager
+    from src.utils.train import EnsemblePredictor, recursive_to
+    output = args.output or os.path.splitext(args.checkpoint)[0] + ('.onnx' if args.format == 'onnx' else '.ts.pt')
+
+    time_start = time.time()
+    cv_mgr = load_ensemble(args.checkpoint, args.device)
+    time_eager_load = time.time() - time_start
+    config = torch.load(args.checkpoint, map_location='cpu')['config']
+    for model in cv_mgr.models:
+        model.recycle_tol = None  # fixed number of recycles
+    patch_size = max([t.patch_size for t in config.data.transform if 'patch_size' in t] + [0])
+    patch_size = math.ceil(patch_size / 8) * 8  # PaddingCollate pads to multiples of 8
+
+    config.train.batch_size = args.batch_size
+    dataset_mgr = SkempiDatasetManager(config, num_cvfolds=cv_mgr.num_cvfolds, num_workers=0)
+    batches = []
+    for batch in dataset_mgr.get_val_loader(0):
+        batches.append(recursive_to(batch, args.device))
+        if len(batches) >= args.num_batches: break
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=torch.jit.TracerWarning)  # the Python branches taken are fixed by the model config
+        meta = export_ensemble(cv_mgr, batches[0], output, fmt=args.format, batch_size=args.batch_size, patch_size=patch_size or None)
+    print(f'Exported {meta["num_cvfolds"]} folds of {meta["model"]} to {output} ({os.path.getsize(output) / 2 ** 20:.1f} MB), inputs {meta["keys"]}.')
+
+    # Parity and latency against the eager ensemble
+    time_start = time.time()
+    exported = load_exported(output, device=args.device)
+    time_export_load = time.time() - time_start
+    predictor = EnsemblePredictor(cv_mgr)
+    max_diff, time_eager, time_export = 0.0, 0.0, 0.0
+    for batch in batches:
+        padded = dict(zip(meta['keys'], pad_batch(batch, meta['keys'], batch['aa'].size(0), meta['patch_size'], meta['pad_values'])))
+        time_start = time.time()
+        ref = predictor.predict(padded)['ddG_pred_folds'].cpu()
+        time_eager += time.time() - time_start
+        time_start = time.time()
+        out = exported(batch)['ddG_pred_folds']
+        time_export += time.time() - time_start
+        max_diff = max(max_diff, (ref - out).abs().max().item())
+    print(f'Parity: max |eager - exported| = {max_diff:.2e} over {len(batches)} batches.')
+    print(f'Cold start: eager {time_eager_load:.2f} s, exported {time_export_load:.2f} s. Per batch: eager {time_eager / len(batches):.3f} s, exported {time_export / len(batches):.3f} s.')
+    assert max_diff <= args.atol, 'exported predictions differ from the eager model by %.2e' % max_diff
@@ -5,18 +5,6 @@ import pickle
 import shutil
 import copy
 
-import lmdb
-import torch
-from Bio import SeqIO
-from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
-from Bio.PDB.Polypeptide import one_to_index
-from esm import FastaBatchedDataset, pretrained, MSATransformer
-from tqdm import tqdm
-
-from src.utils.misc import seed_all
-from src.utils.protein.constants import (AA, three_to_one, non_standard_residue_substitutions)
-
 
 def run(args):
     model, alphabet = pretrained.load_model_and_alphabet(args.model_location)
@@ -95,6 +83,19 @@ if __name__ == "__main__":
 
     parser.add_argument("--nogpu", action="store_true", help="Do not use GPU even if available")
     args = parser.parse_args()
+
+    # After parsing, `--help` does not import torch, lmdb or esm
+    import lmdb
+    import torch
+    from Bio import SeqIO
+    from Bio.Seq import Seq
+    from Bio.SeqRecord import SeqRecord
+    from Bio.PDB.Polypeptide import one_to_index
+    from esm import FastaBatchedDataset, pretrained, MSATransformer
+    from tqdm import tqdm
+
+    from src.utils.misc import seed_all
+    from src.utils.protein.constants import (AA, three_to_one, non_standard_residue_substitutions)
     seed_all(2023)   # default seed
 
     # run train.py first to preprocess the dataset
@@ -1,101 +1,119 @@
 import argparse
 import copy
-
-import pandas as pd
-import torch.utils.tensorboard
-from Bio.PDB.MMCIFParser import MMCIFParser
-from Bio.PDB.PDBParser import PDBParser
-from Bio.PDB.Polypeptide import index_to_one, one_to_index
-from torch.utils.data import DataLoader, Dataset
-from tqdm.auto import tqdm
-
-from src.models.rde_ddg import DDG_RDE_Network
-from src.utils.data import PaddingCollate
-from src.utils.misc import load_config
-from src.utils.protein.parsers import parse_biopython_structure
-from src.utils.train import *
-from src.utils.transforms import Compose, SelectAtom, SelectedRegionFixedSizePatch
-
-
-class PMDataset(Dataset):
-
-    def __init__(self, pdb_path, mutations):
-        super().__init__()
-        self.pdb_path = pdb_path
-
-        self.data = None
-        self.seq_map = None
-        self._load_structure()
-
-        self.mutations = self._parse_mutations(mutations)
-        self.transform = Compose([SelectAtom('backbone+CB'), SelectedRegionFixedSizePatch('mut_flag', 128)])
-
-    def clone_data(self):
-        return copy.deepcopy(self.data)
-
-    def _load_structure(self):
-        if self.pdb_path.endswith('.pdb'):
-            parser = PDBParser(QUIET=True)
-        elif self.pdb_path.endswith('.cif'):
-            parser = MMCIFParser(QUIET=True)
-        else:
-            raise ValueError('Unknown file type.')
-
-        structure = parser.get_structure(None, self.pdb_path)
-        data, seq_map = parse_biopython_structure(structure[0])
-        self.data = data
-        self.seq_map = seq_map
-
-    def _parse_mutations(self, mutations):
-        parsed = []
-        for m in mutations:
-            wt, ch, mt = m[0], m[1], m[-1]
-            seq = int(m[2:-1])
-            pos = (ch, seq, ' ')
-            if pos not in self.seq_map: continue
-
-            if mt == '*':
-                for mt_idx in range(20):
-                    mt = index_to_one(mt_idx)
-                    if mt == wt: continue
-                    parsed.append({'position': pos, 'wt': wt, 'mt': mt, })
-            else:
-                parsed.append({'position': pos, 'wt': wt, 'mt': mt, })
-        return parsed
-
-    def __len__(self):
-        return len(self.mutations)
-
-    def __getitem__(self, index):
-        data = self.clone_data()
-        mut = self.mutations[index]
-        mut_pos_idx = self.seq_map[mut['position']]
-
-        data['mut_flag'] = torch.zeros(size=data['aa'].shape, dtype=torch.bool)
-        data['mut_flag'][mut_pos_idx] = True
-        data['aa_mut'] = data['aa'].clone()
-        data['aa_mut'][mut_pos_idx] = one_to_index(mut['mt'])
-        data = self.transform(data)
-        data['ddG'] = 0
-        data['mutstr'] = '{}{}{}{}'.format(mut['wt'], mut['position'][0], mut['position'][1], mut['mt'])
-        return data
+import os
+from collections import deque
+
+
+def result_rows(batch, out_dict, keys=('mutstr', )):
+    rows = []
+    for i, (ddG_pred, ddG_std, ddG_folds) in enumerate(zip(out_dict['ddG_pred'].cpu().tolist(), out_dict['ddG_pred_std'].cpu().tolist(), out_dict['ddG_pred_folds'].t().cpu().tolist())):
+        rows.append({**{k: batch[k][i] for k in keys}, 'ddG_pred': ddG_pred, 'ddG_pred_std': ddG_std, **{'ddG_pred_fold%d' % f: v for f, v in enumerate(ddG_folds)}})
+    return rows
+
+
+def iter_manifest_samples(manifest, cache, transform, done=frozenset(), lookahead=8):
+    """Mutant samples of every manifest record, the structures of the next `lookahead` records are parsed in the background."""
+    records = iter_manifest(manifest)
+    window = deque()
+    while True:
+        while len(window) < lookahead:
+            record = next(records, None)
+            if record is None: break
+            cache.prefetch(record['path'])
+            window.append(record)
+        if len(window) == 0: break
+
+        record = window.popleft()
+        try:
+            data, seq_map = cache.get(record['path'])
+        except Exception as e:
+            data, seq_map = None, repr(e)
+        if data is None:
+            print(f'Warning: skipping {record["pdb"]}, structure could not be parsed ({seq_map}).')
+            continue
+        for mut in parse_mutations(record['mutations'], seq_map):
+            if (record['pdb'], '{}{}{}{}'.format(mut['wt'], mut['position'][0], mut['position'][1], mut['mt'])) in done: continue
+            sample = mutant_sample(data, seq_map, mut, transform)
+            sample['pdb'] = record['pdb']
+            yield sample
+
+
+def run_manifest(args, predictor):
+    """Predicts every mutation of a manifest, results are appended batch by batch so that memory does not grow with the number of mutations."""
+    if os.path.exists(args.output) and not args.resume:
+        raise FileExistsError(f'{args.output} exists, use --resume to continue it.')
+    writer = ResultWriter(args.output)
+    done = writer.done_keys() if args.resume else frozenset()
+    cache = StructureCache(capacity=max(args.cache_size, 2 * args.num_workers), num_workers=args.num_workers, transform=SelectAtom('backbone+CB'))
+    batcher = LengthBucketBatcher(args.batch_size, PaddingCollate())
+    samples = iter_manifest_samples(args.manifest, cache, SelectedRegionFixedSizePatch('mut_flag', 128), done=done, lookahead=max(2 * args.num_workers, 1))
+
+    def _predict(batch):
+        batch = recursive_to(batch, args.device)
+        writer.write(result_rows(batch, predictor.predict(batch), keys=('pdb', 'mutstr')))
+
+    count = len(done)
+    try:
+        for sample in tqdm(samples, desc='Mutations', dynamic_ncols=True):
+            batch = batcher.add(sample)
+            if batch is not None:
+                _predict(batch)
+            count += 1
+        for batch in batcher.flush():
+            _predict(batch)
+    finally:
+        writer.close()
+        cache.close()
+    print(f'{count} mutations, results saved to {args.output}.')
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('config', type=str)
-    parser.add_argument('-o', '--output', type=str, default='pm_results.csv')
+    parser.add_argument('-o', '--output', type=str, default='pm_results.csv', help='*.csv, or *.parquet (a directory of part files) in manifest mode')
     parser.add_argument('--device', type=str, default='cuda')
     parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--manifest', type=str, default=None, help='JSONL/CSV of (pdb, mutations), overrides config.pdb and config.mutations')
+    parser.add_argument('--num_workers', type=int, default=4, help='structure parsing processes in manifest mode')
+    parser.add_argument('--cache_size', type=int, default=32, help='parsed structures kept in memory in manifest mode')
+    parser.add_argument('--resume', action='store_true', default=False, help='skip the mutations already in the output')
+    parser.add_argument('--quantize', action='store_true', default=False, help='dynamic int8 quantization of the Linear layers, CPU only')
+    parser.add_argument('--compile', action='store_true', default=False, help='compile the encoders with torch.compile, pays off on large inputs')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'], help='mixed precision inference, bf16 also runs on CPU')
     args = parser.parse_args()
+
+    # After parsing, `--help` does not import torch
+    import pandas as pd
+    import torch
+    from torch.utils.data import DataLoader
+    from tqdm.auto import tqdm
+
+    from src.models import get_ddg_model
+    from src.utils.data import PaddingCollate
+    from src.utils.inference import LengthBucketBatcher, PMDataset, ResultWriter, StructureCache, iter_manifest, mutant_sample, parse_mutations
+    from src.utils.misc import load_config
+    from src.utils.train import *
+    from src.utils.transforms import SelectAtom, SelectedRegionFixedSizePatch
     config, _ = load_config(args.config)
 
     # Model
     ckpt = torch.load(config.checkpoint, map_location='cpu')
-    cv_mgr = CrossValidation(model_factory=DDG_RDE_Network, config=ckpt['config'], num_cvfolds=3)
+    cv_mgr = CrossValidation(model_factory=get_ddg_model(ckpt['config'].model), config=ckpt['config'], num_cvfolds=len(ckpt['model']['models']))
     cv_mgr.load_state_dict(ckpt['model'])
     cv_mgr.to(args.device)
-    model = cv_mgr.models[0]
+    if args.compile:
+        for model in cv_mgr.models:
+            compile_encoders(model)
+    predictor = EnsemblePredictor(cv_mgr, precision=args.precision)
+    if args.quantize:  # after the predictor has compared the float pretrained encoders of the folds
+        from src.utils.quantization import quantize_dynamic_int8
+        assert args.device == 'cpu', 'Quantized models run on CPU.'
+        cv_mgr.models = copy.deepcopy(cv_mgr.models)  # keeps the process-wide pretrained encoder in float
+        for model in cv_mgr.models:
+            quantize_dynamic_int8(model)
+    if args.manifest is not None:
+        run_manifest(args, predictor)
+        exit()
 
     # Data
     dataset = PMDataset(pdb_path=config.pdb, mutations=config.mutations, )
@@ -104,15 +122,8 @@ if __name__ == '__main__':
     result = []
     for batch in tqdm(loader):
         batch = recursive_to(batch, args.device)
-        for fold in range(cv_mgr.num_cvfolds):
-            model, _, _ = cv_mgr.get(fold)
-            model.eval()
-            with torch.no_grad():
-                _, out_dict = model(batch)
-            for mutstr, ddG_pred in zip(batch['mutstr'], out_dict['ddG_pred'].cpu().tolist()):
-                result.append({'mutstr': mutstr, 'ddG_pred': ddG_pred, })
+        result.extend(result_rows(batch, predictor.predict(batch)))
     result = pd.DataFrame(result)
-    result = result.groupby('mutstr').mean().reset_index()
     result['rank'] = result['ddG_pred'].rank() / len(result)
     print(result)
     print(f'Results saved to {args.output}.')
@@ -0,0 +1,15 @@
+import argparse
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parse the SKEMPI structures and build the dataset caches, as `python -m src.datasets.skempi`.')
+    parser.add_argument('--skempi_csv_path', type=str, default='./data/SKEMPI_v2/skempi_v2.csv')
+    parser.add_argument('--skempi_pdb_dir', type=str, default='./data/SKEMPI_v2/PDBs')
+    parser.add_argument('--cache_dir', type=str, default='./data/SKEMPI_v2_cache')
+    parser.add_argument('--reset', action='store_true', default=False)
+    args = parser.parse_args()
+
+    from src.datasets.skempi import SkempiABbindDataset  # after parsing, `--help` does not import torch
+    dataset = SkempiABbindDataset(skempi_csv_path=args.skempi_csv_path, skempi_pdb_dir=args.skempi_pdb_dir, cache_dir=args.cache_dir, split='val', num_cvfolds=5, cvfold_index=2,
+                                  reset=args.reset, )
+    print(dataset[0])
+    print(len(dataset))
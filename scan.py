@@ -0,0 +1,34 @@
+import argparse
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config', type=str)  # same as infer.py: checkpoint, pdb and mutations, e.g. 'TI17*'
+    parser.add_argument('-o', '--output', type=str, default='scan_results.csv')
+    parser.add_argument('--interface', action='store_true', default=False, help='scan every interface position instead of the configured mutations')
+    parser.add_argument('--cutoff', type=float, default=8.0, help='CB distance cutoff of interface residues')
+    parser.add_argument('--chains', type=str, default=None, help='chains on one side of the interface, e.g. HL')
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--batch_size', type=int, default=4, help='positions per batch, each with 19 mutants')
+    args = parser.parse_args()
+
+    from src.utils.inference import load_ensemble  # after parsing, `--help` does not import torch
+    from src.utils.misc import load_config
+    from src.utils.mutagenesis import SaturationMutagenesis
+    config, _ = load_config(args.config)
+
+    # Model
+    cv_mgr = load_ensemble(config.checkpoint, args.device)
+
+    # Scan
+    engine = SaturationMutagenesis(cv_mgr, config.pdb, device=args.device)
+    positions = engine.interface_positions(args.cutoff, args.chains) if args.interface else engine.parse_positions(config.mutations)
+    print(f'Scanning {len(positions)} positions.')
+    result = engine.scan(positions, batch_size=args.batch_size)
+    result['rank'] = result['ddG_pred'].rank() / len(result)
+    print(result)
+    print(f'{len(result)} mutations, {engine.throughput:.1f} mutations/sec.')
+    print(f'Results saved to {args.output}.')
+    result.to_csv(args.output)
+
+    if 'interest' in config and config.interest:
+        print(result[result['mutstr'].isin(config.interest)])
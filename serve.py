@@ -0,0 +1,40 @@
+import argparse
+import os
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoint', type=str)
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--socket', type=str, default=None, help='serve on this Unix socket instead of TCP')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--batch_size', type=int, default=32, help='maximum mutations per micro-batch')
+    parser.add_argument('--max_wait_ms', type=float, default=10.0, help='latency deadline of a micro-batch after its first request')
+    parser.add_argument('--cache_size', type=int, default=64, help='parsed structures kept in memory')
+    parser.add_argument('--patch_size', type=int, default=128)
+    parser.add_argument('--verbose', action='store_true', default=False, help='log every request')
+    args = parser.parse_args()
+
+    import torch  # after parsing, `--help` does not import torch
+    from src.utils.inference import load_ensemble
+    from src.utils.server import DDGService, make_server
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    # Models stay loaded for the lifetime of the server, CPU only
+    cv_mgr = load_ensemble(args.checkpoint, 'cpu')
+    service = DDGService(cv_mgr, device='cpu', patch_size=args.patch_size, batch_size=args.batch_size, max_wait_ms=args.max_wait_ms, cache_size=args.cache_size)
+
+    if args.socket is not None and os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = make_server(service, args.host, args.port, socket_path=args.socket, quiet=not args.verbose)
+    print(f'Serving {service.model_name} ({service.num_cvfolds} folds) on {args.socket or "http://%s:%d" % (args.host, args.port)}.')
+    print('POST /predict {"pdb": path or "pdb_text": content, "mutations": [...]}, GET /health, GET /metrics.')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
@@ -1,4 +1,10 @@
-from .pdbredo_chain import PDBRedoChainDataset
-from .skempi import SkempiABbindDataset
-from .t50_ddg import T50DDGDataset
-from .t50_dg import T50DGDataset
+# Datasets are imported on first use, e.g. `pdbredo_chain` requires lmdb.
+from ._base import register_dataset, get_dataset_class
+
+_LEGACY_NAMES = {'PDBRedoChainDataset': 'pdbredo_chain', 'SkempiABbindDataset': 'skempi', 'T50DDGDataset': 't50_ddg', 'T50DGDataset': 't50_dg'}
+
+
+def __getattr__(name):
+    if name in _LEGACY_NAMES:
+        return get_dataset_class(_LEGACY_NAMES[name])
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
@@ -0,0 +1,23 @@
+import importlib
+
+_DATASET_DICT = {}
+_DATASET_MODULES = {  # registered name -> module that registers it, imported on first use
+    'skempi': 'src.datasets.skempi', 'pdbredo_chain': 'src.datasets.pdbredo_chain', 't50_ddg': 'src.datasets.t50_ddg', 't50_dg': 'src.datasets.t50_dg',
+    'md': 'src.datasets.md',
+}
+
+
+def register_dataset(name):
+    def decorator(cls):
+        _DATASET_DICT[name] = cls
+        return cls
+
+    return decorator
+
+
+def get_dataset_class(name):
+    if name not in _DATASET_DICT and name in _DATASET_MODULES:
+        importlib.import_module(_DATASET_MODULES[name])
+    if name not in _DATASET_DICT:
+        raise NotImplementedError('Dataset not supported: %s' % name)
+    return _DATASET_DICT[name]
@@ -8,10 +8,12 @@ from torch.utils.data import Dataset
 from tqdm.auto import tqdm
 
 from src.utils.protein.parsers import parse_biopython_structure
+from src.datasets._base import register_dataset
 
 md_entries = ['2b2x', '2noj', '2qja', '3mzg', '4uyq', '5e9d', '5f4e', ]
 
 
+@register_dataset('md')
 class MolecularDynamicsDataset(Dataset):
 
     def __init__(self, split, md_pdb_dir, cache_dir, transform=None, blocklist=frozenset({}), reset=False, ):
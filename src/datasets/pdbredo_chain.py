@@ -15,6 +15,7 @@ from tqdm.auto import tqdm
 
 from src.utils.protein.parsers import parse_biopython_structure
 from src.utils.transforms._base import _truncate_data
+from src.datasets._base import register_dataset
 
 ClusterIdType, PdbCodeType, ChainIdType = str, str, str
 
@@ -35,6 +36,7 @@ def _process_structure(cif_path, structure_id) -> Optional[Dict]:
     return data
 
 
+@register_dataset('pdbredo_chain')
 class PDBRedoChainDataset(Dataset):
     MAP_SIZE = 384 * (1024 * 1024 * 1024)  # 384GB
 
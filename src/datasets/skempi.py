@@ -12,6 +12,7 @@ from Bio.PDB.PDBParser import PDBParser
 from Bio.PDB.Polypeptide import one_to_index
 
 from src.utils.protein.parsers import parse_biopython_structure
+from src.datasets._base import register_dataset
 
 
 def load_skempi_entries(csv_path, pdb_dir, block_list):
@@ -85,6 +86,7 @@ def load_abbind_entries(csv_path, pdb_dir, block_list=('3NPS', )):
     return entries
 
 
+@register_dataset('skempi')
 class SkempiABbindDataset(Dataset):
 
     def __init__(self, skempi_csv_path, skempi_pdb_dir, cache_dir, abbind_csv_path=None, abbind_pdb_dir=None, use_plm=False, cvfold_index=0, num_cvfolds=3, split='train',
@@ -198,6 +200,14 @@ class SkempiABbindDataset(Dataset):
     def __len__(self):
         return len(self.entries)
 
+    def is_deterministic(self, index):
+        """Whether the masking of `self[index]` is a pure function of the entry, the transform is not considered."""
+        if self.mask_length == 0:
+            return True
+        if len(self.entries[index]['mutations']) != 1:  # the refined mutation is drawn at random
+            return False
+        return self.mask_noise_scale == 0 or (self.mask_mode == 'easy' and self.split != 'train')
+
     def __getitem__(self, index):
         entry = self.entries[index]
         data, seq_map = copy.deepcopy(self.structures[entry['pdbcode']])
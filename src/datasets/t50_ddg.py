@@ -12,6 +12,7 @@ from Bio.PDB.PDBParser import PDBParser
 from Bio.PDB.Polypeptide import one_to_index
 
 from src.utils.protein.parsers import parse_biopython_structure
+from src.datasets._base import register_dataset
 
 
 def load_t50_entries(csv_path):
@@ -51,6 +52,7 @@ def load_t50_entries(csv_path):
     return entries
 
 
+@register_dataset('t50_ddg')
 class T50DDGDataset(Dataset):
 
     def __init__(self, csv_path, cache_dir, split='train', transform=None, blocklist=frozenset({'1KBH'}), reset=False):
@@ -9,6 +9,7 @@ from torch.utils.data import Dataset
 from tqdm.auto import tqdm
 
 from src.utils.protein.parsers import parse_biopython_structure
+from src.datasets._base import register_dataset
 
 
 def load_t50_entries(csv_path):
@@ -27,6 +28,7 @@ def load_t50_entries(csv_path):
     return entries
 
 
+@register_dataset('t50_dg')
 class T50DGDataset(Dataset):
 
     def __init__(self, fold_path, cache_dir, split='train', transform=None, blocklist=frozenset({'1KBH'}), reset=False):
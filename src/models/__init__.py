@@ -1,4 +1,10 @@
-from .rde import CircularSplineRotamerDensityEstimator
-from .rde_ddg import DDG_RDE_Network
-from .pdc_ddg import DDG_PDC_Network
-from .equiformer import EquiformerNet
+# Models are imported on first use, `src.models.equiformer` and the ddG networks pull in their own encoders and dependencies.
+from ._base import register_model, get_model_class, ddg_model_name, get_ddg_model
+
+_LEGACY_NAMES = {'CircularSplineRotamerDensityEstimator': 'rde', 'DDG_RDE_Network': 'ddg_rde', 'DDG_PDC_Network': 'ddg_pdc', 'EquiformerNet': 'equiformer'}
+
+
+def __getattr__(name):
+    if name in _LEGACY_NAMES:
+        return get_model_class(_LEGACY_NAMES[name])
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
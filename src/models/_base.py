@@ -0,0 +1,36 @@
+import importlib
+
+_MODEL_DICT = {}
+_MODEL_MODULES = {  # registered name -> module that registers it, imported on first use
+    'rde': 'src.models.rde', 'rde_mlm': 'src.models.rde_mlm', 'pdc': 'src.models.pdc', 'equiformer': 'src.models.equiformer',
+    'ddg_rde': 'src.models.rde_ddg', 'ddg_pdc': 'src.models.pdc_ddg', 'ddg_pdc_refine': 'src.models.pdc_ddg_refine', 'dg_rde': 'src.models.rde_dg',
+}
+
+
+def register_model(name):
+    def decorator(cls):
+        _MODEL_DICT[name] = cls
+        return cls
+
+    return decorator
+
+
+def get_model_class(name):
+    if name not in _MODEL_DICT and name in _MODEL_MODULES:
+        importlib.import_module(_MODEL_MODULES[name])
+    if name not in _MODEL_DICT:
+        raise NotImplementedError('Model not supported: %s' % name)
+    return _MODEL_DICT[name]
+
+
+def ddg_model_name(cfg):
+    """Registered name of the ddG network of a model config, `name` if given, otherwise inferred from the config as the checkpoints were trained."""
+    if 'name' in cfg:
+        return cfg.name
+    if cfg.get('type', None) == 'ga':
+        return 'ddg_rde'
+    return 'ddg_pdc_refine' if 'pos' in cfg else 'ddg_pdc'
+
+
+def get_ddg_model(cfg):
+    return get_model_class(ddg_model_name(cfg))
@@ -9,8 +9,10 @@ from src.modules.encoders.pair import ResiduePairEncoder
 from src.modules.encoders.single import PerResidueEncoder
 from src.utils.protein.constants import BBHeavyAtom, num_aa_types, chi_angles_atoms, HeavyAtom2int, num_chi_angles
 from src.modules.encoders.egnn import EGNN_Network
+from src.models._base import register_model
 
 
+@register_model('equiformer')
 class EquiformerNet(nn.Module):
 
     def __init__(self, cfg, max_aa_types=22):
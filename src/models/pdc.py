@@ -2,13 +2,70 @@ import numpy as np
 import torch
 import torch.nn as nn
 
-from src.modules.encoders.attn import GAEncoder
+from src.modules.encoders.attn import get_ga_encoder
 from src.modules.encoders.pair import ResiduePairEncoder
 from src.modules.encoders.single import PerResidueEncoder
 from src.utils.protein.constants import BBHeavyAtom, num_aa_types, chi_angles_atoms, HeavyAtom2int, num_chi_angles
 from src.modules.encoders.egnn import EGNN_Network
+from src.utils.data import index_select_batch
+from src.models._base import register_model
 
 
+class RecycleCounter(object):
+    """Number of refinement recycles used per sample, averaged over the predictions since the last `reset`."""
+
+    def __init__(self):
+        super().__init__()
+        self.reset()
+
+    def reset(self):
+        self.total, self.count = 0, 0
+
+    def add(self, num_recycles):
+        self.total += num_recycles.sum().item()
+        self.count += num_recycles.numel()
+
+    @property
+    def average(self):
+        return self.total / self.count if self.count > 0 else float('nan')
+
+
+@torch.no_grad()
+def adaptive_recycle(refine_fn, batch, pos_change_flag, max_recycle, tol):
+    """
+    Inference-time recycling with per-sample early exit: a sample stops once the RMS update of its flagged atoms drops below `tol`,
+    converged samples are removed from the batch so that the remaining recycles only run on the others. `tol=0` recycles `max_recycle` times.
+    Args:
+        refine_fn:          One recycle, maps (batch, pos_change_flag, state) to the refined coordinates, (N, L * A, 3) or (N, L, 3).
+                            `state` is a dict of (N, ...) tensors carried across recycles, see `encode`.
+        pos_change_flag:    (N, L * A) or (N, L), the refined atoms.
+    Returns:
+        Refined coordinates with the shape of `batch['pos_atoms']` and the number of recycles of each sample (N, ).
+    """
+    pos_atoms = batch['pos_atoms'].clone()
+    active = torch.arange(pos_atoms.size(0), device=pos_atoms.device)
+    num_recycles = torch.zeros_like(active)
+    batch_active, flag_active, state = batch, pos_change_flag, {}
+    for _ in range(max_recycle):
+        coors = refine_fn(batch_active, flag_active, state)
+        update = ((coors - batch_active['pos_atoms'].reshape(coors.shape)) ** 2).sum(dim=-1)  # (n, L * A)
+        rms = torch.sqrt((update * flag_active).sum(dim=1) / flag_active.sum(dim=1).clamp(min=1))
+        pos_atoms[active] = coors.reshape(len(active), *pos_atoms.shape[1:])
+        num_recycles[active] += 1
+
+        running = rms >= tol
+        if not running.any():
+            break
+        if not running.all():  # batch compaction
+            index = torch.nonzero(running)[:, 0]
+            active, flag_active = active[index], flag_active[index]
+            batch_active = index_select_batch(batch_active, index)
+            state = {k: v[index] for k, v in state.items()}
+        batch_active = {**batch_active, 'pos_atoms': pos_atoms[active]}
+    return pos_atoms, num_recycles
+
+
+@register_model('pdc')
 class ProbabilityDensityCloud(nn.Module):
 
     def __init__(self, cfg, max_aa_types=22):
@@ -19,6 +76,8 @@ class ProbabilityDensityCloud(nn.Module):
         self.resolution = cfg.resolution
         if self.target == 'refine':
             self.recycle = cfg.pos.recycle
+            self.recycle_tol = cfg.pos.get('recycle_tol', None)  # adaptive early exit at inference, in Angstrom
+            self.recycle_counter = RecycleCounter()
         dim = 1280 if self.use_plm else cfg.encoder.node_feat_dim
         # dim = cfg.encoder.node_feat_dim
         # if self.use_plm:
@@ -34,9 +93,10 @@ class ProbabilityDensityCloud(nn.Module):
         # Encoding
         self.single_encoder = PerResidueEncoder(feat_dim=dim, max_num_atoms=5)  # N, CA, C, O, CB,   # TODO: only use backbone geometries rather than side-chain
         self.pair_encoder = ResiduePairEncoder(feat_dim=cfg.encoder.pair_feat_dim, max_num_atoms=5)  # N, CA, C, O, CB
-        self.attn_encoder = GAEncoder(node_feat_dim=dim, pair_feat_dim=cfg.encoder.pair_feat_dim, num_layers=cfg.encoder.num_layers, )
+        self.attn_encoder = get_ga_encoder(cfg.encoder, node_feat_dim=dim)
         self.spatial_project = EGNN_Network(dim=dim, depth=cfg.encoder.num_layers, num_nearest_neighbors=cfg.encoder.num_nearest_neighbors, norm_coors=cfg.encoder.norm_coors,
-                                            update_coors_mean=cfg.encoder.update_coors_mean, update_coors_var=cfg.encoder.update_coors_var, dropout=dropout_)
+                                            update_coors_mean=cfg.encoder.update_coors_mean, update_coors_var=cfg.encoder.update_coors_var, dropout=dropout_,
+                                            knn_first=cfg.encoder.get('knn_first', False), checkpoint=cfg.encoder.get('checkpoint_egnn', False), subgraph_hops=cfg.encoder.get('refine_subgraph_hops', 0))
         self.masked_bias = nn.Embedding(num_embeddings=2, embedding_dim=dim, padding_idx=0, )
         # self.angle_predictor = nn.Sequential(nn.Dropout(dropout_), nn.Linear(dim, dim), nn.ReLU(), nn.Linear(dim, 4), nn.Sigmoid())
         self.angle_predictor = nn.Sequential(nn.Linear(dim, dim), nn.ReLU(), nn.Linear(dim, 4), nn.Sigmoid())
@@ -49,24 +109,34 @@ class ProbabilityDensityCloud(nn.Module):
         self.register_buffer('num_chis_of_aa',
                              torch.tensor(data=[len(chi_angles_atoms[i]) if i < len(chi_angles_atoms) else 0 for i in range(num_aa_types + 1)], dtype=torch.long, ))
 
-    def encode(self, batch, mode='wt'):
+    def encode(self, batch, mode='wt', state=None):
+        """
+        Args:
+            state:  Dict shared by the recycles of one batch (only the coordinates change between them), to reuse the single features and unchanged pair features.
+        """
         mask_residue = batch['mask_atoms'][:, :, BBHeavyAtom.CA]
         if self.target == 'chi_angle':
             chi = batch['chi_corrupt']
         else:
             chi = batch['chi']
 
-        x = self.single_encoder(aa=batch['aa'], phi=batch['phi'], phi_mask=batch['phi_mask'], psi=batch['psi'], psi_mask=batch['psi_mask'], chi=chi, chi_mask=batch['chi_mask'],
-                                mask_residue=mask_residue, )
-        if self.use_plm:  # comply with downstream ddG task
-            # x += self.plm_linear(batch['plm_wt']) if mode == 'wt' else self.plm_linear(batch['plm_mut'])
-            x += batch['plm_wt'] if mode == 'wt' else batch['plm_mut']
-
-        if self.target == 'chi_angle':
-            b = self.masked_bias(batch['chi_masked_flag'].long())
-            x = x + b
-        z = self.pair_encoder(aa=batch['aa'], res_nb=batch['res_nb'], chain_nb=batch['chain_nb'], pos_atoms=batch['pos_atoms'], mask_atoms=batch['mask_atoms'], )
-        x = self.attn_encoder(pos_atoms=batch['pos_atoms'], res_feat=x, pair_feat=z, mask=mask_residue)
+        x = state.get('single_feat', None) if state is not None else None
+        if x is None:
+            x = self.single_encoder(aa=batch['aa'], phi=batch['phi'], phi_mask=batch['phi_mask'], psi=batch['psi'], psi_mask=batch['psi_mask'], chi=chi, chi_mask=batch['chi_mask'],
+                                    mask_residue=mask_residue, )
+            if self.use_plm:  # comply with downstream ddG task
+                # x += self.plm_linear(batch['plm_wt']) if mode == 'wt' else self.plm_linear(batch['plm_mut'])
+                x += batch['plm_wt'] if mode == 'wt' else batch['plm_mut']
+
+            if self.target == 'chi_angle':
+                b = self.masked_bias(batch['chi_masked_flag'].long())
+                x = x + b
+            if state is not None:
+                state['single_feat'] = x
+        nbr_idx = self.attn_encoder.get_neighbors(batch['pos_atoms'], batch['mask_atoms'])  # None for dense attention
+        pair_args = dict(aa=batch['aa'], res_nb=batch['res_nb'], chain_nb=batch['chain_nb'], pos_atoms=batch['pos_atoms'], mask_atoms=batch['mask_atoms'], nbr_idx=nbr_idx)
+        z = self.pair_encoder(**pair_args) if state is None else self.pair_encoder.forward_incremental(state, **pair_args)
+        x = self.attn_encoder(pos_atoms=batch['pos_atoms'], res_feat=x, pair_feat=z, mask=mask_residue, nbr_idx=nbr_idx)
 
         if self.target == 'refine':
             return x
@@ -142,12 +212,19 @@ class ProbabilityDensityCloud(nn.Module):
                 pos_gt = torch.flatten(batch['pos_gt'], start_dim=1, end_dim=2)[pos_change_flag]
 
             loss_coors = []
-            for _ in range(self.recycle):
-                res_feat = self.encode(batch)
-                coors = self.refine(res_feat, pos_change_flag, batch)
-                # distance loss (instead of RMSE) for each iteration, https://discuss.pytorch.org/t/function-mselossbackward-returned-nan-values-in-its-0th-output/94875
-                loss_coors.append(torch.sqrt(((pos_gt - coors[pos_change_flag]) ** 2).sum(dim=-1) + 1e-10).mean())  # sum() leads to explosion
-                batch['pos_atoms'] = coors.detach().clone().reshape(batch['pos_atoms'].shape)
+            if self.recycle_tol is not None and not self.training:
+                coors, num_recycles = adaptive_recycle(lambda b, f, state: self.refine(self.encode(b, state=state), f, b), batch, pos_change_flag, self.recycle, self.recycle_tol)
+                self.recycle_counter.add(num_recycles)
+                loss_coors.append(torch.sqrt(((pos_gt - coors.reshape(*pos_change_flag.shape, 3)[pos_change_flag]) ** 2).sum(dim=-1) + 1e-10).mean())
+                batch['pos_atoms'] = coors
+            else:
+                state = {}
+                for _ in range(self.recycle):
+                    res_feat = self.encode(batch, state=state)
+                    coors = self.refine(res_feat, pos_change_flag, batch)
+                    # distance loss (instead of RMSE) for each iteration, https://discuss.pytorch.org/t/function-mselossbackward-returned-nan-values-in-its-0th-output/94875
+                    loss_coors.append(torch.sqrt(((pos_gt - coors[pos_change_flag]) ** 2).sum(dim=-1) + 1e-10).mean())  # sum() leads to explosion
+                    batch['pos_atoms'] = coors.detach().clone().reshape(batch['pos_atoms'].shape)
 
             if mode == 'train':
                 loss_dict['pos_refine'] = torch.stack(loss_coors).sum()
@@ -2,16 +2,17 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from src.modules.encoders.egnn_attn import GAEncoder
+from src.modules.encoders.attn import get_ga_encoder
 from src.modules.encoders.pair import ResiduePairEncoder
 from src.modules.encoders.single import PerResidueEncoder
+from src.models.pretrained import check_frozen, load_pretrained
 from src.utils.protein.constants import BBHeavyAtom, HeavyAtom2int
-from .rde import CircularSplineRotamerDensityEstimator
-from src.models.rde_mlm import MaskedLanguageModelingDensityEstimator
-from src.models.pdc import ProbabilityDensityCloud
+from src.utils.data import index_select_batch
 from src.modules.encoders.egnn import EGNN_Network
+from src.models._base import register_model
 
 
+@register_model('ddg_pdc')
 class DDG_PDC_Network(nn.Module):
 
     def __init__(self, cfg, max_aa_types=22):
@@ -28,19 +29,11 @@ class DDG_PDC_Network(nn.Module):
             self.var_embed = nn.Embedding(max_aa_types, 3)    # each residue has a different positional variance
 
         # Pretrain
+        self.feature_cache = None
         if cfg.checkpoint.path:
             self.ckpt_type = cfg.checkpoint.type
-            print(f'Loading {cfg.checkpoint.type} from {cfg.checkpoint.path}')
-            ckpt = torch.load(cfg.checkpoint.path, map_location='cpu')
-            if self.ckpt_type == 'CircularSplineRotamerDensityEstimator':
-                self.rde = CircularSplineRotamerDensityEstimator(ckpt['config'].model)
-            elif self.ckpt_type == 'MaskedLanguageModelingDensityEstimator':
-                self.rde = MaskedLanguageModelingDensityEstimator(ckpt['config'].model)
-            elif self.ckpt_type == 'ProbabilityDensityCloud':
-                self.rde = ProbabilityDensityCloud(ckpt['config'].model)
-            self.rde.load_state_dict(ckpt['model'])
-            for p in self.rde.parameters():
-                p.requires_grad_(False)
+            encoder = {k: v for k, v in cfg.encoder.items() if k in ('attention', 'attention_neighbors')} if self.ckpt_type == 'ProbabilityDensityCloud' else None  # same weights
+            self.rde = load_pretrained(self.ckpt_type, cfg.checkpoint.path, encoder=encoder)  # shared by the models built from the same checkpoint
             self.single_fusion = nn.Sequential(nn.Linear(2 * dim, dim), nn.ReLU(), nn.Linear(dim, dim))
         else:
             self.rde = None
@@ -52,23 +45,45 @@ class DDG_PDC_Network(nn.Module):
 
         if self.resolution != 'CA':
             self.token_emb = nn.Embedding(len(HeavyAtom2int) + 1, dim)  # 6 atom types
-        self.attn_encoder = GAEncoder(node_feat_dim=dim, pair_feat_dim=cfg.encoder.pair_feat_dim, num_layers=cfg.encoder.num_layers,)
+        self.attn_encoder = get_ga_encoder(cfg.encoder, node_feat_dim=dim)
 
         self.spatial_project = EGNN_Network(dim=dim, depth=cfg.encoder.num_layers, num_nearest_neighbors=cfg.encoder.num_nearest_neighbors, norm_coors=cfg.encoder.norm_coors,
-                                            update_coors_mean=cfg.encoder.update_coors_mean, update_coors_var=cfg.encoder.update_coors_var)
+                                            update_coors_mean=cfg.encoder.update_coors_mean, update_coors_var=cfg.encoder.update_coors_var,
+                                            knn_first=cfg.encoder.get('knn_first', False), checkpoint=cfg.encoder.get('checkpoint_egnn', False))
 
         # Pred
         self.ddg_readout = nn.Sequential(nn.Linear(dim, dim // 2), nn.ReLU(), nn.Linear(dim // 2, dim // 4), nn.ReLU(), nn.Linear(dim // 4, 1))
 
+    def set_feature_cache(self, feature_cache):
+        """Cache the outputs of the frozen pretrained encoder, which then always runs in eval mode (no dropout) to make them deterministic."""
+        self.feature_cache = feature_cache
+        self.train(self.training)
+
+    def train(self, mode=True):
+        super().train(mode)
+        if self.rde is not None and self.feature_cache is not None:
+            self.rde.eval()
+        return self
+
     def _encode_rde(self, batch, mask_extra=None):
         batch = {k: v for k, v in batch.items()}
         batch['chi_corrupt'] = batch['chi']
         batch['chi_masked_flag'] = batch['mut_flag']
         if mask_extra is not None:
             batch['mask_atoms'] = batch['mask_atoms'] * mask_extra[:, :, None]
+        check_frozen(self.rde)
         with torch.no_grad():
             return self.rde.encode(batch)
 
+    def _pretrained_features(self, batch, cache_tag=None):
+        def encode_fn(b):
+            x_pret = self._encode_rde(b)
+            return x_pret[0] if self.ckpt_type == 'ProbabilityDensityCloud' else x_pret
+
+        if self.feature_cache is None or cache_tag is None:  # no cache or the input is not a pure function of the entry
+            return encode_fn(batch)
+        return self.feature_cache(encode_fn, batch, cache_tag)
+
     def encode(self, batch, mode='wt'):
         mask_residue = batch['mask_atoms'][:, :, BBHeavyAtom.CA]
         chi = batch['chi'] * (1 - batch['mut_flag'].float())[:, :, None]
@@ -78,17 +93,16 @@ class DDG_PDC_Network(nn.Module):
             res_feat += batch['plm_wt'] if mode == 'wt' else batch['plm_mut']
 
         if self.rde is not None:
-            x_pret = self._encode_rde(batch)
-            if self.ckpt_type == 'ProbabilityDensityCloud':
-                x_pret = x_pret[0]
+            x_pret = self._pretrained_features(batch, cache_tag=mode)
             res_feat = self.single_fusion(torch.cat([res_feat, x_pret], dim=-1))
 
         res_feat = res_feat + self.mut_bias(batch['mut_flag'].long())
 
-        z = self.pair_encoder(aa=batch['aa'], res_nb=batch['res_nb'], chain_nb=batch['chain_nb'], pos_atoms=batch['pos_atoms'], mask_atoms=batch['mask_atoms'], )
+        nbr_idx = self.attn_encoder.get_neighbors(batch['pos_atoms'], batch['mask_atoms'])  # None for dense attention
+        z = self.pair_encoder(aa=batch['aa'], res_nb=batch['res_nb'], chain_nb=batch['chain_nb'], pos_atoms=batch['pos_atoms'], mask_atoms=batch['mask_atoms'], nbr_idx=nbr_idx)
         pos_atom = batch['pos_atoms']
 
-        res_feat = self.attn_encoder(pos_atoms=pos_atom, res_feat=res_feat, pair_feat=z, mask=mask_residue)
+        res_feat = self.attn_encoder(pos_atoms=pos_atom, res_feat=res_feat, pair_feat=z, mask=mask_residue, nbr_idx=nbr_idx)
 
         # Update coordinates
         if self.resolution != 'CA':
@@ -130,3 +144,22 @@ class DDG_PDC_Network(nn.Module):
         loss_dict['regression'] = loss
         out_dict = {'ddG_pred': ddg_pred.detach().clone(), 'ddG_true': batch['ddG'], }
         return loss_dict, out_dict
+
+    @torch.no_grad()
+    def scan(self, batch, aa_mut, wt_index):
+        """
+        ddG of many mutants of a few wild types, each wild type is encoded once.
+        Args:
+            batch:      Wild-type batch (N, L, ...), `mut_flag` marks the mutated positions.
+            aa_mut:     (M, L), mutant sequences.
+            wt_index:   (M, ), wild type of each mutant.
+        Returns:
+            (M, ) predicted ddG.
+        """
+        h_wt = self.encode(batch, 'wt')[0]
+        batch_mt = index_select_batch(batch, wt_index)
+        batch_mt['aa'] = aa_mut
+        h_mt = self.encode(batch_mt, 'mut')[0]
+
+        H_mt, H_wt = h_mt.max(dim=1)[0], h_wt.max(dim=1)[0][wt_index]
+        return self.ddg_readout(H_mt - H_wt).squeeze(-1)
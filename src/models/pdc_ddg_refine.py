@@ -2,16 +2,18 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from src.modules.encoders.egnn_attn import GAEncoder
+from src.modules.encoders.attn import get_ga_encoder
 from src.modules.encoders.pair import ResiduePairEncoder
 from src.modules.encoders.single import PerResidueEncoder
+from src.models.pretrained import check_frozen, load_pretrained
 from src.utils.protein.constants import BBHeavyAtom, HeavyAtom2int
-from .rde import CircularSplineRotamerDensityEstimator
-from src.models.rde_mlm import MaskedLanguageModelingDensityEstimator
-from src.models.pdc import ProbabilityDensityCloud
+from src.utils.data import index_select_batch
+from src.models.pdc import RecycleCounter, adaptive_recycle
 from src.modules.encoders.egnn import EGNN_Network
+from src.models._base import register_model
 
 
+@register_model('ddg_pdc_refine')
 class DDG_PDC_Network(nn.Module):
 
     def __init__(self, cfg, max_aa_types=22):
@@ -25,19 +27,11 @@ class DDG_PDC_Network(nn.Module):
 
         # Pretrain
         self.rde = None
+        self.feature_cache = None
         if cfg.checkpoint.path:
             self.ckpt_type = cfg.checkpoint.type
-            print(f'Loading {cfg.checkpoint.type} from {cfg.checkpoint.path}')
-            ckpt = torch.load(cfg.checkpoint.path, map_location='cpu')
-            if self.ckpt_type == 'CircularSplineRotamerDensityEstimator':
-                self.rde = CircularSplineRotamerDensityEstimator(ckpt['config'].model)
-            elif self.ckpt_type == 'MaskedLanguageModelingDensityEstimator':
-                self.rde = MaskedLanguageModelingDensityEstimator(ckpt['config'].model)
-            elif self.ckpt_type == 'ProbabilityDensityCloud':
-                self.rde = ProbabilityDensityCloud(ckpt['config'].model)
-            self.rde.load_state_dict(ckpt['model'])
-            for p in self.rde.parameters():
-                p.requires_grad_(False)
+            encoder = {k: v for k, v in cfg.encoder.items() if k in ('attention', 'attention_neighbors')} if self.ckpt_type == 'ProbabilityDensityCloud' else None  # same weights
+            self.rde = load_pretrained(self.ckpt_type, cfg.checkpoint.path, encoder=encoder)  # shared by the models built from the same checkpoint
             self.single_fusion = nn.Sequential(nn.Linear(2 * dim, dim), nn.ReLU(), nn.Linear(dim, dim))
 
         # Encoding
@@ -46,48 +40,106 @@ class DDG_PDC_Network(nn.Module):
         self.pair_encoder = ResiduePairEncoder(feat_dim=cfg.encoder.pair_feat_dim, max_num_atoms=5,)  # N, CA, C, O, CB,
         if self.resolution != 'CA':
             self.token_emb = nn.Embedding(len(HeavyAtom2int) + 1, dim)  # 6 atom types
-        self.attn_encoder = GAEncoder(node_feat_dim=dim, pair_feat_dim=cfg.encoder.pair_feat_dim, num_layers=cfg.encoder.num_layers,)
+        self.attn_encoder = get_ga_encoder(cfg.encoder, node_feat_dim=dim)
 
         # Refinement module
+        self.mask_length = cfg.pos.mask_length
         if cfg.pos.mask_length > 0:
             self.recycle = cfg.pos.recycle
+            self.recycle_tol = cfg.pos.get('recycle_tol', None)  # adaptive early exit at inference, in Angstrom
             self.mask_wt = cfg.pos.mask_wt
+            self.noisy_input = True   # masked spans are perturbed by the dataset
             self.spatial_project = EGNN_Network(dim=dim, depth=cfg.encoder.refine_num_layers, num_nearest_neighbors=cfg.encoder.num_nearest_neighbors,
-                                                norm_coors=cfg.encoder.norm_coors, update_coors_mean=cfg.encoder.update_coors_mean, update_coors_var=cfg.encoder.update_coors_var, )
+                                                norm_coors=cfg.encoder.norm_coors, update_coors_mean=cfg.encoder.update_coors_mean, update_coors_var=cfg.encoder.update_coors_var,
+                                                knn_first=cfg.encoder.get('knn_first', False), checkpoint=cfg.encoder.get('checkpoint_egnn', False), subgraph_hops=cfg.encoder.get('refine_subgraph_hops', 0))
         else:
             self.recycle = 0
+            self.recycle_tol = None
             self.mask_wt = False
+            self.noisy_input = False
+
+        self.recycle_counter = RecycleCounter()
 
         # Pred
         self.ddg_readout = nn.Sequential(nn.Linear(dim, dim // 2), nn.ReLU(), nn.Linear(dim // 2, dim // 4), nn.ReLU(), nn.Linear(dim // 4, 1))
 
+    def set_feature_cache(self, feature_cache):
+        """Cache the outputs of the frozen pretrained encoder, which then always runs in eval mode (no dropout) to make them deterministic."""
+        self.feature_cache = feature_cache
+        self.train(self.training)
+
+    def train(self, mode=True):
+        super().train(mode)
+        if self.rde is not None and self.feature_cache is not None:
+            self.rde.eval()
+        return self
+
     def _encode_rde(self, batch, mask_extra=None):
         batch = {k: v for k, v in batch.items()}
         batch['chi_corrupt'] = batch['chi']
         batch['chi_masked_flag'] = batch['mut_flag']
         if mask_extra is not None:
             batch['mask_atoms'] = batch['mask_atoms'] * mask_extra[:, :, None]
+        check_frozen(self.rde)
         with torch.no_grad():
             return self.rde.encode(batch)
 
-    def encode(self, batch, mode):
+    def _pretrained_features(self, batch, cache_tag=None):
+        def encode_fn(b):
+            x_pret = self._encode_rde(b)
+            return x_pret[0] if self.ckpt_type == 'ProbabilityDensityCloud' else x_pret
+
+        if self.feature_cache is None or cache_tag is None:  # no cache or the input is not a pure function of the entry
+            return encode_fn(batch)
+        return self.feature_cache(encode_fn, batch, cache_tag)
+
+    def encode_pair(self, batch, state=None):
+        nbr_idx = self.attn_encoder.get_neighbors(batch['pos_atoms'], batch['mask_atoms'])  # None for dense attention
+        pair_args = dict(aa=batch['aa'], res_nb=batch['res_nb'], chain_nb=batch['chain_nb'], pos_atoms=batch['pos_atoms'], mask_atoms=batch['mask_atoms'], nbr_idx=nbr_idx)
+        z = self.pair_encoder(**pair_args) if state is None else self.pair_encoder.forward_incremental(state, **pair_args)
+        return nbr_idx, z
+
+    def encode_pair_shared(self, batch_wt, batch_mt, wt_index=None):
+        """
+        Pair features of the wild type and mutant on the same structure: geometry is computed once, the mutant is patched on the mutated rows and columns.
+        `wt_index` (M, ) maps each mutant to its wild type when the batches differ in size.
+        """
+        nbr_idx = self.attn_encoder.get_neighbors(batch_wt['pos_atoms'], batch_wt['mask_atoms'])
+        geometry = self.pair_encoder.encode_geometry(res_nb=batch_wt['res_nb'], chain_nb=batch_wt['chain_nb'], pos_atoms=batch_wt['pos_atoms'], mask_atoms=batch_wt['mask_atoms'],
+                                                     nbr_idx=nbr_idx)
+        z_wt = self.pair_encoder.encode_identity(batch_wt['aa'], geometry)
+        if wt_index is None:
+            z_mt = self.pair_encoder.patch_identity(z_wt, batch_mt['aa'], batch_wt['aa'], geometry)
+            return (nbr_idx, z_wt), (nbr_idx, z_mt)
+
+        geometry = {k: v[wt_index] if v is not None else None for k, v in geometry.items()}
+        z_mt = self.pair_encoder.patch_identity(z_wt[wt_index], batch_mt['aa'], batch_wt['aa'][wt_index], geometry)
+        return (nbr_idx, z_wt), (geometry['nbr_idx'], z_mt)
+
+    def encode(self, batch, mode, pair=None, cache_tag=None, state=None):
+        """
+        Args:
+            state:  Dict shared by the refinement recycles of one batch (only the coordinates change between them), to reuse the single features and unchanged pair features.
+        """
         mask_residue = batch['mask_atoms'][:, :, BBHeavyAtom.CA]
         chi = batch['chi'] * (1 - batch['mut_flag'].float())[:, :, None]
 
-        res_feat = self.single_encoder(aa=batch['aa'], phi=batch['phi'], phi_mask=batch['phi_mask'], psi=batch['psi'], psi_mask=batch['psi_mask'], chi=chi,
-                                       chi_mask=batch['chi_mask'], mask_residue=mask_residue, )  # (N, L, F)
-        if self.use_plm:
-            res_feat += batch['plm_wt'] if mode == 'wt' else batch['plm_mut']
+        res_feat = state.get('single_feat', None) if state is not None else None
+        if res_feat is None:
+            res_feat = self.single_encoder(aa=batch['aa'], phi=batch['phi'], phi_mask=batch['phi_mask'], psi=batch['psi'], psi_mask=batch['psi_mask'], chi=chi,
+                                           chi_mask=batch['chi_mask'], mask_residue=mask_residue, )  # (N, L, F)
+            if self.use_plm:
+                res_feat += batch['plm_wt'] if mode == 'wt' else batch['plm_mut']
+            if state is not None:
+                state['single_feat'] = res_feat
 
         if self.rde is not None:
-            x_pret = self._encode_rde(batch)
-            if self.ckpt_type == 'ProbabilityDensityCloud':
-                x_pret = x_pret[0]
+            x_pret = self._pretrained_features(batch, cache_tag=cache_tag)
             res_feat = self.single_fusion(torch.cat([res_feat, x_pret], dim=-1))
 
         res_feat = res_feat + self.mut_bias(batch['mut_flag'].long())
-        z = self.pair_encoder(aa=batch['aa'], res_nb=batch['res_nb'], chain_nb=batch['chain_nb'], pos_atoms=batch['pos_atoms'], mask_atoms=batch['mask_atoms'], )
-        res_feat = self.attn_encoder(pos_atoms=batch['pos_atoms'], res_feat=res_feat, pair_feat=z, mask=mask_residue)
+        nbr_idx, z = self.encode_pair(batch, state) if pair is None else pair
+        res_feat = self.attn_encoder(pos_atoms=batch['pos_atoms'], res_feat=res_feat, pair_feat=z, mask=mask_residue, nbr_idx=nbr_idx)
         return res_feat
 
     def refine(self, res_feat, pos_change_flag, batch):
@@ -112,6 +164,49 @@ class DDG_PDC_Network(nn.Module):
         coors_out = self.spatial_project(coors_mean=pos_atom, coors_var=pos_atom_var, feats=res_feat, mask=mask, pos_change_flag=pos_change_flag)[1]
         return coors_out
 
+    def _use_adaptive_recycle(self):
+        return self.recycle_tol is not None and not self.training
+
+    def recycle_adaptive(self, batch, pos_change_flag, mode):
+        """Refined coordinates, shaped as `batch['pos_atoms']`, after at most `recycle` passes. Every sample stops once its update is below `recycle_tol`."""
+        pos_atoms, num_recycles = adaptive_recycle(lambda b, f, state: self.refine(self.encode(b, mode, state=state), f, b), batch, pos_change_flag, self.recycle, self.recycle_tol)
+        self.recycle_counter.add(num_recycles)
+        return pos_atoms
+
+    def refine_span(self, batch):
+        """
+        (N, L) residues refined around the mutations: `batch['pos_change_flag']` when the dataset built it, otherwise (inference inputs) the span of
+        `mask_length` residues centered on each mutated residue, within its chain, as `SkempiABbindDataset` builds it (which also never refines the
+        first residue of the structure). Every mutation of a multi-point mutant is refined, the dataset draws one of them.
+        """
+        if 'pos_change_flag' in batch:
+            return batch['pos_change_flag']
+        chain_nb, res_nb = batch['chain_nb'], batch['res_nb']
+        near = (chain_nb[:, :, None] == chain_nb[:, None, :]) & ((res_nb[:, :, None] - res_nb[:, None, :]).abs() <= self.mask_length // 2)
+        first = (chain_nb == 0) & (res_nb == 1)  # `res_nb` starts at 1 in each chain
+        return (near & batch['mut_flag'][:, None, :]).any(dim=-1) & ~first
+
+    def refine_mutant(self, batch_mt, pos_change_flag):
+        """Mutant coordinates after the refinement recycles, shaped as `batch_mt['pos_atoms']`. No gradient, the mutant has no ground truth."""
+        if self._use_adaptive_recycle():
+            return self.recycle_adaptive(batch_mt, pos_change_flag, 'mut')
+        batch_mt, state = {k: v for k, v in batch_mt.items()}, {}
+        for _ in range(self.recycle):
+            with torch.no_grad():   # no gradient
+                h_mt_0 = self.encode(batch_mt, 'mut', state=state)
+                c_mt = self.refine(h_mt_0, pos_change_flag, batch_mt)
+                batch_mt['pos_atoms'] = c_mt.detach().clone().reshape(batch_mt['pos_atoms'].shape)
+        return batch_mt['pos_atoms']
+
+    def encode_wt_mt(self, batch_wt, batch_mt):
+        """Residue features of the wild type (crystal structure) and of the mutant, pair geometry is shared when both have the same coordinates."""
+        pair_wt, pair_mt = None, None
+        if torch.equal(batch_wt['pos_atoms'], batch_mt['pos_atoms']):  # same structure, share the geometric pair features
+            pair_wt, pair_mt = self.encode_pair_shared(batch_wt, batch_mt)
+        h_wt = self.encode(batch_wt, 'wt', pair=pair_wt, cache_tag='wt' if self.recycle > 0 or not self.noisy_input else None)  # crystal structure
+        h_mt = self.encode(batch_mt, 'mut', pair=pair_mt, cache_tag='mut' if not self.noisy_input else None)
+        return h_wt, h_mt
+
     def forward(self, batch, return_pos=False):
         batch_wt = {k: v for k, v in batch.items()}
         batch_mt = {k: v for k, v in batch.items()}
@@ -128,28 +223,28 @@ class DDG_PDC_Network(nn.Module):
                 pos_change_flag = batch['pos_change_flag']
                 pos_gt = batch['pos_gt'][:, :, BBHeavyAtom.CA][pos_change_flag]
 
-            for _ in range(self.recycle):
-                h_wt_0 = self.encode(batch_wt, 'wt')
-                c_wt = self.refine(h_wt_0, pos_change_flag, batch_wt)
-                loss_coors.append(torch.sqrt(((pos_gt - c_wt[pos_change_flag]) ** 2).sum(dim=-1) + 1e-10).mean())   # loss for each iteration
-                batch_wt['pos_atoms'] = c_wt.detach().clone().reshape(batch_wt['pos_atoms'].shape)
+            if self._use_adaptive_recycle():
+                c_wt = self.recycle_adaptive(batch_wt, pos_change_flag, 'wt').reshape(*pos_change_flag.shape, 3)
+                loss_coors.append(torch.sqrt(((pos_gt - c_wt[pos_change_flag]) ** 2).sum(dim=-1) + 1e-10).mean())   # loss of the last iteration
+            else:
+                state = {}
+                for _ in range(self.recycle):
+                    h_wt_0 = self.encode(batch_wt, 'wt', state=state)
+                    c_wt = self.refine(h_wt_0, pos_change_flag, batch_wt)
+                    loss_coors.append(torch.sqrt(((pos_gt - c_wt[pos_change_flag]) ** 2).sum(dim=-1) + 1e-10).mean())   # loss for each iteration
+                    batch_wt['pos_atoms'] = c_wt.detach().clone().reshape(batch_wt['pos_atoms'].shape)
 
             batch_wt['pos_atoms'] = batch['pos_gt'].clone()                            # use crystal structures (given)
 
         loss_dict = {'pos_refine': torch.stack(loss_coors).sum() if len(loss_coors) > 0 else torch.tensor(0.0)}
-        h_wt = self.encode(batch_wt, 'wt')
 
         ###############################################
         ## mutation type
         ###############################################
         batch_mt['aa'] = batch_mt['aa_mut']
-        if self.mask_wt:
-            for _ in range(self.recycle):
-                with torch.no_grad():   # no gradient
-                    h_mt_0 = self.encode(batch_mt, 'mut')
-                    c_mt = self.refine(h_mt_0, pos_change_flag, batch_mt)
-                    batch_mt['pos_atoms'] = c_mt.detach().clone().reshape(batch_mt['pos_atoms'].shape)
-        h_mt = self.encode(batch_mt, 'mut')
+        if self.mask_wt and self.recycle > 0:
+            batch_mt['pos_atoms'] = self.refine_mutant(batch_mt, pos_change_flag)
+        h_wt, h_mt = self.encode_wt_mt(batch_wt, batch_mt)
 
         ###############################################
         ## ddG
@@ -167,3 +262,51 @@ class DDG_PDC_Network(nn.Module):
                              'aa_mut': batch_mt['aa'], 'resseq': batch['resseq'], 'chain_nb': batch['chain_nb']})
 
         return loss_dict, out_dict
+
+    @torch.no_grad()
+    def predict(self, batch):
+        """
+        (N, ) predicted ddG, same as `forward` without the losses. The wild-type refinement only contributes to the `pos_refine` loss and is skipped.
+        No ground truth is needed: without `pos_gt` the input structure is the wild type, without `pos_change_flag` the refined span is built from `mut_flag`.
+        """
+        batch_wt = {k: v for k, v in batch.items()}
+        batch_mt = {k: v for k, v in batch.items()}
+        if self.recycle > 0 and 'pos_gt' in batch:
+            batch_wt['pos_atoms'] = batch['pos_gt']
+        batch_mt['aa'] = batch_mt['aa_mut']
+        if self.mask_wt and self.recycle > 0:
+            pos_change_flag = self.refine_span(batch)
+            if self.resolution != 'CA':
+                pos_change_flag = pos_change_flag.repeat(1, batch['pos_atoms'].shape[-2])
+            batch_mt['pos_atoms'] = self.refine_mutant(batch_mt, pos_change_flag)
+        h_wt, h_mt = self.encode_wt_mt(batch_wt, batch_mt)
+        return self.ddg_readout(h_mt.max(dim=1)[0] - h_wt.max(dim=1)[0]).squeeze(-1)
+
+    @torch.no_grad()
+    def scan(self, batch, aa_mut, wt_index):
+        """
+        ddG of many mutants of a few wild types, each wild type is encoded once.
+        Args:
+            batch:      Wild-type batch (N, L, ...), `mut_flag` marks the mutated positions.
+            aa_mut:     (M, L), mutant sequences.
+            wt_index:   (M, ), wild type of each mutant.
+        Returns:
+            (M, ) predicted ddG.
+        """
+        batch_wt = {k: v for k, v in batch.items()}
+        batch_mt = index_select_batch(batch, wt_index)
+        batch_mt['aa'] = aa_mut
+        if self.mask_wt and self.recycle > 0:
+            pos_change_flag = self.refine_span(batch_mt)
+            if self.resolution != 'CA':
+                pos_change_flag = pos_change_flag.repeat(1, batch_mt['pos_atoms'].shape[-2])
+            batch_mt['pos_atoms'] = self.refine_mutant(batch_mt, pos_change_flag)
+
+        pair_wt, pair_mt = None, None
+        if torch.equal(batch_wt['pos_atoms'][wt_index], batch_mt['pos_atoms']):
+            pair_wt, pair_mt = self.encode_pair_shared(batch_wt, batch_mt, wt_index=wt_index)
+        h_wt = self.encode(batch_wt, 'wt', pair=pair_wt, cache_tag='wt')
+        h_mt = self.encode(batch_mt, 'mut', pair=pair_mt, cache_tag='mut' if not self.mask_wt else None)
+
+        H_mt, H_wt = h_mt.max(dim=1)[0], h_wt.max(dim=1)[0][wt_index]
+        return self.ddg_readout(H_mt - H_wt).squeeze(-1)
@@ -0,0 +1,66 @@
+import os
+
+import torch
+
+from .rde import CircularSplineRotamerDensityEstimator
+from src.models.rde_mlm import MaskedLanguageModelingDensityEstimator
+from src.models.pdc import ProbabilityDensityCloud
+
+_PRETRAINED = {}
+
+
+def _load_checkpoint(path):
+    """Memory-maps the tensors of zipfile checkpoints (torch >= 2.1), their pages are only read when used and shared through the page cache."""
+    try:
+        return torch.load(path, map_location='cpu', mmap=True), True
+    except (RuntimeError, TypeError):  # legacy serialization format or older torch
+        return torch.load(path, map_location='cpu'), False
+
+
+def _check_load(module, state_dict, prefix, *args):
+    """Fold models still store and load their own copy of the frozen weights, they must be the weights of the shared module."""
+    current = {**dict(module.named_parameters()), **dict(module.named_buffers())}
+    for name, v in current.items():
+        if prefix + name in state_dict and not torch.equal(state_dict[prefix + name].to(v.device), v):
+            raise RuntimeError('Loading %s%s would modify the shared pretrained model, the checkpoint was trained with different pretrained weights' % (prefix, name))
+
+
+def check_frozen(module):
+    if any(p.requires_grad for p in module.parameters()):
+        raise RuntimeError('The shared pretrained model must stay frozen, it is used by every model loaded from the same checkpoint')
+
+
+def load_pretrained(ckpt_type, path, encoder=None):
+    """
+    Frozen pretrained model of a checkpoint, loaded once per process. Every model built from the same checkpoint (e.g. the folds of `CrossValidation`)
+    shares the returned instance, moving it to a device moves it for all of them.
+    Args:
+        ckpt_type:  Class name of the pretrained model.
+        path:       Checkpoint path.
+        encoder:    Dict, overrides of the encoder config that do not change the weights.
+    """
+    encoder = encoder or {}
+    key = (ckpt_type, os.path.realpath(path), os.path.getmtime(path), tuple(sorted((k, repr(v)) for k, v in encoder.items())))
+    if key not in _PRETRAINED:
+        print(f'Loading {ckpt_type} from {path}')
+        ckpt, mmap = _load_checkpoint(path)
+        config = ckpt['config'].model
+        if ckpt_type == 'CircularSplineRotamerDensityEstimator':
+            model = CircularSplineRotamerDensityEstimator(config)
+        elif ckpt_type == 'MaskedLanguageModelingDensityEstimator':
+            model = MaskedLanguageModelingDensityEstimator(config)
+        elif ckpt_type == 'ProbabilityDensityCloud':
+            config.encoder.update(encoder)
+            model = ProbabilityDensityCloud(config)
+        else:
+            raise NotImplementedError('Pretrained model not supported: %s' % ckpt_type)
+        model.load_state_dict(ckpt['model'], assign=mmap)  # the parameters keep the memory-mapped storages
+        for p in model.parameters():
+            p.requires_grad_(False)
+        model._register_load_state_dict_pre_hook(_check_load, with_module=True)
+        _PRETRAINED[key] = model
+    return _PRETRAINED[key]
+
+
+def clear_pretrained():
+    _PRETRAINED.clear()
@@ -11,6 +11,7 @@ from src.modules.flows.spline import ContextualCircularSplineFlow
 from src.modules.flows.coupling import ContextualCircularSplineCouplingLayer
 from src.modules.flows.container import ContextualSequentialFlow
 from src.utils.protein.constants import BBHeavyAtom, num_aa_types, chi_angles_atoms
+from src.models._base import register_model
 
 
 def _latent_log_prob(z, num_chis):
@@ -47,6 +48,7 @@ def _build_flow(num_chis, n_context_dims, cfg_flow):
     return sequential_flow
 
 
+@register_model('rde')
 class CircularSplineRotamerDensityEstimator(nn.Module):
 
     def __init__(self, cfg):
@@ -98,58 +100,114 @@ class CircularSplineRotamerDensityEstimator(nn.Module):
         return loss_dict
 
     def forward(self, batch):
+        """
+        Each flow only runs on the residues with its number of chi angles, the other residues get zero latents and log-probabilities (excluded from the loss).
+        Returns:
+            [(N, L, 1), ..., (N, L, 4)] latents of the four flows.
+        """
         loss_dict = {}
         c = self.encode(batch)
+        n_chis_data = batch['chi_mask'].sum(-1)  # (N, L)
 
-        zs, logabsdets, logprobs = [], [], []
+        zs, logprobs = [], []
         for n_chis in range(1, 4 + 1):
-            z, logabsdet = self.flows[n_chis - 1](batch['chi_native'][:, :, :n_chis], c, inverse=False)
-            logp = _latent_log_prob(z, n_chis) + logabsdet
+            bucket = n_chis_data == n_chis  # (N, L)
+            z = torch.zeros(list(bucket.shape) + [n_chis], device=c.device)
+            logp = torch.zeros(bucket.shape, device=c.device)
+            if bucket.any():
+                z_bucket, logabsdet = self.flows[n_chis - 1](batch['chi_native'][:, :, :n_chis][bucket], c[bucket], inverse=False)
+                z, logp = z.index_put((bucket, ), z_bucket), logp.index_put((bucket, ), _latent_log_prob(z_bucket, n_chis) + logabsdet)
             zs.append(z)
-            logabsdets.append(logabsdet)
             logprobs.append(logp)
         loss_dict.update(self._mle_loss(batch, logprobs))
 
         return zs
 
-    def sample(self, batch, n_samples=1, residue_subset=None):
-        c = self.encode(batch)
+    def _sample_flows(self, c, n_chis, n_samples):
+        """
+        Args:
+            c:      (M, d) residue contexts.
+            n_chis: (M, ) number of chi angles of each residue, each flow only runs on its residues.
+        Returns:
+            (n_samples, M, 4) angles padded with zeros and (n_samples, M) log-probabilities, zero for residues without chi angles.
+        """
+        xs = torch.zeros([n_samples, c.size(0), 4], device=c.device)
+        logprobs = torch.zeros([n_samples, c.size(0)], device=c.device)
+        for k in range(1, 4 + 1):
+            index = torch.nonzero(n_chis == k)[:, 0]
+            if index.numel() == 0: continue
+            c_k = c[index].unsqueeze(0).expand(n_samples, -1, -1)  # (n_samples, M_k, d)
+            z = sample_latent(c_k.shape[:-1], k, device=c.device)
+            x, logabsdet = self.flows[k - 1](z, c_k, inverse=True)  # (n_samples, M_k, k), (n_samples, M_k)
+            xs[:, index, :k] = x
+            logprobs[:, index] = _latent_log_prob(z, k) + logabsdet
+        return xs, logprobs
 
+    def sample_chunks(self, batch, n_samples=1, residue_subset=None, chunk_size=None):
+        """
+        Yields the samples of `sample` in chunks of at most `chunk_size` samples, (s, N, L, 4) and (s, N, L), so that the flow activations stay bounded.
+        The encoder runs once for all chunks.
+        """
+        c = self.encode(batch)
+        aa = batch['aa']
         if residue_subset is not None:
-            c = c[:, residue_subset, :]
-
-        if n_samples > 1:
-            c_shape = [n_samples] + list(c.shape)  # (n_samples, N, L, d)
-            c = c.unsqueeze(0).expand(c_shape)
-
-        zs = [sample_latent(c.shape[:-1], n_chis, device=c.device) for n_chis in range(1, 4 + 1)]  # [(N, L, 1), ..., (N, L, 4)]
-        logpzs = [_latent_log_prob(zs[n_chis - 1], n_chis) for n_chis in range(1, 4 + 1)]
-
-        xs, logprobs = [], []
-        for n_chis in range(1, 4 + 1):
-            x, logabsdet = self.flows[n_chis - 1](zs[n_chis - 1], c, inverse=True)  # (N, L, n_chis), (N, L)
-            x = F.pad(x, pad=(0, 4 - n_chis), value=0)  # (N, L, 4)
-            logpx = logpzs[n_chis - 1] + logabsdet  # (N, L)
-            xs.append(x)
-            logprobs.append(logpx)
-
-        xs = F.pad(torch.stack(xs, dim=-1), pad=(1, 0), value=0)  # (N, L, 4, 5)
-        logprobs = F.pad(torch.stack(logprobs, dim=-1), pad=(1, 0), value=0)  # (N, L, 5)
-
-        n_chis_all = self.num_chis_of_aa[batch['aa'].flatten()].reshape_as(batch['aa'])  # (N, L)
-        xs = torch.gather(xs, dim=-1, index=n_chis_all[:, :, None, None].expand_as(xs))[..., 0]  # (N, L, 4)
-        logprobs = torch.gather(logprobs, dim=-1, index=n_chis_all[:, :, None].expand_as(logprobs))[..., 0]  # (N, L)
-
+            c, aa = c[:, residue_subset, :], aa[:, residue_subset]
+        N, L = aa.shape
+        n_chis_all = self.num_chis_of_aa[aa.flatten()]  # (N * L, )
+        c = c.reshape(N * L, -1)
+
+        chunk_size = chunk_size or n_samples
+        for start in range(0, n_samples, chunk_size):
+            s = min(chunk_size, n_samples - start)
+            xs, logprobs = self._sample_flows(c, n_chis_all, s)
+            yield xs.reshape(s, N, L, 4), logprobs.reshape(s, N, L)
+
+    def sample(self, batch, n_samples=1, residue_subset=None, chunk_size=None):
+        """
+        Returns:
+            Chi angles (n_samples, N, L, 4) and their log-probabilities (n_samples, N, L), without the sample dimension if `n_samples` is 1.
+        """
+        chunks = list(self.sample_chunks(batch, n_samples=n_samples, residue_subset=residue_subset, chunk_size=chunk_size))
+        xs, logprobs = torch.cat([x for x, _ in chunks], dim=0), torch.cat([lp for _, lp in chunks], dim=0)
+        if n_samples == 1:
+            return xs[0], logprobs[0]
         return xs, logprobs
 
-    def pack(self, batch, n_samples=100):
-        xs, logprobs = self.sample(batch, n_samples=n_samples)  # (s, N, L, 4), (s, N, L)
-        logprobs_max, smp_idx = logprobs.max(dim=0)  # (N, L)
-        smp_idx = smp_idx[None, :, :, None].repeat(1, 1, 1, 4)  # (1, N, L, 4)
-        xs = torch.gather(xs, dim=0, index=smp_idx).squeeze(0)
-        return xs, logprobs_max
-
-    def entropy(self, batch, n_samples=200):
-        _, logprobs = self.sample(batch, n_samples=n_samples)
-        entropy = -logprobs.mean(dim=0)  # (B, L)
-        return entropy
+    def sample_statistics(self, batch, n_samples=200, residue_mask=None, chunk_size=32):
+        """
+        Streaming Monte-Carlo estimates: samples are drawn `chunk_size` at a time and reduced online, memory does not grow with `n_samples`.
+        Args:
+            residue_mask:   (N, L), only sample these residues (e.g. the interface). The others get zero entropy and angles.
+        Returns:
+            Dict of the entropy (N, L), the most likely sampled chi angles `chi` (N, L, 4) and their log-probability `logprob` (N, L).
+        """
+        c = self.encode(batch)
+        if residue_mask is None:
+            residue_mask = torch.ones_like(batch['aa'], dtype=torch.bool)
+        c, n_chis = c[residue_mask], self.num_chis_of_aa[batch['aa'][residue_mask]]  # (M, d), (M, )
+        M = c.size(0)
+
+        logprob_sum = torch.zeros([M], device=c.device)
+        logprob_max = torch.full([M], -float('inf'), device=c.device)
+        chi_max = torch.zeros([M, 4], device=c.device)
+        for start in range(0, n_samples, chunk_size):
+            xs, logprobs = self._sample_flows(c, n_chis, min(chunk_size, n_samples - start))  # (s, M, 4), (s, M)
+            logprob_sum = logprob_sum + logprobs.sum(dim=0)
+            logprobs_chunk, smp_idx = logprobs.max(dim=0)  # (M, )
+            better = logprobs_chunk > logprob_max  # ties keep the earlier sample, same as `max` over all samples
+            chi_max = torch.where(better[:, None], xs[smp_idx, torch.arange(M, device=c.device)], chi_max)
+            logprob_max = torch.where(better, logprobs_chunk, logprob_max)
+
+        N, L = batch['aa'].shape
+        out = {'entropy': torch.zeros([N, L], device=c.device), 'chi': torch.zeros([N, L, 4], device=c.device), 'logprob': torch.zeros([N, L], device=c.device)}
+        out['entropy'][residue_mask] = -logprob_sum / n_samples
+        out['chi'][residue_mask] = chi_max
+        out['logprob'][residue_mask] = logprob_max
+        return out
+
+    def pack(self, batch, n_samples=100, residue_mask=None, chunk_size=32):
+        out = self.sample_statistics(batch, n_samples=n_samples, residue_mask=residue_mask, chunk_size=chunk_size)
+        return out['chi'], out['logprob']  # (N, L, 4), (N, L)
+
+    def entropy(self, batch, n_samples=200, residue_mask=None, chunk_size=32):
+        return self.sample_statistics(batch, n_samples=n_samples, residue_mask=residue_mask, chunk_size=chunk_size)['entropy']  # (B, L)
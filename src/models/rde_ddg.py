@@ -5,12 +5,13 @@ import torch.nn.functional as F
 from src.modules.encoders.single import PerResidueEncoder
 from src.modules.encoders.pair import ResiduePairEncoder
 from src.modules.encoders.attn import GAEncoder
+from src.models.pretrained import check_frozen, load_pretrained
 from src.utils.protein.constants import BBHeavyAtom
-from .rde import CircularSplineRotamerDensityEstimator
-from src.models.rde_mlm import MaskedLanguageModelingDensityEstimator
-from src.models.pdc import ProbabilityDensityCloud
+from src.utils.data import index_select_batch
+from src.models._base import register_model
 
 
+@register_model('ddg_rde')
 class DDG_RDE_Network(nn.Module):
 
     def __init__(self, cfg):
@@ -18,19 +19,10 @@ class DDG_RDE_Network(nn.Module):
         dim = cfg.encoder.node_feat_dim
 
         # Pretrain
+        self.feature_cache = None
         if cfg.checkpoint.path:
             self.ckpt_type = cfg.checkpoint.type
-            print(f'Loading {cfg.checkpoint.type} from {cfg.checkpoint.path}')
-            ckpt = torch.load(cfg.checkpoint.path, map_location='cpu')
-            if self.ckpt_type == 'CircularSplineRotamerDensityEstimator':
-                self.rde = CircularSplineRotamerDensityEstimator(ckpt['config'].model)
-            elif self.ckpt_type == 'MaskedLanguageModelingDensityEstimator':
-                self.rde = MaskedLanguageModelingDensityEstimator(ckpt['config'].model)
-            elif self.ckpt_type == 'ProbabilityDensityCloud':
-                self.rde = ProbabilityDensityCloud(ckpt['config'].model)
-            self.rde.load_state_dict(ckpt['model'])
-            for p in self.rde.parameters():
-                p.requires_grad_(False)
+            self.rde = load_pretrained(self.ckpt_type, cfg.checkpoint.path)  # shared by the models built from the same checkpoint
 
             self.single_fusion = nn.Sequential(nn.Linear(2 * dim, dim), nn.ReLU(), nn.Linear(dim, dim))
         else:
@@ -45,25 +37,44 @@ class DDG_RDE_Network(nn.Module):
         # Pred
         self.ddg_readout = nn.Sequential(nn.Linear(dim, dim), nn.ReLU(), nn.Linear(dim, dim), nn.ReLU(), nn.Linear(dim, 1))
 
+    def set_feature_cache(self, feature_cache):
+        """Cache the outputs of the frozen pretrained encoder, which then always runs in eval mode (no dropout) to make them deterministic."""
+        self.feature_cache = feature_cache
+        self.train(self.training)
+
+    def train(self, mode=True):
+        super().train(mode)
+        if self.rde is not None and self.feature_cache is not None:
+            self.rde.eval()
+        return self
+
     def _encode_rde(self, batch, mask_extra=None):
         batch = {k: v for k, v in batch.items()}
         batch['chi_corrupt'] = batch['chi']
         batch['chi_masked_flag'] = batch['mut_flag']
         if mask_extra is not None:
             batch['mask_atoms'] = batch['mask_atoms'] * mask_extra[:, :, None]
+        check_frozen(self.rde)
         with torch.no_grad():
             return self.rde.encode(batch)
 
-    def encode(self, batch):
+    def _pretrained_features(self, batch, cache_tag=None):
+        def encode_fn(b):
+            x_pret = self._encode_rde(b)
+            return x_pret[0] if self.ckpt_type == 'ProbabilityDensityCloud' else x_pret
+
+        if self.feature_cache is None or cache_tag is None:  # no cache or the input is not a pure function of the entry
+            return encode_fn(batch)
+        return self.feature_cache(encode_fn, batch, cache_tag)
+
+    def encode(self, batch, cache_tag=None):
         mask_residue = batch['mask_atoms'][:, :, BBHeavyAtom.CA]
         chi = batch['chi'] * (1 - batch['mut_flag'].float())[:, :, None]
 
         x_single = self.single_encoder(aa=batch['aa'], phi=batch['phi'], phi_mask=batch['phi_mask'], psi=batch['psi'], psi_mask=batch['psi_mask'], chi=chi,
                                        chi_mask=batch['chi_mask'], mask_residue=mask_residue, )
         if self.rde is not None:
-            x_pret = self._encode_rde(batch)
-            if self.ckpt_type == 'ProbabilityDensityCloud':
-                x_pret = x_pret[0]
+            x_pret = self._pretrained_features(batch, cache_tag=cache_tag)
             x_single = self.single_fusion(torch.cat([x_single, x_pret], dim=-1))
 
         b = self.mut_bias(batch['mut_flag'].long())
@@ -79,8 +90,8 @@ class DDG_RDE_Network(nn.Module):
         batch_mt = {k: v for k, v in batch.items()}
         batch_mt['aa'] = batch_mt['aa_mut']
 
-        h_wt = self.encode(batch_wt)
-        h_mt = self.encode(batch_mt)
+        h_wt = self.encode(batch_wt, cache_tag='wt')
+        h_mt = self.encode(batch_mt, cache_tag='mut')
 
         H_mt, H_wt = h_mt.max(dim=1)[0], h_wt.max(dim=1)[0]
         ddg_pred = self.ddg_readout(H_mt - H_wt).squeeze(-1)
@@ -90,3 +101,22 @@ class DDG_RDE_Network(nn.Module):
         loss_dict = {'regression': loss, }
         out_dict = {'ddG_pred': ddg_pred, 'ddG_true': batch['ddG'], }
         return loss_dict, out_dict
+
+    @torch.no_grad()
+    def scan(self, batch, aa_mut, wt_index):
+        """
+        ddG of many mutants of a few wild types, each wild type is encoded once.
+        Args:
+            batch:      Wild-type batch (N, L, ...), `mut_flag` marks the mutated positions.
+            aa_mut:     (M, L), mutant sequences.
+            wt_index:   (M, ), wild type of each mutant.
+        Returns:
+            (M, ) predicted ddG.
+        """
+        h_wt = self.encode(batch, cache_tag='wt')
+        batch_mt = index_select_batch(batch, wt_index)
+        batch_mt['aa'] = aa_mut
+        h_mt = self.encode(batch_mt, cache_tag='mut')
+
+        H_mt, H_wt = h_mt.max(dim=1)[0], h_wt.max(dim=1)[0][wt_index]
+        return self.ddg_readout(H_mt - H_wt).squeeze(-1)
@@ -5,12 +5,12 @@ import torch.nn.functional as F
 from src.modules.encoders.single import PerResidueEncoder
 from src.modules.encoders.pair import ResiduePairEncoder
 from src.modules.encoders.attn import GAEncoder
+from src.models.pretrained import check_frozen, load_pretrained
 from src.utils.protein.constants import BBHeavyAtom
-from .rde import CircularSplineRotamerDensityEstimator
-from src.models.rde_mlm import MaskedLanguageModelingDensityEstimator
-from src.models.pdc import ProbabilityDensityCloud
+from src.models._base import register_model
 
 
+@register_model('dg_rde')
 class DG_RDE_Network(nn.Module):
 
     def __init__(self, cfg):
@@ -18,19 +18,10 @@ class DG_RDE_Network(nn.Module):
         dim = cfg.encoder.node_feat_dim
 
         # Pretrain
+        self.feature_cache = None
         if cfg.checkpoint.path:
             self.ckpt_type = cfg.checkpoint.type
-            print(f'Loading {cfg.checkpoint.type} from {cfg.checkpoint.path}')
-            ckpt = torch.load(cfg.checkpoint.path, map_location='cpu')
-            if self.ckpt_type == 'CircularSplineRotamerDensityEstimator':
-                self.rde = CircularSplineRotamerDensityEstimator(ckpt['config'].model)
-            elif self.ckpt_type == 'MaskedLanguageModelingDensityEstimator':
-                self.rde = MaskedLanguageModelingDensityEstimator(ckpt['config'].model)
-            elif self.ckpt_type == 'ProbabilityDensityCloud':
-                self.rde = ProbabilityDensityCloud(ckpt['config'].model)
-            self.rde.load_state_dict(ckpt['model'])
-            for p in self.rde.parameters():
-                p.requires_grad_(False)
+            self.rde = load_pretrained(self.ckpt_type, cfg.checkpoint.path)  # shared by the models built from the same checkpoint
 
             self.single_fusion = nn.Sequential(nn.Linear(2 * dim, dim), nn.ReLU(), nn.Linear(dim, dim))
         else:
@@ -44,24 +35,43 @@ class DG_RDE_Network(nn.Module):
         # Pred
         self.dg_readout = nn.Sequential(nn.Linear(dim, dim), nn.ReLU(), nn.Linear(dim, dim), nn.ReLU(), nn.Linear(dim, 1))
 
+    def set_feature_cache(self, feature_cache):
+        """Cache the outputs of the frozen pretrained encoder, which then always runs in eval mode (no dropout) to make them deterministic."""
+        self.feature_cache = feature_cache
+        self.train(self.training)
+
+    def train(self, mode=True):
+        super().train(mode)
+        if self.rde is not None and self.feature_cache is not None:
+            self.rde.eval()
+        return self
+
     def _encode_rde(self, batch, mask_extra=None):
         batch = {k: v for k, v in batch.items()}
         batch['chi_corrupt'] = batch['chi']
         batch['chi_masked_flag'] = torch.zeros(size=batch['aa'].shape, dtype=torch.bool).cuda()   # no mutation and mask
         if mask_extra is not None:
             batch['mask_atoms'] = batch['mask_atoms'] * mask_extra[:, :, None]
+        check_frozen(self.rde)
         with torch.no_grad():
             return self.rde.encode(batch)
 
-    def encode(self, batch):
+    def _pretrained_features(self, batch, cache_tag=None):
+        def encode_fn(b):
+            x_pret = self._encode_rde(b)
+            return x_pret[0] if self.ckpt_type == 'ProbabilityDensityCloud' else x_pret
+
+        if self.feature_cache is None or cache_tag is None:  # no cache or the input is not a pure function of the entry
+            return encode_fn(batch)
+        return self.feature_cache(encode_fn, batch, cache_tag)
+
+    def encode(self, batch, cache_tag=None):
         mask_residue = batch['mask_atoms'][:, :, BBHeavyAtom.CA]
 
         x = self.single_encoder(aa=batch['aa'], phi=batch['phi'], phi_mask=batch['phi_mask'], psi=batch['psi'], psi_mask=batch['psi_mask'], chi=batch['chi'],
                                 chi_mask=batch['chi_mask'], mask_residue=mask_residue, )
         if self.rde is not None:
-            x_pret = self._encode_rde(batch)
-            if self.ckpt_type == 'ProbabilityDensityCloud':
-                x_pret = x_pret[0]
+            x_pret = self._pretrained_features(batch, cache_tag=cache_tag)
             x = self.single_fusion(torch.cat([x, x_pret], dim=-1))
 
         z = self.pair_encoder(aa=batch['aa'], res_nb=batch['res_nb'], chain_nb=batch['chain_nb'], pos_atoms=batch['pos_atoms'], mask_atoms=batch['mask_atoms'], )
@@ -70,7 +80,7 @@ class DG_RDE_Network(nn.Module):
         return x
 
     def forward(self, batch):
-        h = self.encode(batch)
+        h = self.encode(batch, cache_tag='wt')
         H = h.max(dim=1)[0]
 
         dg_pred = self.dg_readout(H).squeeze(-1)
@@ -6,6 +6,7 @@ from src.modules.encoders.attn import GAEncoder
 from src.modules.encoders.pair import ResiduePairEncoder
 from src.modules.encoders.single import PerResidueEncoder
 from src.utils.protein.constants import BBHeavyAtom, num_aa_types, chi_angles_atoms
+from src.models._base import register_model
 
 
 def _latent_log_prob(z, num_chis):
@@ -16,6 +17,7 @@ def _latent_log_prob(z, num_chis):
     return torch.full(shape, logp, device=z.device, dtype=torch.float)
 
 
+@register_model('rde_mlm')
 class MaskedLanguageModelingDensityEstimator(nn.Module):
 
     def __init__(self, cfg):
@@ -1,3 +1,5 @@
+import functools
+
 import torch
 import torch.nn.functional as F
 
@@ -5,6 +7,17 @@ from src.utils.protein.constants import BBHeavyAtom
 from .topology import get_terminus_flag
 
 
+def full_precision(fn):
+    """Runs `fn` in float32 with autocast disabled. Absolute coordinates (~100 Angstrom) lose about 0.5 Angstrom when rounded to bfloat16."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        args = [a.float() if torch.is_tensor(a) and a.is_floating_point() else a for a in args]
+        kwargs = {k: v.float() if torch.is_tensor(v) and v.is_floating_point() else v for k, v in kwargs.items()}
+        with torch.autocast('cpu', enabled=False), torch.autocast('cuda', enabled=False):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
 def safe_norm(x, dim=-1, keepdim=False, eps=1e-8, sqrt=True):
     out = torch.clamp(torch.sum(torch.square(x), dim=dim, keepdim=keepdim), min=eps)
     return torch.sqrt(out) if sqrt else out
@@ -63,6 +76,7 @@ def construct_3d_basis(center, p1, p2):
     return mat
 
 
+@full_precision
 def local_to_global(R, t, p):
     """
     Description:
@@ -85,6 +99,7 @@ def local_to_global(R, t, p):
     return q
 
 
+@full_precision
 def global_to_local(R, t, q):
     """
     Description:
@@ -141,6 +156,41 @@ def knn_gather(idx, value):
     return torch.gather(value, dim=2, index=idx)
 
 
+def gather_neighbors(value, idx):
+    """
+    Args:
+        idx:    (B, N, K)
+        value:  (B, N, ...)
+    Returns:
+        (B, N, K, ...), without materializing the (B, N, N, ...) expansion of `knn_gather`.
+    """
+    B, N, K = idx.size()
+    rest = value.shape[2:]
+    idx_flat = idx.reshape(B, N * K, *([1] * len(rest))).expand(B, N * K, *rest)
+    return torch.gather(value, dim=1, index=idx_flat).reshape(B, N, K, *rest)
+
+
+def residue_knn(pos_atoms, mask_atoms, K):
+    """
+    Args:
+        pos_atoms:  (N, L, A, 3).
+        mask_atoms: (N, L, A).
+    Returns:
+        Indices of the K nearest residues (itself included) by CB distance (CA if no CB), (N, L, K).
+        Masked residues are ranked last.
+    """
+    L = pos_atoms.size(1)
+    pos_CA = pos_atoms[:, :, BBHeavyAtom.CA]
+    if pos_atoms.size(2) > BBHeavyAtom.CB:
+        pos_CB = torch.where(mask_atoms[:, :, BBHeavyAtom.CB, None], pos_atoms[:, :, BBHeavyAtom.CB], pos_CA)
+    else:
+        pos_CB = pos_CA
+    mask_residue = mask_atoms[:, :, BBHeavyAtom.CA]
+    d = torch.cdist(pos_CB, pos_CB)  # (N, L, L)
+    d = d.masked_fill(~mask_residue[:, None, :], float('inf'))
+    return d.topk(min(K, L), dim=-1, largest=False)[1]
+
+
 def knn_points(q, p, K):
     """
     Args:
@@ -195,21 +245,47 @@ def get_backbone_dihedral_angles(pos_atoms, chain_nb, res_nb, mask):
     return bb_dihedral, mask_bb_dihed
 
 
-def pairwise_dihedrals(pos_atoms):
+def pairwise_dihedrals(pos_atoms, nbr_idx=None):
     """
     Args:
         pos_atoms:  (N, L, A, 3).
+        nbr_idx:    (N, L, K), optional. Only compute angles between each residue and its neighbors.
     Returns:
-        Inter-residue Phi and Psi angles, (N, L, L, 2).
+        Inter-residue Phi and Psi angles, (N, L, L, 2) or (N, L, K, 2).
     """
     N, L = pos_atoms.shape[:2]
     pos_N = pos_atoms[:, :, BBHeavyAtom.N]  # (N, L, 3)
     pos_CA = pos_atoms[:, :, BBHeavyAtom.CA]
     pos_C = pos_atoms[:, :, BBHeavyAtom.C]
 
+    if nbr_idx is not None:
+        K = nbr_idx.size(-1)
+        pos_N_j, pos_CA_j, pos_C_j = [gather_neighbors(p, nbr_idx) for p in (pos_N, pos_CA, pos_C)]  # (N, L, K, 3)
+        ir_phi = dihedral_from_four_points(pos_C[:, :, None].expand(N, L, K, 3), pos_N_j, pos_CA_j, pos_C_j)
+        ir_psi = dihedral_from_four_points(pos_N[:, :, None].expand(N, L, K, 3), pos_CA[:, :, None].expand(N, L, K, 3), pos_C[:, :, None].expand(N, L, K, 3), pos_N_j)
+        return torch.stack([ir_phi, ir_psi], dim=-1)
+
     ir_phi = dihedral_from_four_points(pos_C[:, :, None].expand(N, L, L, 3), pos_N[:, None, :].expand(N, L, L, 3), pos_CA[:, None, :].expand(N, L, L, 3),
         pos_C[:, None, :].expand(N, L, L, 3))
     ir_psi = dihedral_from_four_points(pos_N[:, :, None].expand(N, L, L, 3), pos_CA[:, :, None].expand(N, L, L, 3), pos_C[:, :, None].expand(N, L, L, 3),
         pos_N[:, None, :].expand(N, L, L, 3))
     ir_dihed = torch.stack([ir_phi, ir_psi], dim=-1)
     return ir_dihed
+
+
+def dihedrals_between(pos_atoms_i, pos_atoms_j):
+    """
+    Same as `pairwise_dihedrals` for residues i and j given separately, e.g. a few rows or columns of the pair map.
+    Args:
+        pos_atoms_i:    (N, Li, A, 3).
+        pos_atoms_j:    (N, Li or 1, Lj, A, 3).
+    Returns:
+        (N, Li, Lj, 2).
+    """
+    N, Li, Lj = pos_atoms_i.size(0), pos_atoms_i.size(1), pos_atoms_j.size(2)
+    shape = (N, Li, Lj, 3)
+    pos_N, pos_CA, pos_C = [pos_atoms_i[:, :, None, a].expand(shape) for a in (BBHeavyAtom.N, BBHeavyAtom.CA, BBHeavyAtom.C)]
+    pos_N_j, pos_CA_j, pos_C_j = [pos_atoms_j[:, :, :, a].expand(shape) for a in (BBHeavyAtom.N, BBHeavyAtom.CA, BBHeavyAtom.C)]
+    ir_phi = dihedral_from_four_points(pos_C, pos_N_j, pos_CA_j, pos_C_j)
+    ir_psi = dihedral_from_four_points(pos_N, pos_CA, pos_C, pos_N_j)
+    return torch.stack([ir_phi, ir_psi], dim=-1)
@@ -136,6 +136,8 @@ class LayerNorm(nn.Module):
             self.beta.data.zero_()
 
     def forward(self, x):
+        dtype = x.dtype
+        x = x.float()  # statistics in float32, epsilon=1e-10 underflows in half precision and the variance overflows float16
         mean = x.mean(dim=-1, keepdim=True)
         var = ((x - mean) ** 2).mean(dim=-1, keepdim=True)
         std = (var + self.epsilon).sqrt()
@@ -144,7 +146,7 @@ class LayerNorm(nn.Module):
             y *= self.gamma
         if self.beta is not None:
             y += self.beta
-        return y
+        return y.to(dtype)
 
     def extra_repr(self):
         return 'normal_shape={}, gamma={}, beta={}, epsilon={}'.format(
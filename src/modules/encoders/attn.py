@@ -1,9 +1,10 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import numpy as np
 
-from src.modules.common.geometry import global_to_local, local_to_global, normalize_vector, construct_3d_basis, angstrom_to_nm
+from src.modules.common.geometry import global_to_local, local_to_global, normalize_vector, construct_3d_basis, angstrom_to_nm, gather_neighbors, residue_knn
 from src.modules.common.layers import mask_zero, LayerNorm
 from src.utils.protein.constants import BBHeavyAtom
 
@@ -20,12 +21,30 @@ def _alpha_from_logits(logits, mask, inf=1e5):
     mask_row = mask.view(N, L, 1, 1).expand_as(logits)  # (N, L, *, *)
     mask_pair = mask_row * mask_row.permute(0, 2, 1, 3)  # (N, L, L, *)
 
-    logits = torch.where(mask_pair, logits, logits - inf)
+    logits = torch.where(mask_pair, logits.float(), logits.float() - inf)  # float32, `inf` overflows float16 and fully masked rows would turn into NaN
     alpha = torch.softmax(logits, dim=2)  # (N, L, L, num_heads)
     alpha = torch.where(mask_row, alpha, torch.zeros_like(alpha))
     return alpha
 
 
+def _sparse_alpha_from_logits(logits, mask, nbr_idx, inf=1e5):
+    """
+    Args:
+        logits: Logit matrices, (N, L, K, num_heads).
+        mask:   Masks, (N, L).
+        nbr_idx: Neighbor indices, (N, L, K).
+    Returns:
+        alpha:  Attention weights over the neighbors.
+    """
+    mask_row = mask[:, :, None, None].expand_as(logits)  # (N, L, *, *)
+    mask_pair = mask_row * gather_neighbors(mask, nbr_idx)[:, :, :, None]  # (N, L, K, *)
+
+    logits = torch.where(mask_pair, logits.float(), logits.float() - inf)  # float32, `inf` overflows float16 and fully masked rows would turn into NaN
+    alpha = torch.softmax(logits, dim=2)  # (N, L, K, num_heads)
+    alpha = torch.where(mask_row, alpha, torch.zeros_like(alpha))
+    return alpha
+
+
 def _heads(x, n_heads, n_ch):
     """
     Args:
@@ -158,16 +177,134 @@ class GABlock(nn.Module):
         return x_updated
 
 
+class SparseGABlock(GABlock):
+    """GABlock attending only to the K spatial neighbors of each residue, O(L * K) instead of O(L^2)."""
+
+    def _node_logits(self, x, nbr_idx):
+        query_l = _heads(self.proj_query(x), self.num_heads, self.query_key_dim)  # (N, L, n_heads, qk_ch)
+        key_l = _heads(self.proj_key(x), self.num_heads, self.query_key_dim)  # (N, L, n_heads, qk_ch)
+        key_l = gather_neighbors(key_l, nbr_idx)  # (N, L, K, n_heads, qk_ch)
+        logits_node = (query_l.unsqueeze(2) * key_l * (1 / np.sqrt(self.query_key_dim))).sum(-1)  # (N, L, K, num_heads)
+        return logits_node
+
+    def _spatial_logits(self, R, t, x, nbr_idx):
+        N, L, _ = t.size()
+        query_points = _heads(self.proj_query_point(x), self.num_heads * self.num_query_points, 3)  # (N, L, n_heads * n_pnts, 3)
+        query_s = local_to_global(R, t, query_points).reshape(N, L, self.num_heads, -1)  # (N, L, n_heads, n_pnts*3)
+        key_points = _heads(self.proj_key_point(x), self.num_heads * self.num_query_points, 3)  # (N, L, n_heads * n_pnts, 3)
+        key_s = local_to_global(R, t, key_points).reshape(N, L, self.num_heads, -1)  # (N, L, n_heads, n_pnts*3)
+        key_s = gather_neighbors(key_s, nbr_idx)  # (N, L, K, n_heads, n_pnts*3)
+        sum_sq_dist = ((query_s.unsqueeze(2) - key_s) ** 2).sum(-1)  # (N, L, K, n_heads)
+        gamma = F.softplus(self.spatial_coef)
+        logits_spatial = sum_sq_dist * ((-1 * gamma * np.sqrt(2 / (9 * self.num_query_points))) / 2)  # (N, L, K, n_heads)
+        return logits_spatial
+
+    def _node_aggregation(self, alpha, x, nbr_idx):
+        N, L = x.shape[:2]
+        value_l = _heads(self.proj_value(x), self.num_heads, self.query_key_dim)  # (N, L, n_heads, v_ch)
+        feat_node = alpha.unsqueeze(-1) * gather_neighbors(value_l, nbr_idx)  # (N, L, K, n_heads, v_ch)
+        return feat_node.sum(dim=2).reshape(N, L, -1)
+
+    def _spatial_aggregation(self, alpha, R, t, x, nbr_idx):
+        N, L, _ = t.size()
+        K = nbr_idx.size(-1)
+        value_points = _heads(self.proj_value_point(x), self.num_heads * self.num_value_points, 3)  # (N, L, n_heads * n_v_pnts, 3)
+        value_points = local_to_global(R, t, value_points.reshape(N, L, self.num_heads, self.num_value_points, 3))  # (N, L, n_heads, n_v_pnts, 3)
+        aggr_points = alpha.reshape(N, L, K, self.num_heads, 1, 1) * gather_neighbors(value_points, nbr_idx)  # (N, L, K, n_heads, n_pnts, 3)
+        aggr_points = aggr_points.sum(dim=2)  # (N, L, n_heads, n_pnts, 3)
+
+        feat_points = global_to_local(R, t, aggr_points)  # (N, L, n_heads, n_pnts, 3)
+        feat_distance = feat_points.norm(dim=-1)  # (N, L, n_heads, n_pnts)
+        feat_direction = normalize_vector(feat_points, dim=-1, eps=1e-4)  # (N, L, n_heads, n_pnts, 3)
+
+        feat_spatial = torch.cat([feat_points.reshape(N, L, -1), feat_distance.reshape(N, L, -1), feat_direction.reshape(N, L, -1), ], dim=-1)
+        return feat_spatial
+
+    def forward(self, R, t, x, z, mask, nbr_idx):
+        """
+        Args:
+            R:  Frame basis matrices, (N, L, 3, 3_index).
+            t:  Frame external (absolute) coordinates, (N, L, 3).
+            x:  Node-wise features, (N, L, F).
+            z:  Pair-wise features between residues and their neighbors, (N, L, K, C).
+            mask:   Masks, (N, L).
+            nbr_idx:    Neighbor indices, (N, L, K).
+        Returns:
+            x': Updated node-wise features, (N, L, F).
+        """
+        logits_sum = self._node_logits(x, nbr_idx) + self._pair_logits(z) + self._spatial_logits(R, t, x, nbr_idx)
+        alpha = _sparse_alpha_from_logits(logits_sum * np.sqrt(1 / 3), mask, nbr_idx)  # (N, L, K, n_heads)
+
+        feat_p2n = self._pair_aggregation(alpha, z)
+        feat_node = self._node_aggregation(alpha, x, nbr_idx)
+        feat_spatial = self._spatial_aggregation(alpha, R, t, x, nbr_idx)
+
+        feat_all = self.out_transform(torch.cat([feat_p2n, feat_node, feat_spatial], dim=-1))  # (N, L, F)
+        feat_all = mask_zero(mask.unsqueeze(-1), feat_all)
+        x_updated = self.layer_norm_1(x + feat_all)
+        x_updated = self.layer_norm_2(x_updated + self.mlp_transition(x_updated))
+        return x_updated
+
+
 class GAEncoder(nn.Module):
 
-    def __init__(self, node_feat_dim, pair_feat_dim, num_layers, ga_block_opt={}):
+    def __init__(self, node_feat_dim, pair_feat_dim, num_layers, ga_block_opt={}, checkpoint=False):
         super(GAEncoder, self).__init__()
         self.blocks = nn.ModuleList([GABlock(node_feat_dim, pair_feat_dim, **ga_block_opt) for _ in range(num_layers)])
+        self.checkpoint = checkpoint  # recompute the (N, L, L, heads) activations of each block in backward instead of storing them
 
-    def forward(self, pos_atoms, res_feat, pair_feat, mask):
+    def _block(self, block, *args):
+        if self.checkpoint and self.training and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(block, *args, use_reentrant=False)
+        return block(*args)
+
+    def get_neighbors(self, pos_atoms, mask_atoms):
+        return None  # every residue attends to every other residue
+
+    def forward(self, pos_atoms, res_feat, pair_feat, mask, nbr_idx=None):
         R = construct_3d_basis(pos_atoms[:, :, BBHeavyAtom.CA], pos_atoms[:, :, BBHeavyAtom.C], pos_atoms[:, :, BBHeavyAtom.N])
         t = pos_atoms[:, :, BBHeavyAtom.CA]
         t = angstrom_to_nm(t)
         for block in self.blocks:
-            res_feat = block(R, t, res_feat, pair_feat, mask)
+            res_feat = self._block(block, R, t, res_feat, pair_feat, mask)
         return res_feat
+
+
+class SparseGAEncoder(GAEncoder):
+    """
+    Each residue attends to its `num_neighbors` nearest residues (by CB distance), so whole complexes can be encoded without patching.
+    Parameters are identical to GAEncoder, dense checkpoints load as is. Pair features must be computed on the same neighbors,
+    i.e. `ResiduePairEncoder(..., nbr_idx=encoder.get_neighbors(pos_atoms, mask_atoms))`.
+    """
+
+    def __init__(self, node_feat_dim, pair_feat_dim, num_layers, num_neighbors=32, ga_block_opt={}, checkpoint=False):
+        super(GAEncoder, self).__init__()
+        self.num_neighbors = num_neighbors
+        self.blocks = nn.ModuleList([SparseGABlock(node_feat_dim, pair_feat_dim, **ga_block_opt) for _ in range(num_layers)])
+        self.checkpoint = checkpoint
+
+    def get_neighbors(self, pos_atoms, mask_atoms):
+        return residue_knn(pos_atoms, mask_atoms, self.num_neighbors)  # (N, L, K)
+
+    def forward(self, pos_atoms, res_feat, pair_feat, mask, nbr_idx=None):
+        assert nbr_idx is not None, 'sparse attention requires the neighbors used to compute `pair_feat`'
+        R = construct_3d_basis(pos_atoms[:, :, BBHeavyAtom.CA], pos_atoms[:, :, BBHeavyAtom.C], pos_atoms[:, :, BBHeavyAtom.N])
+        t = angstrom_to_nm(pos_atoms[:, :, BBHeavyAtom.CA])
+        for block in self.blocks:
+            res_feat = self._block(block, R, t, res_feat, pair_feat, mask, nbr_idx)
+        return res_feat
+
+
+def get_ga_encoder(cfg, node_feat_dim=None):
+    """
+    Build the dense or sparse GAEncoder from the `encoder` config, `attention: dense | sparse`, `checkpoint_ga: True` enables activation checkpointing.
+    """
+    node_feat_dim = cfg.node_feat_dim if node_feat_dim is None else node_feat_dim
+    attention = cfg.get('attention', 'dense')
+    if attention == 'dense':
+        return GAEncoder(node_feat_dim=node_feat_dim, pair_feat_dim=cfg.pair_feat_dim, num_layers=cfg.num_layers, checkpoint=cfg.get('checkpoint_ga', False))
+    elif attention == 'sparse':
+        return SparseGAEncoder(node_feat_dim=node_feat_dim, pair_feat_dim=cfg.pair_feat_dim, num_layers=cfg.num_layers, num_neighbors=cfg.get('attention_neighbors', 32),
+                               checkpoint=cfg.get('checkpoint_ga', False))
+    else:
+        raise NotImplementedError('Attention not supported: %s' % attention)
@@ -1,6 +1,7 @@
 import torch
 from einops import rearrange, repeat
 from torch import nn, einsum, broadcast_tensors
+from torch.utils.checkpoint import checkpoint
 
 
 # helper functions
@@ -32,6 +33,13 @@ def batched_index_select(values, indices, dim=1):
     return values.gather(dim, indices)
 
 
+def expected_sq_dist(coors_mean, coors_var, diagonal_var=True):
+    """E|x_i - x_j|^2 = |mu_i - mu_j|^2 + tr(var_i) + tr(var_j) without (B, N, N, 3) intermediates, (B, N, N)."""
+    coors_var_trace = coors_var.sum(dim=-1) if diagonal_var else coors_var.diagonal(offset=0, dim1=-2, dim2=-1).sum(dim=-1)  # (B, N)
+    dist = torch.cdist(coors_mean, coors_mean, compute_mode='donot_use_mm_for_euclid_dist') ** 2
+    return dist + coors_var_trace[:, :, None] + coors_var_trace[:, None, :]
+
+
 def fourier_encode_dist(x, num_encodings=4, include_self=True):
     x = x.unsqueeze(-1)
     device, dtype, orig_x = x.device, x.dtype, x
@@ -99,14 +107,14 @@ class Attention(nn.Module):
         kv = self.to_kv(context).chunk(2, dim=-1)
 
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=h), (q, *kv))
-        dots = einsum('b h i d, b h j d -> b h i j', q, k) * self.scale
+        dots = einsum('b h i d, b h j d -> b h i j', q, k).float() * self.scale  # softmax in float32 under autocast
 
         if exists(mask):
             mask_value = -torch.finfo(dots.dtype).max
             mask = rearrange(mask, 'b n -> b () () n')
             dots.masked_fill_(~mask, mask_value)
 
-        attn = dots.softmax(dim=-1)
+        attn = dots.softmax(dim=-1).to(v.dtype)
         out = einsum('b h i j, b h j d -> b h i d', attn, v)
 
         out = rearrange(out, 'b h n d -> b n (h d)', h=h)
@@ -140,7 +148,7 @@ class GlobalLinearAttention(nn.Module):
 class EGNN(nn.Module):
     def __init__(self, dim, edge_dim=0, m_dim=16, fourier_features=0, num_nearest_neighbors=0, dropout=0.0, init_eps=1e-3, norm_feats=False, norm_coors=False,
                  norm_coors_scale_init=1e-2, update_feats=True, update_coors_mean=True, update_coors_var=True, only_sparse_neighbors=False, valid_radius=float('inf'),
-                 m_pool_method='sum', soft_edges=False, coor_weights_clamp_value=None, distri_input=True):
+                 m_pool_method='sum', soft_edges=False, coor_weights_clamp_value=None, distri_input=True, knn_first=False):
         super().__init__()
         assert m_pool_method in {'sum', 'mean'}, 'pool method must be either sum or mean'
         assert update_feats or update_coors_mean or update_coors_var, 'you must update either features, coordinates mean or variance, or all'
@@ -165,6 +173,7 @@ class EGNN(nn.Module):
 
         self.num_nearest_neighbors = num_nearest_neighbors
         self.only_sparse_neighbors = only_sparse_neighbors
+        self.knn_first = knn_first  # select neighbors on distances first, relative statistics in O(N * k) memory
         self.valid_radius = valid_radius
 
         self.coor_weights_clamp_value = coor_weights_clamp_value
@@ -177,33 +186,45 @@ class EGNN(nn.Module):
             # seems to be needed to keep the network from exploding to NaN with greater depths
             nn.init.normal_(module.weight, std=self.init_eps)
 
-    def forward(self, feats, coors_mean, coors_var, edges=None, mask=None, adj_mat=None, diagonal_var=True):
-        b, n, d = feats.shape
-        device, num_nearest, valid_radius, only_sparse_neighbors = feats.device, self.num_nearest_neighbors, self.valid_radius, self.only_sparse_neighbors
-
-        use_nearest = num_nearest > 0 or only_sparse_neighbors
-
+    @staticmethod
+    def _relative_coors(coors_mean, coors_var, diagonal_var):
         if diagonal_var:
             rel_coors_var = rearrange(coors_var, 'b i d-> b i () d') + rearrange(coors_var, 'b j d -> b () j d')   # relative pos variance (B, N, N, 3)
         else:
             rel_coors_var = rearrange(coors_var, 'b i d k-> b i () d k') + rearrange(coors_var, 'b j d k -> b () j d k')   # relative pos variance (B, N, N, 3, 3)
 
         rel_coors_mean = rearrange(coors_mean, 'b i d -> b i () d') - rearrange(coors_mean, 'b j d -> b () j d')          # relative pos mean (B, N, N, 3)
+        return rel_coors_mean, rel_coors_var
 
-        # compute the distribution of atomic distances
-        rel_dist_sum = (rel_coors_mean ** 2).sum(dim=-1)  # (B, N, N)
+    @staticmethod
+    def _relative_dist(rel_coors_mean, rel_coors_var, diagonal_var):
+        # compute the distribution of atomic distances, (B, N, N) or (B, N, K)
+        rel_dist_sum = (rel_coors_mean ** 2).sum(dim=-1)
         if diagonal_var:
-            rel_coors_var_trace = rel_coors_var.sum(dim=-1)   # (B, N, N)
-            rel_dist_std = 2 * rel_coors_var_trace + 4 * (rel_coors_mean ** 2 * rel_coors_var).sum(-1)   # (B, N, N)
+            rel_coors_var_trace = rel_coors_var.sum(dim=-1)
+            rel_dist_std = 2 * rel_coors_var_trace + 4 * (rel_coors_mean ** 2 * rel_coors_var).sum(-1)
         else:
-            rel_coors_var_trace = rel_coors_var.diagonal(offset=0, dim1=-2, dim2=-1).sum(dim=-1)   # (B, N, N)
-            rel_dist_std = 2 * rel_coors_var_trace + 4 * (rel_coors_mean.unsqueeze(-2) @ rel_coors_var @ rel_coors_mean.unsqueeze(-1)).squeeze(-1).squeeze(-1)   # (B, N, N)
+            rel_coors_var_trace = rel_coors_var.diagonal(offset=0, dim1=-2, dim2=-1).sum(dim=-1)
+            rel_dist_std = 2 * rel_coors_var_trace + 4 * (rel_coors_mean.unsqueeze(-2) @ rel_coors_var @ rel_coors_mean.unsqueeze(-1)).squeeze(-1).squeeze(-1)
 
-        rel_dist_mean = rel_dist_sum + rel_coors_var_trace    # (B, N, N)
+        rel_dist_mean = rel_dist_sum + rel_coors_var_trace
+        return rel_dist_mean, rel_dist_std
 
-        if use_nearest:
-            ranking = rel_dist_mean.clone()
+    def forward(self, feats, coors_mean, coors_var, edges=None, mask=None, adj_mat=None, diagonal_var=True):
+        b, n, d = feats.shape
+        device, num_nearest, valid_radius, only_sparse_neighbors = feats.device, self.num_nearest_neighbors, self.valid_radius, self.only_sparse_neighbors
+
+        use_nearest = num_nearest > 0 or only_sparse_neighbors
 
+        if use_nearest and self.knn_first:
+            ranking = expected_sq_dist(coors_mean, coors_var, diagonal_var)  # same ranking as rel_dist_mean, no (B, N, N, 3) tensors
+        else:
+            rel_coors_mean, rel_coors_var = self._relative_coors(coors_mean, coors_var, diagonal_var)
+            rel_dist_mean, rel_dist_std = self._relative_dist(rel_coors_mean, rel_coors_var, diagonal_var)
+            if use_nearest:
+                ranking = rel_dist_mean.clone()
+
+        if use_nearest:
             if exists(mask):
                 rank_mask = mask[:, :, None] * mask[:, None, :]
                 ranking.masked_fill_(~rank_mask, 1e5)
@@ -222,14 +243,21 @@ class EGNN(nn.Module):
                 ranking.masked_fill_(self_mask, -1.)
                 ranking.masked_fill_(adj_mat, 0.)
 
-            nbhd_ranking, nbhd_indices = ranking.topk(num_nearest, dim=-1, largest=False)
+            nbhd_ranking, nbhd_indices = ranking.topk(min(num_nearest, n), dim=-1, largest=False)
 
             nbhd_mask = nbhd_ranking <= valid_radius
 
-            rel_coors_mean = batched_index_select(rel_coors_mean, nbhd_indices, dim=2)
-            rel_coors_var = batched_index_select(rel_coors_var, nbhd_indices, dim=2)
-            rel_dist_mean = batched_index_select(rel_dist_mean, nbhd_indices, dim=2)
-            rel_dist_std = batched_index_select(rel_dist_std, nbhd_indices, dim=2)
+            if self.knn_first:  # distribution-aware statistics of the selected edges only, (B, N, K, ...)
+                coors_mean_j = batched_index_select(coors_mean, nbhd_indices, dim=1)
+                coors_var_j = batched_index_select(coors_var, nbhd_indices, dim=1)
+                rel_coors_mean = coors_mean.unsqueeze(2) - coors_mean_j
+                rel_coors_var = coors_var.unsqueeze(2) + coors_var_j
+                rel_dist_mean, rel_dist_std = self._relative_dist(rel_coors_mean, rel_coors_var, diagonal_var)
+            else:
+                rel_coors_mean = batched_index_select(rel_coors_mean, nbhd_indices, dim=2)
+                rel_coors_var = batched_index_select(rel_coors_var, nbhd_indices, dim=2)
+                rel_dist_mean = batched_index_select(rel_dist_mean, nbhd_indices, dim=2)
+                rel_dist_std = batched_index_select(rel_dist_std, nbhd_indices, dim=2)
 
             if exists(edges):
                 edges = batched_index_select(edges, nbhd_indices, dim=2)
@@ -325,10 +353,13 @@ class EGNN(nn.Module):
 
 class EGNN_Network(nn.Module):
     def __init__(self, *, depth, dim, num_tokens=None, num_edge_tokens=None, num_positions=None, edge_dim=0, num_adj_degrees=None,
-                 adj_dim=0, global_linear_attn_every=0, global_linear_attn_heads=8, global_linear_attn_dim_head=64, num_global_tokens=4, **kwargs):
+                 adj_dim=0, global_linear_attn_every=0, global_linear_attn_heads=8, global_linear_attn_dim_head=64, num_global_tokens=4, subgraph_hops=0, checkpoint=False, **kwargs):
         super().__init__()
         assert not (exists(num_adj_degrees) and num_adj_degrees < 1), 'make sure adjacent degrees is greater than 1'
+        assert subgraph_hops == 0 or kwargs.get('num_nearest_neighbors', 0) > 0, 'subgraph refinement requires a k-nearest neighbor graph'
         self.num_positions = num_positions
+        self.subgraph_hops = subgraph_hops  # > 0: with pos_change_flag, only run on the flagged nodes and their k-hop neighborhood
+        self.checkpoint = checkpoint  # recompute the edge activations of each layer in backward instead of storing them
 
         self.token_emb = nn.Embedding(num_tokens, dim) if exists(num_tokens) else None
         self.pos_emb = nn.Embedding(num_positions, dim) if exists(num_positions) else None
@@ -353,6 +384,34 @@ class EGNN_Network(nn.Module):
             self.layers.append(nn.ModuleList([GlobalLinearAttention(dim=dim, heads=global_linear_attn_heads, dim_head=global_linear_attn_dim_head) if is_global_layer else None,
                                               EGNN(dim=dim, edge_dim=(edge_dim + adj_dim), norm_feats=True, **kwargs), ]))
 
+    def _extract_subgraph(self, coors_mean, coors_var, mask, pos_change_flag, diagonal_var):
+        """
+        Returns:
+            subgraph_idx:   Indices of the flagged nodes and their k-hop neighbors, padded to the largest subgraph, (B, S).
+            subgraph_flag:  Whether the index is part of the subgraph (False for padding), (B, S).
+        """
+        n = coors_mean.shape[1]
+        ranking = expected_sq_dist(coors_mean, coors_var, diagonal_var)
+        if exists(mask):
+            ranking.masked_fill_(~(mask[:, :, None] * mask[:, None, :]), 1e5)
+        nbhd_indices = ranking.topk(min(self.layers[0][1].num_nearest_neighbors, n), dim=-1, largest=False)[1]  # (B, N, K)
+
+        selected = pos_change_flag.clone()
+        for _ in range(self.subgraph_hops):
+            hits = torch.zeros(selected.shape, device=selected.device).scatter_add_(1, nbhd_indices.flatten(1), selected[:, :, None].expand_as(nbhd_indices).flatten(1).float())
+            selected = selected | (hits > 0)
+
+        num_selected = int(selected.sum(dim=-1).max().item())
+        subgraph_idx = torch.sort((~selected).int(), dim=1, stable=True)[1][:, :num_selected]  # selected nodes first, in their original order
+        return subgraph_idx, selected.gather(1, subgraph_idx)
+
+    @staticmethod
+    def _scatter_subgraph(full, sub, subgraph_idx, subgraph_flag):
+        shape = (*subgraph_idx.shape, *((1,) * (full.dim() - 2)))
+        index = subgraph_idx.view(shape).expand_as(sub)
+        sub = torch.where(subgraph_flag.view(shape), sub, full.gather(1, index))
+        return full.scatter(1, index, sub)
+
     def forward(self, feats, coors_mean, coors_var, adj_mat=None, edges=None, mask=None, return_coor_changes=False, diagonal_var=True, pos_change_flag=None):
         b, device = feats.shape[0], feats.device
 
@@ -394,6 +453,15 @@ class EGNN_Network(nn.Module):
         if exists(self.global_tokens):
             global_tokens = repeat(self.global_tokens, 'n d -> b n d', b=b)
 
+        # refine the flagged nodes on their local subgraph only, the other nodes keep their input features and coordinates
+        subgraph_idx = None
+        if pos_change_flag is not None and self.subgraph_hops > 0 and not torch.jit.is_tracing():  # the subgraph size is data-dependent, traced graphs run on all nodes (equal for hops >= depth)
+            assert not exists(adj_mat) and not exists(edges), 'subgraph refinement does not support edges or adjacency matrices'
+            subgraph_idx, subgraph_flag = self._extract_subgraph(coors_mean, coors_var, mask, pos_change_flag, diagonal_var)
+            feats_full, coors_mean_full, coors_var_full = feats, coors_mean, coors_var
+            feats, coors_mean, coors_var, pos_change_flag = [batched_index_select(t, subgraph_idx, dim=1) for t in (feats, coors_mean, coors_var, pos_change_flag)]
+            mask = subgraph_flag & batched_index_select(mask, subgraph_idx, dim=1) if exists(mask) else subgraph_flag
+
         # go through layers
         if return_coor_changes:
             coor_changes = [coors_mean]
@@ -403,13 +471,23 @@ class EGNN_Network(nn.Module):
             if exists(global_attn):
                 feats, global_tokens = global_attn(feats, global_tokens, mask=mask)
 
-            feats, coors_mean, coors_var = egnn(feats, coors_mean, coors_var, adj_mat=adj_mat, edges=edges, mask=mask, diagonal_var=diagonal_var)
+            if self.checkpoint and self.training and torch.is_grad_enabled():
+                feats, coors_mean, coors_var = checkpoint(egnn, feats, coors_mean, coors_var, adj_mat=adj_mat, edges=edges, mask=mask, diagonal_var=diagonal_var, use_reentrant=False)
+            else:
+                feats, coors_mean, coors_var = egnn(feats, coors_mean, coors_var, adj_mat=adj_mat, edges=edges, mask=mask, diagonal_var=diagonal_var)
             if pos_change_flag is not None:
-                coors_mean[~pos_change_flag] = coors_mean_[~pos_change_flag]
+                coors_mean = torch.where(pos_change_flag[..., None], coors_mean, coors_mean_)  # no data-dependent shapes, compiles into a single graph
 
             if return_coor_changes:
                 coor_changes.append(coors_mean)
 
+        if exists(subgraph_idx):
+            feats = self._scatter_subgraph(feats_full, feats, subgraph_idx, subgraph_flag)
+            coors_var = self._scatter_subgraph(coors_var_full, coors_var, subgraph_idx, subgraph_flag)
+            if return_coor_changes:
+                coor_changes = [self._scatter_subgraph(coors_mean_full, c, subgraph_idx, subgraph_flag) for c in coor_changes]
+            coors_mean = self._scatter_subgraph(coors_mean_full, coors_mean, subgraph_idx, subgraph_flag)
+
         if return_coor_changes:
             return feats, coors_mean, coors_var, coor_changes
 
@@ -20,7 +20,7 @@ def _alpha_from_logits(logits, mask, inf=1e5):
     mask_row = mask.view(N, L, 1, 1).expand_as(logits)  # (N, L, *, *)
     mask_pair = mask_row * mask_row.permute(0, 2, 1, 3)  # (N, L, L, *)
 
-    logits = torch.where(mask_pair, logits, logits - inf)
+    logits = torch.where(mask_pair, logits.float(), logits.float() - inf)  # float32, `inf` overflows float16 and fully masked rows would turn into NaN
     alpha = torch.softmax(logits, dim=2)  # (N, L, L, num_heads)
     alpha = torch.where(mask_row, alpha, torch.zeros_like(alpha))
     return alpha
@@ -2,7 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from src.modules.common.geometry import angstrom_to_nm, pairwise_dihedrals
+from src.modules.common.geometry import angstrom_to_nm, dihedrals_between, pairwise_dihedrals, gather_neighbors
 from src.modules.common.layers import AngularEncoding
 from src.utils.protein.constants import BBHeavyAtom
 
@@ -27,44 +27,170 @@ class ResiduePairEncoder(nn.Module):
         infeat_dim = feat_dim + feat_dim + feat_dim + feat_dihed_dim
         self.out_mlp = nn.Sequential(nn.Linear(infeat_dim, feat_dim), nn.ReLU(), nn.Linear(feat_dim, feat_dim), nn.ReLU(), nn.Linear(feat_dim, feat_dim), )
 
-    def forward(self, aa, res_nb, chain_nb, pos_atoms, mask_atoms):
+    def compile(self, *args, **kwargs):
+        """Also compiles the geometry and identity kernels, `encode_geometry`, `patch_identity` and `update_positions` call them outside of `forward`."""
+        super().compile(*args, **kwargs)
+        self._pair_geometry = torch.compile(self._pair_geometry, *args, **kwargs)
+        self._identity_features = torch.compile(self._identity_features, *args, **kwargs)
+
+    def encode_geometry(self, res_nb, chain_nb, pos_atoms, mask_atoms, nbr_idx=None):
         """
+        Pair features that do not depend on the amino acid identities. They can be shared by sequences on the same structure (e.g. wild-type and mutant).
         Args:
-            aa: (N, L).
             res_nb: (N, L).
             chain_nb: (N, L).
             pos_atoms:  (N, L, A, 3)
             mask_atoms: (N, L, A)
+            nbr_idx:    (N, L, K), optional. Only encode the pairs between each residue and its K neighbors.
         Returns:
-            (N, L, L, feat_dim)
+            Dict of (N, L, L, *) or (N, L, K, *) tensors.
         """
-        N, L = aa.size()
-        mask_residue = mask_atoms[:, :, BBHeavyAtom.CA]  # (N, L)
-        mask_pair = mask_residue[:, :, None] * mask_residue[:, None, :]
+        if nbr_idx is None:  # residue j broadcasts along dim 1
+            j = [v[:, None] for v in (res_nb, chain_nb, pos_atoms, mask_atoms)]
+        else:  # residue j is gathered per row, (N, L, K, ...)
+            j = [gather_neighbors(v, nbr_idx) for v in (res_nb, chain_nb, pos_atoms, mask_atoms)]
+        geometry = self._pair_geometry(res_nb, chain_nb, pos_atoms, mask_atoms, *j, dihed=pairwise_dihedrals(pos_atoms, nbr_idx=nbr_idx))
+        return {'nbr_idx': nbr_idx, **geometry}
 
-        # Pair identities
-        aa_pair = aa[:, :, None] * self.max_aa_types + aa[:, None, :]  # (N, L, L)
-        feat_aapair = self.aa_pair_embed(aa_pair)
+    def _pair_geometry(self, res_nb, chain_nb, pos_atoms, mask_atoms, res_nb_j, chain_nb_j, pos_atoms_j, mask_atoms_j, dihed):
+        """Residues i (N, Li, ...) and residues j (N, Li or 1, Lj, ...)."""
+        N, L = res_nb.size()
+        mask_residue, mask_residue_j = mask_atoms[:, :, BBHeavyAtom.CA], mask_atoms_j[..., BBHeavyAtom.CA]
+        mask_pair = mask_residue[:, :, None] * mask_residue_j
+        M = mask_pair.size(2)
 
         # Relative positions
-        same_chain = (chain_nb[:, :, None] == chain_nb[:, None, :])
-        relpos = torch.clamp(res_nb[:, :, None] - res_nb[:, None, :], min=-self.max_relpos, max=self.max_relpos, )  # (N, L, L)
+        same_chain = (chain_nb[:, :, None] == chain_nb_j)
+        relpos = torch.clamp(res_nb[:, :, None] - res_nb_j, min=-self.max_relpos, max=self.max_relpos, )  # (N, L, L)
         feat_relpos = self.relpos_embed(relpos + self.max_relpos) * same_chain[:, :, :, None]
 
         # Distances
-        d = angstrom_to_nm(torch.linalg.norm(pos_atoms[:, :, None, :, None] - pos_atoms[:, None, :, None, :], dim=-1, ord=2, )).reshape(N, L, L, -1)  # (N, L, L, A*A)
-        c = F.softplus(self.aapair_to_distcoef(aa_pair))  # (N, L, L, A*A)
-        d_gauss = torch.exp(-1 * c * d ** 2)
-        mask_atom_pair = (mask_atoms[:, :, None, :, None] * mask_atoms[:, None, :, None, :]).reshape(N, L, L, -1)
-        feat_dist = self.distance_embed(d_gauss * mask_atom_pair)
+        d = angstrom_to_nm(torch.linalg.norm(pos_atoms[:, :, None, :, None] - pos_atoms_j[:, :, :, None, :], dim=-1, ord=2, )).reshape(N, L, M, -1)  # (N, L, L, A*A)
+        mask_atom_pair = (mask_atoms[:, :, None, :, None] * mask_atoms_j[:, :, :, None, :]).reshape(N, L, M, -1)
 
         # Orientations
-        dihed = pairwise_dihedrals(pos_atoms)  # (N, L, L, 2)
         feat_dihed = self.dihedral_embed(dihed)
 
+        return {'feat_relpos': feat_relpos, 'd': d, 'mask_atom_pair': mask_atom_pair, 'feat_dihed': feat_dihed, 'mask_pair': mask_pair}
+
+    def _identity_features(self, aa_i, aa_j, feat_relpos, d, mask_atom_pair, feat_dihed, mask_pair, **kwargs):
+        # Pair identities
+        aa_pair = aa_i[:, :, None] * self.max_aa_types + aa_j  # (N, L, L)
+        feat_aapair = self.aa_pair_embed(aa_pair)
+
+        # Distances
+        c = F.softplus(self.aapair_to_distcoef(aa_pair))  # (N, L, L, A*A)
+        d_gauss = torch.exp(-1 * c * d ** 2)
+        feat_dist = self.distance_embed(d_gauss * mask_atom_pair)
+
         # All
         feat_all = torch.cat([feat_aapair, feat_relpos, feat_dist, feat_dihed], dim=-1)
         feat_all = self.out_mlp(feat_all)  # (N, L, L, F)
         feat_all = feat_all * mask_pair[:, :, :, None]
-
         return feat_all
+
+    def encode_identity(self, aa, geometry):
+        """
+        Args:
+            aa: (N, L).
+            geometry:   Output of `encode_geometry`.
+        Returns:
+            (N, L, L, feat_dim) or (N, L, K, feat_dim)
+        """
+        nbr_idx = geometry['nbr_idx']
+        aa_j = aa[:, None, :] if nbr_idx is None else gather_neighbors(aa, nbr_idx)
+        return self._identity_features(aa, aa_j, **geometry)
+
+    def patch_identity(self, feat_ref, aa, aa_ref, geometry):
+        """
+        Pair features of `aa` on the same structure as `feat_ref` (computed for `aa_ref`), only recomputed on the rows and columns where the sequences differ.
+        Args:
+            feat_ref:   (N, L, L, feat_dim).
+            aa, aa_ref: (N, L).
+            geometry:   Output of `encode_geometry`, shared by both sequences.
+        """
+        if geometry['nbr_idx'] is not None or torch.jit.is_tracing():  # sparse pairs are cheap, mutated columns are scattered over the neighbor lists
+            return self.encode_identity(aa, geometry)  # traced graphs cannot depend on the number of changed residues
+
+        changed = (aa != aa_ref)  # (N, L)
+        num_changed = int(changed.sum(dim=-1).max().item())
+        if num_changed == 0:
+            return feat_ref
+        # Changed residues first. Rows with fewer changes are padded with unchanged residues, recomputing them is redundant but still correct.
+        idx = torch.sort((~changed).int(), dim=1, stable=True)[1][:, :num_changed]  # (N, M)
+        geometry = {k: v for k, v in geometry.items() if k != 'nbr_idx'}
+
+        feat_rows = self._identity_features(aa.gather(1, idx), aa[:, None, :], **{k: _gather_pairs(v, idx, dim=1) for k, v in geometry.items()})  # (N, M, L, F)
+        feat_cols = self._identity_features(aa, aa.gather(1, idx)[:, None, :], **{k: _gather_pairs(v, idx, dim=2) for k, v in geometry.items()})  # (N, L, M, F)
+
+        feat = feat_ref.clone()
+        feat.scatter_(1, _pair_index(idx, feat_rows.shape, dim=1), feat_rows)
+        feat.scatter_(2, _pair_index(idx, feat_cols.shape, dim=2), feat_cols)
+        return feat
+
+    def update_positions(self, feat_ref, aa, res_nb, chain_nb, pos_atoms, mask_atoms, moved):
+        """
+        Dense pair features after the residues `moved` (N, L) changed coordinates, e.g. between refinement recycles. Only their rows and columns are recomputed.
+        Args:
+            feat_ref:   (N, L, L, feat_dim), pair features before the move.
+            pos_atoms:  (N, L, A, 3), coordinates after the move.
+        """
+        num_moved = int(moved.sum(dim=-1).max().item())
+        if num_moved == 0:
+            return feat_ref
+        idx = torch.sort((~moved).int(), dim=1, stable=True)[1][:, :num_moved]  # (N, M), moved residues first
+        full = (aa, res_nb, chain_nb, pos_atoms, mask_atoms)
+        sub = [gather_neighbors(v, idx[:, None, :]) for v in full]  # (N, 1, M, ...)
+
+        rows = self._pair_geometry(*[v[:, 0] for v in sub[1:]], *[v[:, None] for v in full[1:]], dihed=dihedrals_between(sub[3][:, 0], pos_atoms[:, None]))
+        feat_rows = self._identity_features(sub[0][:, 0], aa[:, None, :], **rows)  # (N, M, L, F)
+        cols = self._pair_geometry(*full[1:], *sub[1:], dihed=dihedrals_between(pos_atoms, sub[3]))
+        feat_cols = self._identity_features(aa, sub[0], **cols)  # (N, L, M, F)
+
+        feat = feat_ref.clone()
+        feat.scatter_(1, _pair_index(idx, feat_rows.shape, dim=1), feat_rows)
+        feat.scatter_(2, _pair_index(idx, feat_cols.shape, dim=2), feat_cols)
+        return feat
+
+    def forward(self, aa, res_nb, chain_nb, pos_atoms, mask_atoms, nbr_idx=None):
+        """
+        Args:
+            aa: (N, L).
+            res_nb: (N, L).
+            chain_nb: (N, L).
+            pos_atoms:  (N, L, A, 3)
+            mask_atoms: (N, L, A)
+            nbr_idx:    (N, L, K), optional. Only encode the pairs between each residue and its K neighbors.
+        Returns:
+            (N, L, L, feat_dim) or (N, L, K, feat_dim)
+        """
+        geometry = self.encode_geometry(res_nb=res_nb, chain_nb=chain_nb, pos_atoms=pos_atoms, mask_atoms=mask_atoms, nbr_idx=nbr_idx)
+        return self.encode_identity(aa, geometry)
+
+    def forward_incremental(self, state, aa, res_nb, chain_nb, pos_atoms, mask_atoms, nbr_idx=None):
+        """
+        Same as `forward`, across calls on the same sequences whose coordinates partly change (refinement recycles).
+        Dense pair features in `state` are updated on the rows and columns of the moved residues, sparse ones are recomputed since the neighbor lists change.
+        """
+        if nbr_idx is None and 'pair_feat' in state and not torch.jit.is_tracing():  # the number of moved residues would be fixed in a traced graph
+            moved = (pos_atoms != state['pos_atoms']).flatten(start_dim=2).any(dim=-1)  # (N, L)
+            feat = self.update_positions(state['pair_feat'], aa, res_nb, chain_nb, pos_atoms, mask_atoms, moved)
+        else:
+            feat = self(aa=aa, res_nb=res_nb, chain_nb=chain_nb, pos_atoms=pos_atoms, mask_atoms=mask_atoms, nbr_idx=nbr_idx)
+        if nbr_idx is None:
+            state['pair_feat'], state['pos_atoms'] = feat, pos_atoms
+        return feat
+
+
+def _pair_index(idx, shape, dim):
+    """Expand residue indices (N, M) along pair dimension `dim` (1 for rows, 2 for columns) to a `shape` (N, *, *, ...) index."""
+    index_shape = [1] * len(shape)
+    index_shape[0], index_shape[dim] = idx.size(0), idx.size(1)
+    return idx.view(index_shape).expand(shape)
+
+
+def _gather_pairs(v, idx, dim):
+    """Select the rows (dim=1) or columns (dim=2) of pair tensor `v`, (N, L, L, *) -> (N, M, L, *) or (N, L, M, *)."""
+    shape = list(v.shape)
+    shape[dim] = idx.size(1)
+    return v.gather(dim, _pair_index(idx, shape, dim))
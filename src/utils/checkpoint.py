@@ -0,0 +1,136 @@
+import collections
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+TRAINING_STATE_KEYS = ('optimizer', 'optimizers', 'scheduler', 'schedulers')
+
+
+def snapshot(obj, memo=None):
+    """CPU copy of the tensors of a (nested) state, taken on the training thread so that later steps do not modify it. Tensors sharing storage stay shared."""
+    memo = {} if memo is None else memo
+    if isinstance(obj, torch.Tensor):
+        key = (obj.untyped_storage().data_ptr(), obj.storage_offset(), tuple(obj.shape), obj.stride(), obj.dtype, obj.device)
+        if key not in memo:
+            memo[key] = obj.detach().to('cpu', copy=True)
+        return memo[key]
+    elif type(obj) in (dict, collections.OrderedDict):  # state dicts, other mappings (the config) are kept as is
+        out = type(obj)((k, snapshot(v, memo)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):  # module versions read by `load_state_dict`
+            out._metadata = obj._metadata
+        return out
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v, memo) for v in obj)
+    return obj
+
+
+def weights_only(state):
+    """The state without optimizers and schedulers, enough for inference (`load_ensemble`, `test_skempi.py`)."""
+    if type(state) is dict:  # checkpoint and `CrossValidation` dicts, model state dicts are OrderedDicts
+        return {k: weights_only(v) for k, v in state.items() if k not in TRAINING_STATE_KEYS}
+    return state
+
+
+def atomic_save(obj, path):
+    """Readers never see a partially written file: write to a temporary file in the same directory, then rename."""
+    tmp_path = '%s.tmp%d' % (path, threading.get_ident())
+    try:
+        torch.save(obj, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class CheckpointManager(object):
+    """
+    Writes `<it>.pt` checkpoints in a background thread: `save` only snapshots the state to CPU, serialization and disk I/O overlap with training.
+    Keeps the `keep_last` most recent checkpoints and the best one according to `metric` (e.g. per-complex Spearman on the validation set).
+    Args:
+        ckpt_dir:       Directory of the checkpoints, None disables saving (debug runs).
+        keep_last:      Number of recent checkpoints kept, None keeps all of them and 0 only the best one.
+        mode:           'max' or 'min', whether a larger metric is better.
+        weights_only:   Also write `<it>.weights.pt` without the optimizer and scheduler states.
+        max_pending:    Snapshots waiting to be written, `save` blocks beyond that to bound the host memory.
+    """
+
+    def __init__(self, ckpt_dir, keep_last=None, mode='max', weights_only=False, max_pending=2, logger=None):
+        super().__init__()
+        if mode not in ('max', 'min'):
+            raise NotImplementedError('Checkpoint mode not supported: %s' % mode)
+        if keep_last is not None and keep_last < 0:
+            raise ValueError('keep_last must be None or non-negative: %d' % keep_last)
+        self.ckpt_dir = ckpt_dir
+        self.keep_last = keep_last
+        self.mode = mode
+        self.weights_only = weights_only
+        self.max_pending = max_pending
+        self.logger = logger
+        self.history = []  # iterations of the checkpoints on disk
+        self.best_it, self.best_metric = None, None
+        self.pending = []
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint') if ckpt_dir is not None else None
+
+    def path(self, it, weights=False):
+        return os.path.join(self.ckpt_dir, ('%d.weights.pt' if weights else '%d.pt') % it)
+
+    @property
+    def best_path(self):
+        return None if self.best_it is None else self.path(self.best_it)
+
+    def _is_better(self, metric):
+        if metric is None:
+            return False
+        return self.best_metric is None or (metric > self.best_metric if self.mode == 'max' else metric < self.best_metric)
+
+    def save(self, state, it, metric=None):
+        """Schedules the checkpoint of iteration `it`, returns once `state` has been copied to CPU."""
+        if self.executor is None:
+            return
+        state = snapshot(state)
+        if self._is_better(metric):
+            self.best_it, self.best_metric = it, metric
+        for f in [f for f in self.pending if f.done()]:
+            self.pending.remove(f)
+            f.result()  # raises the error of a failed write
+        while len(self.pending) >= self.max_pending:
+            self.pending.pop(0).result()
+        self.pending.append(self.executor.submit(self._write, state, it, self.best_it))
+
+    def _write(self, state, it, best_it):
+        try:
+            atomic_save(state, self.path(it))
+            if self.weights_only:
+                atomic_save(weights_only(state), self.path(it, weights=True))
+            self.history.append(it)
+            self._apply_retention(best_it)
+        except Exception as e:  # the training thread is not interrupted, the error is reported
+            if self.logger is not None:
+                self.logger.error('Failed to write checkpoint %d: %r' % (it, e))
+            raise
+
+    def _apply_retention(self, best_it):
+        if self.keep_last is None:
+            return
+        keep = set(self.history[len(self.history) - self.keep_last:]) | {best_it}  # `history[-0:]` would keep everything
+        for it in [i for i in self.history if i not in keep]:
+            for path in (self.path(it), self.path(it, weights=True)):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.history.remove(it)
+
+    def wait(self):
+        """Blocks until every scheduled checkpoint is on disk, raises the first write error."""
+        pending, self.pending = self.pending, []
+        for f in pending:
+            f.result()
+
+    def close(self):
+        if self.executor is not None:
+            try:
+                self.wait()
+            finally:
+                self.executor.shutdown(wait=True)
+                self.executor = None
@@ -1,7 +1,12 @@
 import math
+import os
+
 import torch
+from torch.utils.data import DataLoader, Subset
 from torch.utils.data._utils.collate import default_collate
 
+from src.utils.checkpoint import atomic_save
+
 DEFAULT_PAD_VALUES = {'aa': 21, 'aa_masked': 21, 'aa_true': 21, 'chain_nb': -1, 'pos14': 0.0, 'chain_id': ' ', 'icode': ' ', }
 
 
@@ -63,3 +68,96 @@ class PaddingCollate(object):
         batch = default_collate(data_list_padded)
         batch['size'] = len(data_list_padded)
         return batch
+
+
+def index_select_batch(batch, index):
+    """Select samples of a collated batch along the batch dimension, `index` may repeat samples."""
+    n = batch['aa'].size(0)
+    batch_selected = {}
+    for k, v in batch.items():
+        if isinstance(v, torch.Tensor) and v.dim() > 0 and v.size(0) == n:
+            batch_selected[k] = v[index]
+        elif isinstance(v, list) and len(v) == n:
+            batch_selected[k] = [v[i] for i in index.tolist()]
+        else:
+            batch_selected[k] = v
+    batch_selected['size'] = len(index)
+    return batch_selected
+
+
+def _identity(x):
+    return x
+
+
+class _SampleCollate(object):
+    """Also returns the samples of the batch, `CachedBatchLoader` keeps the deterministic ones."""
+
+    def __init__(self, collate_fn):
+        super().__init__()
+        self.collate_fn = collate_fn
+
+    def __call__(self, data_list):
+        return data_list, self.collate_fn(data_list)
+
+
+def _load_cache(path):
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=False)  # tensors are only read when used
+    except TypeError:  # torch < 2.1
+        return torch.load(path, map_location='cpu')
+
+
+class CachedBatchLoader(object):
+    """
+    Evaluation loader that materializes its batches during the first pass, later passes iterate them directly instead of running `__getitem__`
+    (deepcopy, transforms) and the collate function again. Batches whose samples are all deterministic are cached collated, the other batches keep
+    their deterministic samples and only recompute the rest.
+    Args:
+        loader:         DataLoader with a sequential sampler (shuffle=False), its batches are in the order of `loader.batch_sampler`.
+        deterministic:  Maps a dataset index to whether the sample is a pure function of the index (see `SkempiABbindDataset.is_deterministic`).
+        path:           File of the cache, written after the first pass and loaded memory-mapped by later runs. None keeps it in memory.
+    """
+
+    def __init__(self, loader, deterministic, path=None):
+        super().__init__()
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.collate_fn = loader.collate_fn
+        self.num_workers = loader.num_workers
+        self.batch_indices = list(loader.batch_sampler)
+        self.deterministic = [deterministic(i) for i in range(len(self.dataset))]
+        self.path = path
+        self.batches = _load_cache(path) if path is not None and os.path.exists(path) else None
+
+    def __len__(self):
+        return len(self.batch_indices)
+
+    def __iter__(self):
+        if self.batches is None:
+            return self._materialize()
+        return self._iter_cached()
+
+    def _materialize(self):
+        loader = DataLoader(self.dataset, batch_sampler=self.batch_indices, collate_fn=_SampleCollate(self.collate_fn), num_workers=self.num_workers)
+        batches = []
+        for indices, (data_list, batch) in zip(self.batch_indices, loader):
+            if all(self.deterministic[i] for i in indices):
+                batches.append(batch)
+            else:
+                batches.append([data if self.deterministic[i] else None for i, data in zip(indices, data_list)])
+            yield dict(batch)  # models add and replace keys of the batch, not of the cached one
+        self.batches = batches  # only complete passes are cached
+        if self.path is not None:
+            atomic_save(batches, self.path)
+
+    def _iter_cached(self):
+        missing = [i for indices, cached in zip(self.batch_indices, self.batches) if not isinstance(cached, dict) for i, data in zip(indices, cached) if data is None]
+        if self.num_workers > 0 and len(missing) > 0:
+            recomputed = iter(DataLoader(Subset(self.dataset, missing), batch_size=None, collate_fn=_identity, num_workers=self.num_workers))
+        else:
+            recomputed = (self.dataset[i] for i in missing)
+        for cached in self.batches:
+            if isinstance(cached, dict):
+                yield dict(cached)
+            else:
+                yield self.collate_fn([data if data is not None else next(recomputed) for data in cached])
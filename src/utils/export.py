@@ -0,0 +1,132 @@
+import json
+
+import torch
+import torch.nn as nn
+
+# Inputs available at deployment, refinement models build the refined span from `mut_flag` and use `pos_atoms` as the wild type (no ground truth)
+EXPORT_KEYS = ('aa', 'aa_mut', 'mut_flag', 'res_nb', 'chain_nb', 'pos_atoms', 'mask_atoms', 'type_atoms', 'phi', 'phi_mask', 'psi', 'psi_mask', 'chi', 'chi_mask')
+
+
+class _ExportEnsemble(nn.Module):
+    """Positional tensor inputs to the (mean, std, folds) predictions of every fold, the graph that is traced."""
+
+    def __init__(self, cv_mgr, keys):
+        super().__init__()
+        from src.utils.train import EnsemblePredictor
+        self.models = nn.ModuleList(cv_mgr.models)
+        self.keys = list(keys)
+        self.predictor = EnsemblePredictor(cv_mgr)
+
+    def forward(self, *inputs):
+        batch = dict(zip(self.keys, inputs))
+        batch['ddG'] = torch.zeros(batch['aa'].size(0), device=batch['aa'].device)  # only read by the losses
+        out = self.predictor.predict(batch)
+        return out['ddG_pred'], out['ddG_pred_std'], out['ddG_pred_folds']
+
+
+def pad_batch(batch, keys, batch_size, patch_size, pad_values):
+    """Pads the samples of a collated batch to `patch_size` residues and repeats the last sample up to `batch_size`, the fixed input signature of an exported model."""
+    n, L = batch['aa'].shape[:2]
+    assert n <= batch_size and L <= patch_size, 'batch (%d, %d) exceeds the exported input signature (%d, %d)' % (n, L, batch_size, patch_size)
+    inputs = []
+    for k in keys:
+        v = batch[k]
+        if L < patch_size:
+            pad = torch.full([n, patch_size - L] + list(v.shape[2:]), fill_value=pad_values.get(k, 0)).to(v)
+            v = torch.cat([v, pad], dim=1)
+        if n < batch_size:
+            v = torch.cat([v, v[-1:].expand(batch_size - n, *v.shape[1:])], dim=0)
+        inputs.append(v.contiguous())
+    return inputs
+
+
+def export_ensemble(cv_mgr, example_batch, path, fmt='torchscript', batch_size=None, patch_size=None):
+    """
+    Freezes every fold of `cv_mgr` and the frozen pretrained encoder into a single artifact with a fixed (batch_size, patch_size) input signature.
+    Folds fine-tuned from the same pretrained encoder store it once. Data-dependent shortcuts (patched mutant pair features, incremental recycles,
+    subgraph refinement) are replaced by their full computation while tracing, adaptive recycling must be disabled.
+    Args:
+        example_batch:  Collated batch used for tracing, also defines the input keys.
+        fmt:            'torchscript' (`*.pt`) or 'onnx' (`*.onnx`, requires onnx).
+    Returns:
+        Metadata stored with the artifact.
+    """
+    from src.utils.data import DEFAULT_PAD_VALUES
+    from src.utils.train import EnsemblePredictor
+    assert all(getattr(m, 'recycle_tol', None) is None for m in cv_mgr.models), 'adaptive recycling cannot be exported, set recycle_tol to None'
+    for model in cv_mgr.models:
+        model.eval()
+    if EnsemblePredictor._same_pretrained(cv_mgr.models):
+        for model in cv_mgr.models[1:]:
+            model.rde = cv_mgr.models[0].rde
+
+    keys = [k for k in EXPORT_KEYS if k in example_batch]
+    batch_size = example_batch['aa'].size(0) if batch_size is None else batch_size
+    patch_size = example_batch['aa'].size(1) if patch_size is None else patch_size
+    pad_values = {k: v for k, v in DEFAULT_PAD_VALUES.items() if k in keys}
+    inputs = tuple(pad_batch(example_batch, keys, batch_size, patch_size, pad_values))
+    module = _ExportEnsemble(cv_mgr, keys).eval()
+    meta = {'format': fmt, 'keys': keys, 'dtypes': [str(v.dtype).replace('torch.', '') for v in inputs], 'shapes': [list(v.shape) for v in inputs],
+            'batch_size': batch_size, 'patch_size': patch_size, 'pad_values': pad_values, 'num_cvfolds': cv_mgr.num_cvfolds,
+            'model': type(cv_mgr.models[0]).__module__ + '.' + type(cv_mgr.models[0]).__name__, 'outputs': ['ddG_pred', 'ddG_pred_std', 'ddG_pred_folds']}
+
+    with torch.no_grad():
+        if fmt == 'torchscript':
+            traced = torch.jit.trace(module, inputs, check_trace=False)
+            traced = torch.jit.freeze(traced)
+            torch.jit.save(traced, path, _extra_files={'meta.json': json.dumps(meta)})
+        elif fmt == 'onnx':
+            import onnx
+            torch.onnx.export(module, inputs, path, input_names=keys, output_names=meta['outputs'], opset_version=17)
+            model_proto = onnx.load(path)
+            entry = model_proto.metadata_props.add()
+            entry.key, entry.value = 'meta.json', json.dumps(meta)
+            onnx.save(model_proto, path)
+        else:
+            raise NotImplementedError('Export format not supported: %s' % fmt)
+    return meta
+
+
+class ExportedPredictor(object):
+    """
+    Runtime of an exported ensemble, only requires torch (TorchScript) or onnxruntime (ONNX). Returns the same dict as `EnsemblePredictor`.
+    Batches with fewer samples or residues than the input signature are padded, larger batches are split. As in the eager model, predictions depend
+    on the padding (the readout pools over every residue), they equal those of the eager model on the batch padded to `patch_size`.
+    """
+
+    def __init__(self, path, device='cpu'):
+        super().__init__()
+        self.device = device
+        if path.endswith('.onnx'):
+            import onnxruntime
+            self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+            self.meta = json.loads(self.session.get_modelmeta().custom_metadata_map['meta.json'])
+            self.module = None
+        else:
+            extra_files = {'meta.json': ''}
+            self.module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+            self.meta = json.loads(extra_files['meta.json'])
+            self.session = None
+        self.keys, self.batch_size, self.patch_size = self.meta['keys'], self.meta['batch_size'], self.meta['patch_size']
+        self.dtypes = [getattr(torch, d) for d in self.meta['dtypes']]
+
+    def _run(self, inputs):
+        if self.module is not None:
+            with torch.no_grad():
+                return [o.cpu() for o in self.module(*[v.to(self.device) for v in inputs])]
+        return [torch.from_numpy(o) for o in self.session.run(None, {k: v.cpu().numpy() for k, v in zip(self.keys, inputs)})]
+
+    def __call__(self, batch):
+        n = batch['aa'].size(0)
+        outputs = []
+        for i in range(0, n, self.batch_size):
+            chunk = {k: batch[k][i:i + self.batch_size] for k in self.keys}
+            inputs = [v.to(dtype) for v, dtype in zip(pad_batch(chunk, self.keys, self.batch_size, self.patch_size, self.meta['pad_values']), self.dtypes)]
+            m = chunk['aa'].size(0)
+            ddG_pred, ddG_std, ddG_folds = self._run(inputs)
+            outputs.append((ddG_pred[:m], ddG_std[:m], ddG_folds[:, :m]))
+        return {'ddG_pred': torch.cat([o[0] for o in outputs]), 'ddG_pred_std': torch.cat([o[1] for o in outputs]), 'ddG_pred_folds': torch.cat([o[2] for o in outputs], dim=1)}
+
+
+def load_exported(path, device='cpu'):
+    return ExportedPredictor(path, device=device)
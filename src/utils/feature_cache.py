@@ -0,0 +1,134 @@
+import hashlib
+import os
+
+import torch
+from tqdm.auto import tqdm
+
+from src.utils.data import DEFAULT_PAD_VALUES
+from src.utils.misc import BlackHole
+from src.utils.train import recursive_to
+from src.utils.transforms import has_stochastic_transform
+
+
+def checkpoint_hash(path, chunk_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()[:16]
+
+
+def _pad_batch(batch, n):
+    """Append `n` padding residues to every per-residue tensor of a collated batch."""
+    B, L = batch['aa'].shape[:2]
+    batch_padded = {}
+    for k, v in batch.items():
+        if isinstance(v, torch.Tensor) and v.dim() >= 2 and v.shape[:2] == (B, L):
+            pad = torch.full([B, n] + list(v.shape[2:]), fill_value=False if k == 'mask' else DEFAULT_PAD_VALUES.get(k, 0)).to(v)
+            v = torch.cat([v, pad], dim=1)
+        batch_padded[k] = v
+    return batch_padded
+
+
+class PretrainedFeatureCache(object):
+    """
+    Per-residue outputs of a frozen pretrained encoder, keyed by (entry id, patch residues, checkpoint hash).
+    Only valid when the encoder input is a pure function of the entry, i.e. no stochastic transforms and no dropout in the pretrained encoder.
+    """
+
+    def __init__(self, checkpoint_path, cache_dir=None):
+        super().__init__()
+        self.checkpoint_hash = checkpoint_hash(checkpoint_path)
+        self.cache_dir = os.path.join(cache_dir, self.checkpoint_hash) if cache_dir is not None else None
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.memory = {}  # only used without cache_dir
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def sample_keys(batch, tag):
+        if 'id' not in batch or 'mask' not in batch:
+            return None
+        keys = []
+        for i, n in enumerate(batch['mask'].sum(dim=1).tolist()):
+            residues = torch.stack([batch['chain_nb'][i, :n], batch['res_nb'][i, :n], batch['aa'][i, :n]]).cpu().numpy().tobytes()  # patch indices and sequence
+            entry = '%s:%d' % (batch['pdbcode'][i] if 'pdbcode' in batch else '', int(batch['id'][i]))
+            keys.append('%s:%s:%s' % (entry, tag, hashlib.sha1(residues).hexdigest()))
+        return keys
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.pt')
+
+    def get(self, key):
+        if self.cache_dir is None:
+            return self.memory.get(key, None)
+        path = self._path(key)
+        return torch.load(path, map_location='cpu') if os.path.exists(path) else None
+
+    def put(self, key, feat):
+        feat = feat.detach().cpu()
+        if self.cache_dir is None:
+            self.memory[key] = feat
+        else:
+            path = self._path(key)
+            torch.save(feat, path + '.tmp')
+            os.replace(path + '.tmp', path)  # atomic, readers never see a partial file
+
+    def __len__(self):
+        if self.cache_dir is None:
+            return len(self.memory)
+        return len([f for f in os.listdir(self.cache_dir) if f.endswith('.pt')])
+
+    def __call__(self, encode_fn, batch, tag):
+        """
+        Args:
+            encode_fn:  Maps a collated batch to per-residue features, (N, L, F).
+            batch:      Collated batch with `id` and `mask`, otherwise the cache is bypassed.
+            tag:        Distinguishes the inputs built from the same entry, e.g. 'wt' and 'mut'.
+        Returns:
+            (N, L, F), equal to `encode_fn(batch)` on valid residues. Padding residues reuse one feature vector per sample.
+        """
+        keys = self.sample_keys(batch, tag)
+        if keys is None:
+            return encode_fn(batch)
+        lengths = batch['mask'].sum(dim=1).tolist()
+        cached = [self.get(k) for k in keys]
+        missing = [i for i, c in enumerate(cached) if c is None]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if len(missing) > 0:
+            feat = encode_fn(_pad_batch(batch, 1))  # one extra padding residue, so that every sample has a padding feature
+            for i in missing:
+                cached[i] = feat[i, :lengths[i] + 1].detach()
+                self.put(keys[i], cached[i])
+
+        L, device = batch['aa'].size(1), batch['aa'].device
+        feat = [torch.cat([c[:n], c[n:n + 1].expand(L - n, -1)], dim=0) for c, n in zip(cached, lengths)]
+        return torch.stack(feat, dim=0).to(device)
+
+    def prefill(self, model, loader, device):
+        """One pass over `loader`, the model stores the features of every cacheable pretrained encoder call."""
+        training = model.training
+        model.eval()
+        with torch.no_grad():
+            for batch in tqdm(loader, desc='Prefill', dynamic_ncols=True):
+                model(recursive_to(batch, device))
+        model.train(training)
+
+
+def get_feature_cache(config, mode, logger=BlackHole()):
+    """
+    Args:
+        mode:   None, 'memory' or 'disk'. Disk caches are stored under `config.data.cache_dir` and shared across runs with the same checkpoint.
+    """
+    if mode is None or not config.model.checkpoint.path:
+        return None
+    if has_stochastic_transform(config.data.transform):
+        logger.info('Pretrained feature cache bypassed: stochastic transforms are active.')
+        return None
+    if mode == 'memory':
+        return PretrainedFeatureCache(config.model.checkpoint.path)
+    elif mode == 'disk':
+        return PretrainedFeatureCache(config.model.checkpoint.path, cache_dir=os.path.join(config.data.cache_dir, 'pretrained_features'))
+    else:
+        raise NotImplementedError('Feature cache mode not supported: %s' % mode)
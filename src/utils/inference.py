@@ -0,0 +1,258 @@
+import csv
+import json
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import torch
+from Bio.PDB.Polypeptide import index_to_one, one_to_index
+from torch.utils.data import Dataset
+
+from src.models import get_ddg_model
+from src.utils.protein.parsers import load_structure
+from src.utils.train import CrossValidation
+from src.utils.transforms import Compose, SelectAtom, SelectedRegionFixedSizePatch
+
+
+def load_ensemble(checkpoint, device='cpu'):
+    """The `CrossValidation` of a ddG checkpoint, the model class is inferred from the model config."""
+    ckpt = torch.load(checkpoint, map_location='cpu')
+    cv_mgr = CrossValidation(model_factory=get_ddg_model(ckpt['config'].model), config=ckpt['config'], num_cvfolds=len(ckpt['model']['models']))
+    cv_mgr.load_state_dict(ckpt['model'])
+    return cv_mgr.to(device)
+
+
+def parse_mutations(mutations, seq_map):
+    """
+    Args:
+        mutations:  Mutation strings such as `TI17R` (wild type, chain, residue number, mutant), `*` as mutant expands to the 19 substitutions.
+        seq_map:    Residue keys (chain, resseq, icode) to indices. Mutations at missing residues are skipped.
+    """
+    parsed = []
+    for m in mutations:
+        wt, ch, mt = m[0], m[1], m[-1]
+        seq = int(m[2:-1])
+        pos = (ch, seq, ' ')
+        if pos not in seq_map: continue
+
+        if mt == '*':
+            for mt_idx in range(20):
+                mt = index_to_one(mt_idx)
+                if mt == wt: continue
+                parsed.append({'position': pos, 'wt': wt, 'mt': mt, })
+        else:
+            parsed.append({'position': pos, 'wt': wt, 'mt': mt, })
+    return parsed
+
+
+def mutant_sample(data, seq_map, mut, transform):
+    """A sample of the mutation `mut` (see `parse_mutations`) of the parsed structure `data`, which is not modified."""
+    data = {k: v for k, v in data.items()}  # the transforms do not modify their input
+    mut_pos_idx = seq_map[mut['position']]
+    data['mut_flag'] = torch.zeros(size=data['aa'].shape, dtype=torch.bool)
+    data['mut_flag'][mut_pos_idx] = True
+    data['aa_mut'] = data['aa'].clone()
+    data['aa_mut'][mut_pos_idx] = one_to_index(mut['mt'])
+    data = transform(data)
+    data['ddG'] = 0
+    data['mutstr'] = '{}{}{}{}'.format(mut['wt'], mut['position'][0], mut['position'][1], mut['mt'])
+    return data
+
+
+class PMDataset(Dataset):
+    """Samples of the `mutations` (see `parse_mutations`) of a single structure, as in `infer.py`."""
+
+    def __init__(self, pdb_path, mutations):
+        super().__init__()
+        self.pdb_path = pdb_path
+
+        self.data = None
+        self.seq_map = None
+        self._load_structure()
+
+        self.mutations = parse_mutations(mutations, self.seq_map)
+        self.transform = Compose([SelectAtom('backbone+CB'), SelectedRegionFixedSizePatch('mut_flag', 128)])
+
+    def _load_structure(self):
+        self.data, self.seq_map = load_structure(self.pdb_path)
+
+    def __len__(self):
+        return len(self.mutations)
+
+    def __getitem__(self, index):
+        return mutant_sample(self.data, self.seq_map, self.mutations[index], self.transform)
+
+
+def iter_manifest(path):
+    """
+    Streams the (structure path, mutations) records of a manifest, relative structure paths are resolved against the manifest directory.
+    JSONL: one object per line, e.g. `{"pdb": "1abc.pdb", "mutations": ["TI17R", "KA5*"]}`, mutations may also be a comma separated string.
+    CSV:   columns `pdb` and `mutations`, mutations separated by commas, semicolons or spaces.
+    """
+    root = os.path.dirname(os.path.abspath(path))
+
+    def _record(pdb, mutations):
+        if isinstance(mutations, str):
+            mutations = [m for m in re.split(r'[,;\s]+', mutations) if m]
+        return {'pdb': pdb, 'path': os.path.join(root, pdb), 'mutations': list(mutations)}
+
+    with open(path, 'r') as f:
+        if path.endswith('.jsonl') or path.endswith('.json'):
+            for line in f:
+                if not line.strip(): continue
+                record = json.loads(line)
+                yield _record(record['pdb'], record['mutations'])
+        elif path.endswith('.csv'):
+            for row in csv.DictReader(f):
+                yield _record(row['pdb'], row['mutations'])
+        else:
+            raise NotImplementedError('Manifest format not supported: %s' % path)
+
+
+def _parse_structure(path, transform=None):
+    data, seq_map = load_structure(path)
+    if data is not None and transform is not None:
+        data = transform(data)
+    return data, seq_map
+
+
+class StructureCache(object):
+    """
+    LRU cache of parsed structures. Structures are parsed in a process pool, `prefetch` schedules the parsing ahead of `get`.
+    Args:
+        capacity:       Maximum number of structures held, parsed or pending. Should exceed the number of prefetched structures.
+        num_workers:    Parser processes, 0 parses in the calling process.
+        transform:      Applied to each parsed structure in the worker, e.g. `SelectAtom` to keep only the atoms used by the model.
+    """
+
+    def __init__(self, capacity=32, num_workers=4, transform=None):
+        super().__init__()
+        self.capacity = capacity
+        self.transform = transform
+        self.executor = ProcessPoolExecutor(max_workers=num_workers) if num_workers > 0 else None
+        self.entries = OrderedDict()  # path -> Future or (data, seq_map)
+
+    def prefetch(self, path):
+        if path in self.entries:
+            self.entries.move_to_end(path)
+            return
+        if self.executor is not None:
+            self.entries[path] = self.executor.submit(_parse_structure, path, self.transform)
+        else:
+            self.entries[path] = None  # parsed lazily in `get`
+        while len(self.entries) > self.capacity:
+            _, evicted = self.entries.popitem(last=False)
+            if evicted is not None and not isinstance(evicted, tuple):
+                evicted.cancel()
+
+    def get(self, path):
+        """Returns (data, seq_map), or raises the parsing error."""
+        self.prefetch(path)
+        entry = self.entries[path]
+        if entry is None:
+            entry = _parse_structure(path, self.transform)
+        elif not isinstance(entry, tuple):
+            try:
+                entry = entry.result()
+            except Exception:
+                del self.entries[path]
+                raise
+        self.entries[path] = entry
+        return entry
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        self.entries.clear()
+
+
+class LengthBucketBatcher(object):
+    """Groups samples of similar length, so that batches mixing structures are padded as little as possible."""
+
+    def __init__(self, batch_size, collate_fn, length_ref_key='aa', multiple=8):
+        super().__init__()
+        self.batch_size = batch_size
+        self.collate_fn = collate_fn
+        self.length_ref_key = length_ref_key
+        self.multiple = multiple  # same as the padding of `PaddingCollate`
+        self.buckets = {}
+
+    def add(self, sample):
+        """Returns a collated batch once the bucket of `sample` is full, otherwise None."""
+        length = sample[self.length_ref_key].size(0)
+        key = (length + self.multiple - 1) // self.multiple
+        bucket = self.buckets.setdefault(key, [])
+        bucket.append(sample)
+        if len(bucket) < self.batch_size:
+            return None
+        del self.buckets[key]
+        return self.collate_fn(bucket)
+
+    def flush(self):
+        """Collated batches of the remaining samples."""
+        for key in sorted(self.buckets.keys()):
+            yield self.collate_fn(self.buckets[key])
+        self.buckets = {}
+
+
+class ResultWriter(object):
+    """
+    Appends result rows to a CSV file or a Parquet dataset, so that partial results survive an interruption.
+    Parquet files cannot be appended to, `*.parquet` paths are directories of part files each written atomically (requires pyarrow).
+    """
+
+    def __init__(self, path, buffer_size=256):
+        super().__init__()
+        self.path = path
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.parquet = path.endswith('.parquet')
+        if self.parquet:
+            import pyarrow  # noqa: F401, fail before any prediction
+            os.makedirs(path, exist_ok=True)
+        elif not path.endswith('.csv'):
+            raise NotImplementedError('Output format not supported: %s' % path)
+
+    def _parts(self):
+        return sorted(f for f in os.listdir(self.path) if f.startswith('part-') and f.endswith('.parquet'))
+
+    def read(self):
+        if self.parquet:
+            parts = self._parts()
+            return pd.concat([pd.read_parquet(os.path.join(self.path, f)) for f in parts], ignore_index=True) if parts else pd.DataFrame()
+        return pd.read_csv(self.path) if os.path.exists(self.path) and os.path.getsize(self.path) > 0 else pd.DataFrame()
+
+    def done_keys(self, columns=('pdb', 'mutstr')):
+        """Keys of the rows already written, to resume an interrupted run."""
+        result = self.read()
+        if len(result) == 0:
+            return set()
+        return set(zip(*[result[c].astype(str) for c in columns]))
+
+    def write(self, rows):
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        df = pd.DataFrame(self.buffer)
+        if self.parquet:
+            parts = self._parts()
+            index = int(parts[-1][len('part-'):-len('.parquet')]) + 1 if parts else 0
+            path = os.path.join(self.path, 'part-%05d.parquet' % index)
+            df.to_parquet(path + '.tmp', index=False)
+            os.replace(path + '.tmp', path)  # atomic, readers never see a partial file
+        else:
+            new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            with open(self.path, 'a') as f:
+                df.to_csv(f, header=new_file, index=False)
+                f.flush()
+                os.fsync(f.fileno())
+        self.buffer = []
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,102 @@
+import time
+
+import pandas as pd
+import torch
+from Bio.PDB.Polypeptide import index_to_one
+from tqdm.auto import tqdm
+
+from src.utils.data import PaddingCollate
+from src.utils.protein.constants import BBHeavyAtom
+from src.utils.protein.parsers import load_structure
+from src.utils.train import EnsemblePredictor, recursive_to
+from src.utils.transforms import SelectAtom, SelectedRegionFixedSizePatch
+from src.utils.transforms._base import _get_CB_positions
+
+
+class SaturationMutagenesis(object):
+    """
+    Predicts the ddG of every substitution at the scanned positions of a structure with all folds of a `CrossValidation`.
+    The patch and the wild-type encoding are computed once per position, the 19 mutants of each position are encoded in one batch.
+    """
+
+    def __init__(self, cv_mgr, pdb_path, resolution='backbone+CB', patch_size=128, device='cuda'):
+        super().__init__()
+        self.predictor = EnsemblePredictor(cv_mgr)
+        data, self.seq_map = load_structure(pdb_path)
+        self.data = SelectAtom(resolution)(data)
+        self.patch = SelectedRegionFixedSizePatch('mut_flag', patch_size)
+        self.collate = PaddingCollate()
+        self.device = device
+        self.throughput = None  # mutations/sec of the last scan
+
+    def _position(self, i):
+        return self.data['chain_id'][i], int(self.data['resseq'][i]), self.data['icode'][i]
+
+    def parse_positions(self, specs):
+        """Positions from mutation strings such as `TI17` or `TI17*` (wild type, chain, residue number), missing residues are skipped."""
+        positions = []
+        for m in specs:
+            m = m.rstrip('*')
+            pos = (m[1], int(m[2:]), ' ')
+            if pos in self.seq_map:
+                positions.append(pos)
+        return positions
+
+    def interface_positions(self, cutoff=8.0, chains=None):
+        """
+        Residues whose CB is within `cutoff` of a residue on the other side of the interface.
+        Args:
+            chains: Chains on one side, e.g. 'HL'. By default every other chain is the other side.
+        """
+        pos_CB = _get_CB_positions(self.data['pos_atoms'], self.data['mask_atoms'])  # (L, 3)
+        chain_nb = self.data['chain_nb']
+        if chains is None:
+            other_side = chain_nb[:, None] != chain_nb[None, :]  # (L, L)
+        else:
+            side = torch.BoolTensor([ch in chains for ch in self.data['chain_id']])
+            other_side = side[:, None] != side[None, :]
+        mask_residue = self.data['mask_atoms'][:, BBHeavyAtom.CA]
+        contact = (torch.cdist(pos_CB, pos_CB) < cutoff) & other_side & mask_residue[None, :]
+        return [self._position(i) for i in torch.nonzero(contact.any(dim=1) & mask_residue)[:, 0].tolist()]
+
+    def _patch(self, index):
+        data = {k: v for k, v in self.data.items()}  # the patch transform does not modify its input
+        data['mut_flag'] = torch.zeros(size=data['aa'].shape, dtype=torch.bool)
+        data['mut_flag'][index] = True
+        return self.patch(data)
+
+    @staticmethod
+    def _mutants(batch):
+        """All substitutions of the mutated residue of each wild type, (M, L) sequences, (M, ) wild-type indices, (M, ) residue indices and (M, ) amino acids."""
+        N = batch['aa'].size(0)
+        res_index = batch['mut_flag'].float().argmax(dim=1)  # (N, )
+        aa_wt = batch['aa'][torch.arange(N), res_index]
+        aa = torch.arange(20, device=aa_wt.device)[None, :].expand(N, 20)
+        wt_index, aa_mt = torch.nonzero(aa != aa_wt[:, None], as_tuple=True)  # 19 per position (20 for non-standard wild types)
+        aa_mut = batch['aa'][wt_index].clone()
+        aa_mut[torch.arange(len(wt_index)), res_index[wt_index]] = aa_mt
+        return aa_mut, wt_index, res_index[wt_index], aa_mt
+
+    def scan(self, positions, batch_size=4):
+        """
+        Args:
+            positions:  Residue keys (chain, resseq, icode).
+            batch_size: Number of positions encoded together.
+        Returns:
+            DataFrame with one row per mutation.
+        """
+        result = []
+        time_start = time.time()
+        for i in tqdm(range(0, len(positions), batch_size), desc='Scan', dynamic_ncols=True):
+            batch = self.collate([self._patch(self.seq_map[p]) for p in positions[i:i + batch_size]])
+            batch = recursive_to(batch, self.device)
+            aa_mut, wt_index, res_index, aa_mt = self._mutants(batch)
+            out_dict = self.predictor.scan(batch, aa_mut, wt_index)
+
+            aa_wt = batch['aa'][wt_index, res_index]
+            for n, (w, a, ddG_pred, ddG_std) in enumerate(zip(wt_index.tolist(), aa_mt.tolist(), out_dict['ddG_pred'].cpu().tolist(), out_dict['ddG_pred_std'].cpu().tolist())):
+                ch, resseq, icode = positions[i + w]
+                wt = index_to_one(aa_wt[n].item()) if aa_wt[n].item() < 20 else 'X'
+                result.append({'mutstr': '{}{}{}{}{}'.format(wt, ch, resseq, icode.strip(), index_to_one(a)), 'ddG_pred': ddG_pred, 'ddG_pred_std': ddG_std, })
+        self.throughput = len(result) / max(time.time() - time_start, 1e-6)
+        return pd.DataFrame(result)
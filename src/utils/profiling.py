@@ -0,0 +1,188 @@
+import collections
+import contextlib
+import json
+import signal
+import threading
+import time
+
+import torch
+
+# Submodule attribute -> stage, shared by the ddG and pretraining models
+MODEL_STAGES = {'rde': 'pretrained', 'single_encoder': 'encode_single', 'pair_encoder': 'encode_pair', 'attn_encoder': 'ga_blocks', 'spatial_project': 'egnn_refine',
+                'ddg_readout': 'readout', 'angle_predictor': 'readout', }
+
+
+class _Frame(object):
+
+    def __init__(self, name, record_function):
+        self.name = name
+        self.record_function = record_function
+        self.start = time.perf_counter()
+        self.peak = 0
+
+
+class StageTimer(object):
+    """
+    Named wall-clock timers and counters of a training loop. Stages nest (e.g. 'ga_blocks' within 'forward'), appear in `torch.profiler` traces under their name
+    and record the peak CUDA memory allocated while they run.
+    Args:
+        device:     Device of the timed work, CUDA memory is only tracked on CUDA devices.
+        sync:       Synchronize the device at stage boundaries, otherwise CUDA stages only measure the kernel launches.
+    """
+
+    def __init__(self, device='cpu', sync=False):
+        super().__init__()
+        self.device = torch.device(device)
+        self.cuda = self.device.type == 'cuda' and torch.cuda.is_available()
+        self.sync = sync and self.cuda
+        self.stack = []
+        self.iteration = collections.defaultdict(float)  # stage -> seconds, since the last `step`
+        self.iteration_peak = collections.defaultdict(float)  # stage -> MB, since the last `step`
+        self.totals = collections.defaultdict(lambda: {'calls': 0, 'total_s': 0.0, 'max_ms': 0.0, 'peak_mem_mb': 0.0})
+        self.counters = collections.defaultdict(float)
+        self.num_steps = 0
+        self.time_start = time.perf_counter()
+        self.instrumented = set()
+
+    def _enter(self, name):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        if self.cuda:  # the peak so far belongs to the enclosing stages
+            peak = torch.cuda.max_memory_allocated(self.device)
+            for frame in self.stack:
+                frame.peak = max(frame.peak, peak)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        record_function = torch.profiler.record_function(name)
+        record_function.__enter__()
+        self.stack.append(_Frame(name, record_function))
+
+    def _exit(self, name):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        frame = self.stack.pop()
+        assert frame.name == name, 'Stage %s closed within %s' % (name, frame.name)
+        elapsed = time.perf_counter() - frame.start
+        frame.record_function.__exit__(None, None, None)
+        stats = self.totals[name]
+        stats['calls'] += 1
+        stats['total_s'] += elapsed
+        stats['max_ms'] = max(stats['max_ms'], elapsed * 1000)
+        self.iteration[name] += elapsed
+        if self.cuda:
+            frame.peak = max(frame.peak, torch.cuda.max_memory_allocated(self.device))
+            self.iteration_peak[name] = max(self.iteration_peak[name], frame.peak / 2 ** 20)
+            stats['peak_mem_mb'] = max(stats['peak_mem_mb'], frame.peak / 2 ** 20)
+            if self.stack:
+                self.stack[-1].peak = max(self.stack[-1].peak, frame.peak)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        self._enter(name)
+        try:
+            yield
+        finally:
+            self._exit(name)
+
+    def count(self, name, n=1):
+        self.counters[name] += float(n)
+
+    def instrument(self, model, stages=MODEL_STAGES):
+        """
+        Times the submodules of `model` named in `stages` with forward hooks. Only calls within a stage of the loop (e.g. 'forward') are recorded, not validation.
+        Modules shared by several models (the pretrained model of the folds) are instrumented once.
+        """
+        handles = []
+        for attr, name in stages.items():
+            module = getattr(model, attr, None)
+            if not isinstance(module, torch.nn.Module) or id(module) in self.instrumented:
+                continue
+            self.instrumented.add(id(module))
+
+            def pre_hook(module, inputs, name=name):
+                module._stage_recorded = len(self.stack) > 0
+                if module._stage_recorded:
+                    self._enter(name)
+
+            def hook(module, inputs, outputs, name=name):
+                if module._stage_recorded:
+                    self._exit(name)
+
+            handles += [module.register_forward_pre_hook(pre_hook), module.register_forward_hook(hook)]
+        return handles
+
+    def last(self, name):
+        """Seconds spent in `name` since the last `step`."""
+        return self.iteration.get(name, 0.0)
+
+    def step(self, it, writer=None):
+        """Closes the iteration `it`, writes its stage times (seconds) and peak memory (MB) to TensorBoard."""
+        if writer is not None:
+            for name, seconds in self.iteration.items():
+                writer.add_scalar('time/%s' % name, seconds, it)
+            for name, mb in self.iteration_peak.items():
+                writer.add_scalar('memory/%s' % name, mb, it)
+        self.iteration = collections.defaultdict(float)
+        self.iteration_peak = collections.defaultdict(float)
+        self.num_steps += 1
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.time_start
+        stages = {}
+        for name, stats in self.totals.items():
+            stages[name] = {**stats, 'mean_ms': stats['total_s'] * 1000 / stats['calls'], 'per_iter_ms': stats['total_s'] * 1000 / max(self.num_steps, 1),
+                            'fraction': stats['total_s'] / elapsed}
+            if not self.cuda:
+                del stages[name]['peak_mem_mb']
+        counters = {name: {'total': n, 'per_s': n / elapsed} for name, n in self.counters.items()}
+        return {'iterations': self.num_steps, 'elapsed_s': elapsed, 'stages': stages, 'counters': counters}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+class ProfilerTrigger(object):
+    """
+    Records one `torch.profiler` schedule cycle (wait, warmup, active iterations), from the first iteration with `enabled`, or from the next iteration after the
+    process receives `signum` (e.g. `kill -USR1 <pid>` on a running job). Each signal records a new cycle.
+    Args:
+        on_trace_ready: Trace handler, e.g. `torch.profiler.tensorboard_trace_handler(log_dir)`.
+    """
+
+    def __init__(self, on_trace_ready, wait=5, warmup=2, active=5, enabled=False, signum=getattr(signal, 'SIGUSR1', None), logger=None):
+        super().__init__()
+        self.on_trace_ready = on_trace_ready
+        self.wait, self.warmup, self.active = wait, warmup, active
+        self.requested = enabled
+        self.logger = logger
+        self.profiler = None
+        self.num_steps = 0
+        if signum is not None and threading.current_thread() is threading.main_thread():  # handlers can only be installed from the main thread
+            signal.signal(signum, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        self.requested = True  # the profiler is started between iterations
+
+    def step(self):
+        """Called once per training iteration."""
+        if self.profiler is not None:
+            self.profiler.step()
+            self.num_steps += 1
+            if self.num_steps >= self.wait + self.warmup + self.active:
+                self.close()
+        elif self.requested:
+            self.requested = False
+            activities = [torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+            self.profiler = torch.profiler.profile(activities=activities, schedule=torch.profiler.schedule(wait=self.wait, warmup=self.warmup, active=self.active, repeat=1),
+                                                  on_trace_ready=self.on_trace_ready, record_shapes=True, profile_memory=True)
+            self.profiler.start()
+            self.num_steps = 0
+            if self.logger is not None:
+                self.logger.info('Profiling the next %d iterations' % (self.wait + self.warmup + self.active))
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+            if self.logger is not None:
+                self.logger.info('Profiler trace written')
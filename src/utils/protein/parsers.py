@@ -1,6 +1,7 @@
 import torch
 from Bio.PDB import Selection
 from Bio.PDB.MMCIFParser import MMCIFParser
+from Bio.PDB.PDBParser import PDBParser
 from Bio.PDB.Residue import Residue
 from easydict import EasyDict
 
@@ -141,3 +142,22 @@ def parse_biopython_structure(entity, unknown_threshold=1.0, name=None, rmsf=Non
     for key, convert_fn in tensor_types.items():
         data[key] = convert_fn(data[key])
     return data, seq_map
+
+
+def load_structure(path, fmt=None):
+    """
+    Parse the first model of a .pdb or .cif file, returns (data, seq_map).
+    Args:
+        path:   File path or file-like object.
+        fmt:    'pdb' or 'cif', by default the file extension.
+    """
+    if fmt is None:
+        fmt = path.rsplit('.', 1)[-1] if isinstance(path, str) else None
+    if fmt == 'pdb':
+        parser = PDBParser(QUIET=True)
+    elif fmt == 'cif':
+        parser = MMCIFParser(QUIET=True)
+    else:
+        raise ValueError('Unknown file type.')
+    structure = parser.get_structure(None, path)
+    return parse_biopython_structure(structure[0], name=path if isinstance(path, str) else None)
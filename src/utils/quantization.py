@@ -0,0 +1,64 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+
+def _linear_layers(model):
+    return {name: m for name, m in model.named_modules() if isinstance(m, nn.Linear)}
+
+
+def _quantize_linear(linear):
+    return torch.ao.quantization.quantize_dynamic(nn.Sequential(copy.deepcopy(linear)), {nn.Linear}, dtype=torch.qint8)[0]
+
+
+@torch.no_grad()
+def calibrate(model, batches, forward_fn=None):
+    """
+    Sensitivity of every nn.Linear of `model` to int8 quantization, measured on the inputs it receives on the calibration `batches`.
+    Args:
+        forward_fn: Runs the model on a batch, `model(batch)` by default.
+    Returns:
+        Dict of layer name to the relative RMS error of its output when its weights and inputs are quantized.
+    """
+    forward_fn = model if forward_fn is None else forward_fn
+    quantized = {name: _quantize_linear(m).cpu() for name, m in _linear_layers(model).items()}
+    err, ref = {name: 0.0 for name in quantized}, {name: 0.0 for name in quantized}
+
+    def hook(name):
+        def fn(module, inputs, output):
+            output = output.float().cpu()
+            err[name] += ((quantized[name](inputs[0].float().cpu()) - output) ** 2).sum().item()
+            ref[name] += (output ** 2).sum().item()
+        return fn
+
+    handles = [m.register_forward_hook(hook(name)) for name, m in _linear_layers(model).items()]
+    training = model.training
+    model.eval()
+    try:
+        for batch in batches:
+            forward_fn(batch)
+    finally:
+        for h in handles:
+            h.remove()
+        model.train(training)
+    return {name: (err[name] / ref[name]) ** 0.5 if ref[name] > 0 else 0.0 for name in quantized}
+
+
+def shared_linear_layers(models):
+    """Names of the Linear layers that are the same module in every model, e.g. those of the pretrained encoder shared by the folds."""
+    layers = [_linear_layers(m) for m in models]
+    return {name for name, m in layers[0].items() if all(other.get(name) is m for other in layers[1:])}
+
+
+def quantize_dynamic_int8(model, skip=()):
+    """
+    Post-training dynamic quantization for CPU inference: nn.Linear weights are stored in int8 and activations are quantized on the fly at each call.
+    Modifies `model` in place, including the modules it shares with other models: the pretrained encoder of the folds, which is also the process-wide
+    instance of `load_pretrained`. Quantize a deep copy of the folds to keep it in float, its layers are quantized with the first fold and left as they are
+    for the others, so calibrate every fold before quantizing any of them.
+    Args:
+        skip:   Names of the Linear layers kept in float, e.g. the most sensitive ones according to `calibrate`.
+    """
+    qconfig_spec = {name: torch.ao.quantization.default_dynamic_qconfig for name in _linear_layers(model) if name not in skip}
+    return torch.ao.quantization.quantize_dynamic(model.cpu().eval(), qconfig_spec=qconfig_spec, dtype=torch.qint8, inplace=True)
@@ -0,0 +1,260 @@
+import hashlib
+import io
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+import numpy as np
+
+from src.utils.data import PaddingCollate
+from src.utils.inference import mutant_sample, parse_mutations
+from src.utils.protein.parsers import load_structure
+from src.utils.train import EnsemblePredictor, recursive_to
+from src.utils.transforms import SelectAtom, SelectedRegionFixedSizePatch
+
+
+class ServiceMetrics(object):
+    """Counters and latency percentiles over the last `window` requests, safe to update from several threads."""
+
+    def __init__(self, window=1000):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.counters = {'requests': 0, 'errors': 0, 'mutations': 0, 'batches': 0, 'structure_hits': 0, 'structure_misses': 0}
+        self.latency = deque(maxlen=window)  # request latency, ms
+        self.batch_latency = deque(maxlen=window)  # model time per micro-batch, ms
+        self.batch_sizes = deque(maxlen=window)
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def add_request(self, latency_ms, num_mutations):
+        with self.lock:
+            self.counters['requests'] += 1
+            self.counters['mutations'] += num_mutations
+            self.latency.append(latency_ms)
+
+    def add_batch(self, latency_ms, size):
+        with self.lock:
+            self.counters['batches'] += 1
+            self.batch_latency.append(latency_ms)
+            self.batch_sizes.append(size)
+
+    @staticmethod
+    def _percentiles(values):
+        if len(values) == 0:
+            return {}
+        return {'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95)), 'p99': float(np.percentile(values, 99)), 'mean': float(np.mean(values))}
+
+    def summary(self):
+        with self.lock:
+            return {**self.counters, 'uptime_sec': time.time() - self.start_time, 'latency_ms': self._percentiles(list(self.latency)),
+                    'batch_latency_ms': self._percentiles(list(self.batch_latency)), 'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0, }
+
+
+class ContentStructureCache(object):
+    """LRU cache of parsed structures keyed by the hash of the file content, so that edited files are parsed again."""
+
+    def __init__(self, capacity=64, transform=None, metrics=None):
+        super().__init__()
+        self.capacity = capacity
+        self.transform = transform
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # sha1 -> Future of (data, seq_map)
+
+    def get(self, content, fmt):
+        key = '%s:%s' % (fmt, hashlib.sha1(content).hexdigest())
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            else:
+                future = self.entries[key] = Future()  # concurrent requests of the same structure wait for a single parse
+        if self.metrics is not None:
+            self.metrics.add('structure_hits' if entry is not None else 'structure_misses')
+        if entry is not None:
+            return entry.result()
+
+        try:
+            data, seq_map = load_structure(io.StringIO(content.decode()), fmt=fmt)  # outside the lock, different structures are parsed concurrently
+            if data is None:
+                raise ValueError('Structure could not be parsed.')
+            if self.transform is not None:
+                data = self.transform(data)
+            future.set_result((data, seq_map))
+        except Exception as e:
+            with self.lock:
+                self.entries.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self.lock:
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        return data, seq_map
+
+
+class MicroBatcher(object):
+    """
+    Coalesces the samples of concurrent requests into micro-batches, evaluated by a single thread that owns the models.
+    A micro-batch is run once it holds `batch_size` samples or `max_wait_ms` after its first request arrived, whichever comes first.
+    """
+
+    def __init__(self, predictor, device='cpu', batch_size=32, max_wait_ms=10.0, metrics=None):
+        super().__init__()
+        self.predictor = predictor
+        self.device = device
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.metrics = metrics
+        self.collate = PaddingCollate()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, name='micro-batcher', daemon=True)
+        self.thread.start()
+
+    def submit(self, samples):
+        """Returns a future of the list of predictions of `samples`."""
+        future = Future()
+        if len(samples) == 0:
+            future.set_result([])
+        else:
+            self.queue.put((samples, future))
+        return future
+
+    def _loop(self):
+        while True:
+            pending = [self.queue.get()]
+            count = len(pending[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while count < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0: break
+                try:
+                    pending.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                count += len(pending[-1][0])
+            self._run(pending)
+
+    def _run(self, pending):
+        try:
+            results = [[None] * len(samples) for samples, _ in pending]
+            flat = [(r, i, s) for r, (samples, _) in enumerate(pending) for i, s in enumerate(samples)]
+            flat.sort(key=lambda x: x[2]['aa'].size(0))  # similar lengths in the same batch
+            for j in range(0, len(flat), self.batch_size):
+                chunk = flat[j:j + self.batch_size]
+                time_start = time.time()
+                batch = recursive_to(self.collate([s for _, _, s in chunk]), self.device)
+                out_dict = self.predictor.predict(batch)  # no ground truth (`pos_gt`, `pos_change_flag`, `ddG`) in the requests
+                ddG_pred, ddG_std, ddG_folds = out_dict['ddG_pred'].cpu().tolist(), out_dict['ddG_pred_std'].cpu().tolist(), out_dict['ddG_pred_folds'].t().cpu().tolist()
+                for n, (r, i, s) in enumerate(chunk):
+                    results[r][i] = {'mutstr': s['mutstr'], 'ddG_pred': ddG_pred[n], 'ddG_pred_std': ddG_std[n], 'ddG_pred_folds': ddG_folds[n]}
+                if self.metrics is not None:
+                    self.metrics.add_batch((time.time() - time_start) * 1000, len(chunk))
+            for (_, future), result in zip(pending, results):
+                future.set_result(result)
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+
+
+class DDGService(object):
+    """
+    ddG predictions of a fold ensemble for JSON requests, models and parsed structures stay in memory between requests.
+    Request:    {"pdb": path} or {"pdb_text": file content, "format": "pdb" or "cif"}, and {"mutations": ["TI17R", "KA5*", ...]}.
+    Response:   {"results": [{"mutstr", "ddG_pred", "ddG_pred_std", "ddG_pred_folds"}, ...], "latency_ms"}.
+    """
+
+    def __init__(self, cv_mgr, device='cpu', resolution='backbone+CB', patch_size=128, batch_size=32, max_wait_ms=10.0, cache_size=64):
+        super().__init__()
+        self.num_cvfolds = cv_mgr.num_cvfolds
+        self.model_name = type(cv_mgr.models[0]).__module__ + '.' + type(cv_mgr.models[0]).__name__
+        self.metrics = ServiceMetrics()
+        self.structures = ContentStructureCache(cache_size, transform=SelectAtom(resolution), metrics=self.metrics)
+        self.patch = SelectedRegionFixedSizePatch('mut_flag', patch_size)
+        self.batcher = MicroBatcher(EnsemblePredictor(cv_mgr), device=device, batch_size=batch_size, max_wait_ms=max_wait_ms, metrics=self.metrics)
+
+    def predict(self, request):
+        time_start = time.time()
+        if 'pdb_text' in request:
+            content, fmt = request['pdb_text'].encode(), request.get('format', 'pdb')
+        elif 'pdb' in request:
+            with open(request['pdb'], 'rb') as f:
+                content = f.read()
+            fmt = request.get('format', request['pdb'].rsplit('.', 1)[-1])
+        else:
+            raise ValueError('Request has no structure, expected `pdb` or `pdb_text`.')
+        mutations = request.get('mutations', [])
+        if isinstance(mutations, str):
+            mutations = [mutations]
+
+        data, seq_map = self.structures.get(content, fmt)
+        samples = [mutant_sample(data, seq_map, mut, self.patch) for mut in parse_mutations(mutations, seq_map)]
+        results = self.batcher.submit(samples).result()
+        latency_ms = (time.time() - time_start) * 1000
+        self.metrics.add_request(latency_ms, len(results))
+        return {'results': results, 'latency_ms': latency_ms}
+
+    def health(self):
+        return {'status': 'ok' if self.batcher.thread.is_alive() else 'error', 'model': self.model_name, 'num_cvfolds': self.num_cvfolds, 'queue': self.batcher.queue.qsize()}
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    service = None  # set by `make_server`
+    quiet = True
+
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+    def _reply(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, self.service.health())
+        elif self.path == '/metrics':
+            self._reply(200, self.service.metrics.summary())
+        else:
+            self._reply(404, {'error': 'Unknown endpoint: %s' % self.path})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._reply(404, {'error': 'Unknown endpoint: %s' % self.path})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            self._reply(200, self.service.predict(request))
+        except (ValueError, KeyError, OSError) as e:
+            self.service.metrics.add('errors')
+            self._reply(400, {'error': repr(e)})
+        except Exception as e:
+            self.service.metrics.add('errors')
+            self._reply(500, {'error': repr(e)})
+
+
+class _UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host='127.0.0.1', port=8000, socket_path=None, quiet=True):
+    """HTTP server of `service` on (host, port), or on the Unix socket `socket_path`."""
+    handler = type('RequestHandler', (_RequestHandler, ), {'service': service, 'quiet': quiet})
+    if socket_path is not None:
+        return _UnixHTTPServer(socket_path, handler)
+    return ThreadingHTTPServer((host, port), handler)
@@ -1,16 +1,16 @@
 import functools
+import hashlib
+import os
 
 import numpy as np
 import pandas as pd
-from sklearn.linear_model import LinearRegression
-from sklearn.metrics import roc_auc_score
 from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 
-from src.datasets import SkempiABbindDataset
-from src.utils.data import PaddingCollate
+from src.datasets import get_dataset_class
+from src.utils.data import PaddingCollate, CachedBatchLoader
 from src.utils.misc import inf_iterator, BlackHole
-from src.utils.transforms import get_transform
+from src.utils.transforms import get_transform, has_stochastic_transform
 
 
 def per_complex_corr(df, pred_attr='ddG_pred', limit=10):
@@ -27,15 +27,23 @@ def per_complex_corr(df, pred_attr='ddG_pred', limit=10):
 
 
 class SkempiDatasetManager(object):
+    """
+    Args:
+        val_cache:  None, 'memory' or 'disk', materialize the validation batches during the first pass (see `CachedBatchLoader`). Disk caches are stored
+                    under `cfg.data.cache_dir` and memory-mapped by later runs with the same validation data.
+    """
 
-    def __init__(self, cfg, num_cvfolds, num_workers=4, logger=BlackHole()):
+    def __init__(self, cfg, num_cvfolds, num_workers=4, logger=BlackHole(), val_cache=None):
         super().__init__()
+        if val_cache not in (None, 'memory', 'disk'):
+            raise NotImplementedError('Validation cache mode not supported: %s' % val_cache)
         self.cfg = cfg
         self.num_cvfolds = num_cvfolds
         self.train_iterators = []
         self.val_loaders = []
         self.logger = logger
         self.num_workers = num_workers
+        self.val_cache = val_cache
         for fold in range(num_cvfolds):
             train_iterator, val_loader = self.init_loaders(fold)
             self.train_iterators.append(train_iterator)
@@ -43,7 +51,7 @@ class SkempiDatasetManager(object):
 
     def init_loaders(self, fold):
         cfg = self.cfg
-        dataset_ = functools.partial(SkempiABbindDataset, skempi_csv_path=cfg.data.skempi_csv_path, skempi_pdb_dir=cfg.data.skempi_pdb_dir, cache_dir=cfg.data.cache_dir,
+        dataset_ = functools.partial(get_dataset_class('skempi'), skempi_csv_path=cfg.data.skempi_csv_path, skempi_pdb_dir=cfg.data.skempi_pdb_dir, cache_dir=cfg.data.cache_dir,
                                      abbind_csv_path=cfg.data.get('abbind_csv_path', None), abbind_pdb_dir=cfg.data.get('abbind_pdb_dir', None), num_cvfolds=self.num_cvfolds,
                                      cvfold_index=fold, transform=get_transform(cfg.data.transform), use_plm=cfg.model.use_plm, reset=cfg.data.reset,
                                      mask_length=cfg.model.pos.mask_length if 'pos' in cfg.model else 0,
@@ -60,7 +68,27 @@ class SkempiDatasetManager(object):
         train_iterator = inf_iterator(train_loader)
         val_loader = DataLoader(val_dataset, batch_size=cfg.train.batch_size, shuffle=False, collate_fn=PaddingCollate(), num_workers=self.num_workers)
         self.logger.info('Fold %d: Train %d, Val %d' % (fold, len(train_dataset), len(val_dataset)))
-        return train_iterator, val_loader
+        return train_iterator, self.cache_val_loader(fold, val_loader)
+
+    def cache_val_loader(self, fold, val_loader):
+        if self.val_cache is None:
+            return val_loader
+        if has_stochastic_transform(self.cfg.data.transform):
+            self.logger.info('Validation cache bypassed: stochastic transforms are active.')
+            return val_loader
+        val_dataset = val_loader.dataset
+        num_deterministic = sum(val_dataset.is_deterministic(i) for i in range(len(val_dataset)))
+        if num_deterministic == 0:
+            self.logger.info('Validation cache bypassed: no deterministic validation sample.')
+            return val_loader
+        path = None
+        if self.val_cache == 'disk':
+            key = repr((fold, self.num_cvfolds, self.cfg.train.batch_size, self.cfg.data.transform, val_dataset.use_plm, val_dataset.mask_length, val_dataset.mask_mode,
+                        val_dataset.mask_noise_scale, [(e['pdbcode'], e['id']) for e in val_dataset.entries], os.path.getmtime(val_dataset.structures_cache)))
+            os.makedirs(os.path.join(self.cfg.data.cache_dir, 'val_batches'), exist_ok=True)
+            path = os.path.join(self.cfg.data.cache_dir, 'val_batches', 'fold%d_%s.pt' % (fold, hashlib.sha1(key.encode()).hexdigest()[:16]))
+        self.logger.info('Fold %d: caching %d/%d validation samples' % (fold, num_deterministic, len(val_dataset)))
+        return CachedBatchLoader(val_loader, val_dataset.is_deterministic, path=path)
 
     def get_train_iterator(self, fold):
         return self.train_iterators[fold]
@@ -92,11 +120,13 @@ def percomplex_correlations(df, return_details=False):
 
 
 def overall_auroc(df):
+    from sklearn.metrics import roc_auc_score
     score = roc_auc_score((df['ddG'] > 0).to_numpy(), df['ddG_pred'].to_numpy())
     return {'auroc': score, }
 
 
 def overall_rmse_mae(df):
+    from sklearn.linear_model import LinearRegression
     true = df['ddG'].to_numpy()
     pred = df['ddG_pred'].to_numpy()[:, None]
     reg = LinearRegression().fit(pred, true)
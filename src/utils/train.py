@@ -1,6 +1,5 @@
 import numpy as np
 import torch
-import matplotlib.pyplot as plt
 
 from src.utils.protein.constants import chi_pi_periodic, AA
 from src.utils.misc import BlackHole
@@ -95,6 +94,103 @@ def recursive_to(obj, device):
     return obj
 
 
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def autocast(precision, device):
+    """
+    Mixed precision context for the forward pass, matmuls run in the reduced precision while LayerNorm, attention softmax and frame transforms stay in float32.
+    Args:
+        precision:  'fp32' (autocast disabled), 'bf16' (CPU or GPU) or 'fp16' (GPU, with a `get_grad_scaler` for training).
+    """
+    if precision not in PRECISIONS:
+        raise NotImplementedError('Precision not supported: %s' % precision)
+    return torch.autocast(torch.device(device).type, dtype=PRECISIONS[precision], enabled=precision != 'fp32')
+
+
+def get_grad_scaler(precision, device):
+    """Loss scaling against float16 gradient underflow, a no-op for the other precisions."""
+    return torch.amp.GradScaler(torch.device(device).type, enabled=precision == 'fp16')
+
+
+def check_precision(model, batch, precision, device, atol=1e-2, seed=0):
+    """
+    Compares `autocast(precision)` with float32: the pieces kept in float32 on fixed random inputs (frame transforms of absolute coordinates, LayerNorm of
+    constant and low-variance features, attention softmax and its gradient with fully masked rows), then the ddG predictions of `model` on `batch`.
+    Args:
+        atol:   Tolerance of the ddG predictions, the float32 pieces are held to float32 round-off and LayerNorm to the rounding of its output.
+    Returns:
+        Dict of check name to (error, tolerance), errors are max absolute differences relative to max(|float32 output|, 1), inf when not finite.
+    """
+    from src.modules.common.geometry import global_to_local, local_to_global
+    from src.modules.common.layers import LayerNorm
+    from src.modules.encoders import attn, egnn_attn
+
+    def error(x, ref):
+        if not torch.isfinite(x).all():
+            return float('inf')
+        return ((x.float() - ref.float()).abs().max() / ref.float().abs().max().clamp(min=1)).item()
+
+    g = torch.Generator().manual_seed(seed)
+    dtype = PRECISIONS[precision]
+    tol_fp32, tol_rounding = 1e-5, torch.finfo(dtype).eps
+    errors = {}
+    with torch.no_grad():
+        # Frames of residues ~100 Angstrom from the origin, rounding the coordinates to bfloat16 moves them by ~0.5 Angstrom
+        R = torch.linalg.qr(torch.randn(4, 32, 3, 3, generator=g))[0].to(device)
+        t, p = (100 * torch.randn(4, 32, 3, generator=g)).to(device), torch.randn(4, 32, 5, 3, generator=g).to(device)
+        q_ref = local_to_global(R, t, p)
+        with autocast(precision, device):
+            q = local_to_global(R, t, p)
+            p_back = global_to_local(R, t, q)
+        errors['frames'] = (max(error(q, q_ref), error(p_back, p)), tol_fp32)
+
+        # LayerNorm statistics, epsilon=1e-10 underflows in half precision (constant rows) and small variances lose their precision
+        layer_norm = LayerNorm(64).to(device)
+        x = torch.cat([torch.ones(8, 64), 1 + 1e-2 * torch.randn(56, 64, generator=g)]).to(device).to(dtype)
+        with autocast(precision, device):
+            y = layer_norm(x)
+        errors['layer_norm'] = (error(y, layer_norm(x.float())), tol_rounding)
+
+    # Attention weights with padded residues, the -1e5 offset overflows float16 and fully masked rows turn into NaN gradients
+    logits = (10 * torch.randn(2, 16, 16, 4, generator=g)).to(device).to(dtype)
+    mask = torch.ones(2, 16, dtype=torch.bool, device=device)
+    mask[1, 10:] = False
+    for name, alpha_from_logits in [('alpha_ga', attn._alpha_from_logits), ('alpha_egnn', egnn_attn._alpha_from_logits)]:
+        alpha_ref = alpha_from_logits(logits.float(), mask)
+        with torch.enable_grad(), autocast(precision, device):
+            logits_grad = logits.clone().requires_grad_()
+            alpha = alpha_from_logits(logits_grad, mask)
+            alpha.float().sum().backward()
+        errors[name] = (error(alpha, alpha_ref) if torch.isfinite(logits_grad.grad).all() else float('inf'), tol_fp32)
+
+    # End to end
+    model.eval()
+    with torch.no_grad():
+        ddG_ref = model(batch)[1]['ddG_pred']
+        with autocast(precision, device):
+            ddG = model(batch)[1]['ddG_pred']
+    errors['ddG_pred'] = (error(ddG, ddG_ref), atol)
+    return errors
+
+
+def compile_encoders(model, **kwargs):
+    """
+    Compiles the encoders of `model` (and of its frozen pretrained encoder) in place with `torch.compile`, parameter names are unchanged.
+    Shapes are static for fixed patch sizes, so each encoder compiles once per batch size. The data-dependent parts around them
+    (neighbor selection, incremental pair updates, adaptive recycling) stay eager.
+    """
+    from src.modules.encoders.attn import GAEncoder
+    from src.modules.encoders.egnn import EGNN_Network
+    from src.modules.encoders.pair import ResiduePairEncoder
+    from src.modules.encoders.single import PerResidueEncoder
+    kwargs.setdefault('dynamic', False)
+    for module in model.modules():
+        if isinstance(module, (PerResidueEncoder, ResiduePairEncoder, GAEncoder, EGNN_Network)):
+            module.compile(**kwargs)
+    return model
+
+
 def sum_weighted_losses(losses, weights, echo=False):
     """
     Args:
@@ -147,6 +243,7 @@ def aggregate_sidechain_accuracy(aa, chi_pred, chi_native, chi_mask):
 
 
 def make_sidechain_accuracy_table_image(tag: str, diff: np.ndarray):
+    import matplotlib.pyplot as plt
     from Bio.PDB.Polypeptide import index_to_three
     columns = ['chi1', 'chi2', 'chi3', 'chi4']
     rows = [index_to_three(i) for i in range(20)]
@@ -176,6 +273,10 @@ class CrossValidation(object):
     def get(self, fold):
         return self.models[fold], self.optimizers[fold], self.schedulers[fold]
 
+    def train_folds(self, it, parallel=False):
+        """Folds to step at iteration `it`: one fold per iteration in turn, or all folds at once (each with its own batch and optimizer)."""
+        return list(range(self.num_cvfolds)) if parallel else [it % self.num_cvfolds]
+
     def to(self, device):
         for m in self.models:
             m.to(device)
@@ -187,7 +288,79 @@ class CrossValidation(object):
     def load_state_dict(self, state_dict):
         for sd, obj in zip(state_dict['models'], self.models):
             obj.load_state_dict(sd)
-        for sd, obj in zip(state_dict['optimizers'], self.optimizers):
+        for sd, obj in zip(state_dict.get('optimizers', []), self.optimizers):  # absent from weights-only checkpoints
             obj.load_state_dict(sd)
-        for sd, obj in zip(state_dict['schedulers'], self.schedulers):
+        for sd, obj in zip(state_dict.get('schedulers', []), self.schedulers):
             obj.load_state_dict(sd)
+
+
+class _SharedPretrainedFeatures(object):
+    """Feature cache scoped to one batch: the first fold computes the frozen pretrained features, the other folds reuse them."""
+
+    def __init__(self):
+        super().__init__()
+        self.features = {}
+
+    def __call__(self, encode_fn, batch, tag):
+        if tag not in self.features:
+            self.features[tag] = encode_fn(batch)
+        return self.features[tag]
+
+
+class EnsemblePredictor(object):
+    """
+    Evaluates every fold model of a `CrossValidation` on the same batch and aggregates the predictions.
+    Folds fine-tuned from the same frozen pretrained encoder share its features within a batch.
+    """
+
+    def __init__(self, cv_mgr, pred_key='ddG_pred', precision='fp32'):
+        super().__init__()
+        self.cv_mgr = cv_mgr
+        self.pred_key = pred_key
+        self.precision = precision
+        self.share_pretrained = self._same_pretrained(cv_mgr.models)
+
+    @staticmethod
+    def _same_pretrained(models):
+        if any(getattr(m, 'rde', None) is None or not hasattr(m, 'set_feature_cache') for m in models):
+            return False
+        if all(m.rde is models[0].rde for m in models):  # built from the same checkpoint, see `load_pretrained`
+            return True
+        ref = models[0].rde.state_dict()
+        return all(all(torch.equal(ref[k], v) for k, v in m.rde.state_dict().items()) for m in models[1:])
+
+    def _ensemble(self, predict_fn, device):
+        shared = _SharedPretrainedFeatures() if self.share_pretrained else None
+        preds = []
+        for model in self.cv_mgr.models:
+            model.eval()
+            if shared is not None:
+                feature_cache = model.feature_cache
+                model.set_feature_cache(shared)
+            try:
+                with autocast(self.precision, device):
+                    preds.append(predict_fn(model).float())
+            finally:
+                if shared is not None:
+                    model.set_feature_cache(feature_cache)
+        preds = torch.stack(preds, dim=0)  # (F, N)
+        std = preds.std(dim=0) if preds.size(0) > 1 else torch.zeros_like(preds[0])
+        return {self.pred_key + '_folds': preds, self.pred_key: preds.mean(dim=0), self.pred_key + '_std': std}
+
+    @torch.no_grad()
+    def __call__(self, batch, **kwargs):
+        """
+        Returns:
+            Dict with `<pred_key>_folds` (F, N), the fold mean `<pred_key>` (N, ) and the fold standard deviation `<pred_key>_std` (N, ).
+        """
+        return self._ensemble(lambda model: model(batch, **kwargs)[1][self.pred_key], batch['aa'].device)
+
+    @torch.no_grad()
+    def predict(self, batch):
+        """Same as `__call__`, with the `predict` method of the models that have one (no losses, no ground truth ddG needed)."""
+        return self._ensemble(lambda model: model.predict(batch) if hasattr(model, 'predict') else model(batch)[1][self.pred_key], batch['aa'].device)
+
+    @torch.no_grad()
+    def scan(self, batch, aa_mut, wt_index):
+        """Same as `__call__` for the mutants `aa_mut` (M, L) of the wild types in `batch`, see `scan` of the DDG models."""
+        return self._ensemble(lambda model: model.scan(batch, aa_mut, wt_index), batch['aa'].device)
@@ -14,16 +14,25 @@ class Compose:
 
 
 _TRANSFORM_DICT = {}
+_STOCHASTIC_TRANSFORMS = set()
 
 
-def register_transform(name):
+def register_transform(name, stochastic=False):
     def decorator(cls):
         _TRANSFORM_DICT[name] = cls
+        if stochastic:  # output is not a pure function of the input
+            _STOCHASTIC_TRANSFORMS.add(name)
         return cls
 
     return decorator
 
 
+def has_stochastic_transform(cfg):
+    if cfg is None:
+        return False
+    return any(t_dict['type'] in _STOCHASTIC_TRANSFORMS for t_dict in cfg)
+
+
 def get_transform(cfg):
     if cfg is None or len(cfg) == 0:
         return None
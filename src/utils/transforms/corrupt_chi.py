@@ -4,7 +4,7 @@ import numpy as np
 from ._base import register_transform, _get_CB_positions
 
 
-@register_transform('corrupt_chi_angle')
+@register_transform('corrupt_chi_angle', stochastic=True)
 class CorruptChiAngle(object):
 
     def __init__(self, ratio_mask=0.1, add_noise=True, maskable_flag_attr=None):
@@ -33,7 +33,7 @@ def _mask_sidechains(pos_atoms, mask_atoms, mask_idx):
     return pos_atoms, mask_atoms
 
 
-@register_transform('random_mask_amino_acids')
+@register_transform('random_mask_amino_acids', stochastic=True)
 class RandomMaskAminoAcids(object):
 
     def __init__(self, mask_ratio_in_all=0.05, ratio_in_maskable_limit=0.5, mask_token=20, maskable_flag_attr='core_flag', extend_maskable_flag=False,
@@ -73,7 +73,7 @@ class RandomMaskAminoAcids(object):
         return data
 
 
-@register_transform('random_mask_pos_and_multiple_patch')
+@register_transform('random_mask_pos_and_multiple_patch', stochastic=True)
 class RandomMasPositionAndFocusedMultiplePatch(object):
 
     def __init__(self, focus_attr, seed_nbh_size, patch_size, mask_ratio=0.05, mask_max_length=10, mask_noise_scale=1.0, num_patch=1):
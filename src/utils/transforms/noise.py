@@ -4,7 +4,7 @@ import numpy as np
 from ._base import register_transform
 
 
-@register_transform('add_atom_noise')
+@register_transform('add_atom_noise', stochastic=True)
 class AddAtomNoise(object):
 
     def __init__(self, noise_std=0.02):
@@ -20,7 +20,7 @@ class AddAtomNoise(object):
         return data
 
 
-@register_transform('add_atom_variance_noise')
+@register_transform('add_atom_variance_noise', stochastic=True)
 class AddAtomVarianceNoise(object):
 
     def __init__(self, diagonal_var, noise_std=0.02):
@@ -52,7 +52,7 @@ class AddZeroVariance(object):
         return data
 
 
-@register_transform('add_chi_angle_noise')
+@register_transform('add_chi_angle_noise', stochastic=True)
 class AddChiAngleNoise(object):
 
     def __init__(self, noise_std=0.02):
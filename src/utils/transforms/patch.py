@@ -4,7 +4,7 @@ import torch
 from ._base import _index_select_data, register_transform, _get_CB_positions
 
 
-@register_transform('focused_random_patch')
+@register_transform('focused_random_patch', stochastic=True)
 class FocusedRandomPatch(object):
 
     def __init__(self, focus_attr, seed_nbh_size=32, patch_size=128):
@@ -38,7 +38,7 @@ class FocusedRandomPatch(object):
         return data_patch
 
 
-@register_transform('random_patch')
+@register_transform('random_patch', stochastic=True)
 class RandomPatch(object):
 
     def __init__(self, seed_nbh_size=32, patch_size=128):
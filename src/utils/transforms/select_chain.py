@@ -4,7 +4,7 @@ import torch
 from ._base import _mask_select_data, register_transform
 
 
-@register_transform('random_interacting_chain')
+@register_transform('random_interacting_chain', stochastic=True)
 class RandomInteractingChain(object):
 
     def __init__(self, interaction_attr):
@@ -0,0 +1,139 @@
+import os
+import queue
+
+import pandas as pd
+import torch
+from tqdm.auto import tqdm
+
+from src.utils.train import ScalarMetricAccumulator, autocast, recursive_to
+
+
+@torch.no_grad()
+def validate_folds(models, dataset_mgr, device, precision='fp32', progress=True):
+    """
+    Predictions of each fold model on its validation split.
+    Returns:
+        Dict with the per-mutation `results` (DataFrame), the loss accumulator `scalar_accum` and the overall and per-complex correlations.
+    """
+    from src.utils.skempi import per_complex_corr
+    scalar_accum = ScalarMetricAccumulator()
+    results = []
+    for fold, model in enumerate(models):
+        model.eval()
+        for batch in tqdm(dataset_mgr.get_val_loader(fold), desc='Validate', dynamic_ncols=True, disable=not progress):
+            batch = recursive_to(batch, device)
+            with autocast(precision, device):
+                loss_dict, output_dict = model(batch)
+            scalar_accum.add(name='ddg_loss', value=loss_dict['regression'], batchsize=batch['size'], mode='mean')
+            if 'pos_refine' in loss_dict:
+                scalar_accum.add(name='pos_loss', value=loss_dict['pos_refine'], batchsize=batch['size'], mode='mean')
+            for complex, mutstr, ddg_true, ddg_pred in zip(batch['complex'], batch['mutstr'], output_dict['ddG_true'], output_dict['ddG_pred']):
+                results.append({'complex': complex, 'mutstr': mutstr, 'num_muts': len(mutstr.split(',')), 'ddG': ddg_true.item(), 'ddG_pred': ddg_pred.item()})
+
+    results = pd.DataFrame(results)
+    pearson_pc, spearman_pc = per_complex_corr(results)
+    return {'results': results, 'scalar_accum': scalar_accum, 'pearson_all': results[['ddG', 'ddG_pred']].corr('pearson').iloc[0, 1],
+            'spearman_all': results[['ddG', 'ddG_pred']].corr('spearman').iloc[0, 1], 'pearson_pc': pearson_pc, 'spearman_pc': spearman_pc}
+
+
+def _validation_worker(config, num_cvfolds, device, precision, num_threads, results_dir, val_cache, requests, responses):
+    from src.models import get_ddg_model
+    from src.utils.misc import seed_all
+    from src.utils.skempi import SkempiDatasetManager
+    seed_all(config.train.seed)  # the mutation drawn for multi-mutation entries
+    torch.set_num_threads(num_threads)
+    dataset_mgr = SkempiDatasetManager(config, num_cvfolds=num_cvfolds, num_workers=0, val_cache=val_cache)
+    models = [get_ddg_model(config.model)(config.model).to(device) for _ in range(num_cvfolds)]
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        it, state_dicts = request
+        try:
+            for model, state_dict in zip(models, state_dicts):
+                model.load_state_dict(state_dict)
+            del state_dicts, request  # release the shared memory of the snapshot
+            out = validate_folds(models, dataset_mgr, device, precision, progress=False)
+            if results_dir is not None:
+                out['results'].to_csv(os.path.join(results_dir, f'results_{it}.csv'), index=False)
+            del out['results']
+            responses.put((it, out))
+        except Exception as e:
+            responses.put((it, e))
+
+
+class AsyncValidator(object):
+    """
+    Validates weight snapshots in a separate process while training continues. Snapshots go through shared memory (torch.multiprocessing queues),
+    metrics come back tagged with the iteration of the snapshot, in order.
+    Args:
+        device:         Device of the validation models, e.g. 'cpu' to keep the GPU for training, or a second GPU.
+        num_threads:    Intra-op threads of the worker, the cores it takes from training on CPU.
+        max_pending:    Snapshots waiting to be validated, `submit` blocks beyond that.
+        results_dir:    Where the worker writes `results_{it}.csv`, None to skip.
+        val_cache:      Cache mode of the validation batches of the worker, see `SkempiDatasetManager`.
+    """
+
+    def __init__(self, config, num_cvfolds, device='cpu', precision='fp32', num_threads=4, max_pending=2, results_dir=None, val_cache=None):
+        super().__init__()
+        ctx = torch.multiprocessing.get_context('spawn')  # no CUDA context or data loader state inherited from the trainer
+        self.requests, self.responses = ctx.Queue(), ctx.Queue()
+        self.process = ctx.Process(target=_validation_worker, args=(config, num_cvfolds, device, precision, num_threads, results_dir, val_cache, self.requests, self.responses),
+                                   daemon=True)
+        self.process.start()
+        self.max_pending = max_pending
+        self.pending = []  # iterations submitted and not reported yet
+
+    def submit(self, it, state_dicts):
+        """
+        Schedules the validation of the fold weights at iteration `it`, blocks only while `max_pending` snapshots are being validated.
+        Args:
+            state_dicts:    CPU snapshots of the fold models (see `snapshot`), moved to shared memory. They must not be modified afterwards.
+        Returns:
+            The results received meanwhile, as `poll`.
+        """
+        received = []
+        while len(self.pending) >= self.max_pending:
+            received.append(self._get(block=True))
+        for state_dict in state_dicts:
+            for v in state_dict.values():
+                v.share_memory_()
+        self.requests.put((it, state_dicts))
+        self.pending.append(it)
+        return received + self.poll()
+
+    def _get(self, block):
+        while True:
+            try:
+                it, out = self.responses.get(timeout=5.0) if block else self.responses.get_nowait()
+                break
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('The validation worker exited with code %s' % self.process.exitcode)
+                if not block:
+                    return None
+        self.pending.remove(it)
+        if isinstance(out, Exception):
+            raise RuntimeError('Validation of iteration %d failed' % it) from out
+        return it, out
+
+    def poll(self):
+        """(iteration, metrics) of the snapshots validated since the last call, without blocking."""
+        received = []
+        while self.pending:
+            r = self._get(block=False)
+            if r is None:
+                break
+            received.append(r)
+        return received
+
+    def drain(self):
+        """Waits for every submitted snapshot."""
+        return [self._get(block=True) for _ in range(len(self.pending))]
+
+    def close(self):
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join(timeout=30)
+        if self.process.is_alive():
+            self.process.terminate()
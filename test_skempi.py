@@ -1,14 +1,6 @@
 import argparse
-import pandas as pd
-import torch.utils.tensorboard
-from tqdm.auto import tqdm
-
-torch.backends.cuda.matmul.allow_tf32 = True
-torch.backends.cudnn.allow_tf32 = True
-
-from src.utils.misc import get_logger
-from src.utils.train import *
-from src.utils.skempi import SkempiDatasetManager, eval_skempi_three_modes
+import copy
+import time
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -17,7 +9,27 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--output', type=str, default='skempi_results')
     parser.add_argument('--device', type=str, default='cuda')
     parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'], help='mixed precision inference, also reports the fp32 metrics, time and peak CUDA memory')
+    parser.add_argument('--quantize', action='store_true', default=False, help='dynamic int8 quantization of the Linear layers (CPU), also reports the fp32 metrics')
+    parser.add_argument('--calibrate', type=int, default=0, help='training batches per fold to find the Linear layers too sensitive to quantize')
+    parser.add_argument('--quant_tol', type=float, default=0.05, help='layers whose relative int8 output error on the calibration batches exceeds this stay in float')
+    parser.add_argument('--corr_tol', type=float, default=0.01, help='largest drop of the Pearson/Spearman correlations against fp32 accepted with --precision or --quantize')
+    parser.add_argument('--ddg_tol', type=float, default=0.01, help='largest relative ddG difference from fp32 on the first validation batch accepted with --precision')
+    parser.add_argument('--recycle_tol', type=float, default=None, help='stop refinement recycling per sample once the RMS update (Angstrom) is below this value')
     args = parser.parse_args()
+
+    # After parsing, `--help` does not import torch
+    import pandas as pd
+    import torch.utils.tensorboard
+    from tqdm.auto import tqdm
+
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
+    from src.models import get_ddg_model, get_model_class
+    from src.utils.misc import get_logger
+    from src.utils.train import *
+    from src.utils.skempi import SkempiDatasetManager, eval_skempi_three_modes, per_complex_corr
     logger = get_logger('test', None)
 
     ckpt = torch.load(args.ckpt)
@@ -28,20 +40,54 @@ if __name__ == '__main__':
     logger.info('Loading datasets...')
     dataset_mgr = SkempiDatasetManager(config, num_cvfolds=num_cvfolds, num_workers=args.num_workers, logger=logger, )
     logger.info('Building model...')
-    if args.backbone == 'ga':
-        from src.models.rde_ddg import DDG_RDE_Network
-        cv_mgr = CrossValidation(model_factory=DDG_RDE_Network, config=config, num_cvfolds=num_cvfolds).to(args.device)
-    else:
-        if 'pos' in config.model:
-            from src.models.pdc_ddg_refine import DDG_PDC_Network
-        else:
-            from src.models.pdc_ddg import DDG_PDC_Network
-        cv_mgr = CrossValidation(model_factory=DDG_PDC_Network, config=config, num_cvfolds=num_cvfolds).to(args.device)
+    model_factory = get_model_class('ddg_rde') if args.backbone == 'ga' else get_ddg_model(config.model)
+    cv_mgr = CrossValidation(model_factory=model_factory, config=config, num_cvfolds=num_cvfolds).to(args.device)
     logger.info('Loading state dict...')
     cv_mgr.load_state_dict(ckpt['model'])
+    if args.recycle_tol is not None:
+        assert hasattr(cv_mgr.models[0], 'recycle_counter'), 'Adaptive recycling requires a refinement model.'
+        for model in cv_mgr.models:
+            model.recycle_tol = args.recycle_tol
 
+    if args.precision != 'fp32':  # fails before the evaluation when the float32 pieces or the predictions of the reduced precision are off
+        checks = check_precision(cv_mgr.models[0], recursive_to(next(iter(dataset_mgr.get_val_loader(0))), args.device), args.precision, args.device, atol=args.ddg_tol)
+        logger.info('Precision check: ' + ', '.join(f'{k} {err:.2e} (tol {tol:.0e})' for k, (err, tol) in checks.items()))
+        failed = [k for k, (err, tol) in checks.items() if not err <= tol]
+        assert len(failed) == 0, f'{args.precision} differs from fp32 beyond tolerance: {failed}'
+
+    models_fp32 = None
+    if args.quantize:
+        from src.utils.quantization import calibrate, quantize_dynamic_int8, shared_linear_layers
+        assert args.device == 'cpu', 'Quantized models run on CPU.'
+        models_fp32, cv_mgr.models = cv_mgr.models, copy.deepcopy(cv_mgr.models)  # one copy of the shared pretrained model, the loaded one stays in float
+        # Calibrate every fold before the shared pretrained encoder is quantized, its layers stay in float if they are too sensitive in any fold
+        errors = [calibrate(model, [recursive_to(next(dataset_mgr.get_train_iterator(fold)), args.device) for _ in range(args.calibrate)]) if args.calibrate > 0 else {}
+                  for fold, model in enumerate(cv_mgr.models)]
+        shared = shared_linear_layers(cv_mgr.models)
+        skip_shared = sorted({name for e in errors for name, err in e.items() if name in shared and err > args.quant_tol})
+        if args.calibrate > 0:
+            logger.info(f'Shared: {len(skip_shared)}/{len(shared)} Linear layers kept in float: {skip_shared}')
+        for fold, model in enumerate(cv_mgr.models):
+            skip = [name for name, err in errors[fold].items() if name not in shared and err > args.quant_tol]
+            if args.calibrate > 0:
+                logger.info(f'Fold {fold}: {len(skip)}/{len(errors[fold]) - len(shared)} Linear layers kept in float: {skip}')
+            quantize_dynamic_int8(model, skip + skip_shared)
+
+    def timed(fn, *inputs, **kwargs):
+        """Runs `fn`, returns its output, wall-clock seconds and peak CUDA memory (MB, 0 on CPU where the allocator is not tracked)."""
+        cuda = torch.device(args.device).type == 'cuda'
+        if cuda:
+            torch.cuda.synchronize(args.device)
+            torch.cuda.reset_peak_memory_stats(args.device)
+        time_start = time.time()
+        out = fn(*inputs, **kwargs)
+        if cuda:
+            torch.cuda.synchronize(args.device)
+        return out, time.time() - time_start, torch.cuda.max_memory_allocated(args.device) / 2 ** 20 if cuda else 0.0
+
+    compare = models_fp32 is not None or args.precision != 'fp32'  # reference fp32 run next to the reduced precision / int8 one
     scalar_accum = ScalarMetricAccumulator()
-    results = []
+    results, time_fp32, time_model, mem_fp32, mem_model = [], 0.0, 0.0, 0.0, 0.0
     with torch.no_grad():
         for fold in range(num_cvfolds):
             model, _, _ = cv_mgr.get(fold)
@@ -49,7 +95,14 @@ if __name__ == '__main__':
             for i, batch in enumerate(tqdm(dataset_mgr.get_val_loader(fold), desc=f'Fold {fold + 1}/{num_cvfolds}', dynamic_ncols=True)):
                 batch = recursive_to(batch, args.device)
 
-                loss_dict, output_dict = model(batch, return_pos=True)
+                with autocast(args.precision, args.device):
+                    (loss_dict, output_dict), seconds, mem = timed(model, batch, return_pos=True)
+                time_model, mem_model = time_model + seconds, max(mem_model, mem)
+                if compare:
+                    model_fp32 = models_fp32[fold].eval() if models_fp32 is not None else model
+                    (_, output_fp32), seconds, mem = timed(model_fp32, batch)
+                    ddG_fp32 = output_fp32['ddG_pred'].float()
+                    time_fp32, mem_fp32 = time_fp32 + seconds, max(mem_fp32, mem)
                 loss = sum_weighted_losses(loss_dict, config.train.loss_weights)
                 scalar_accum.add(name='loss', value=loss, batchsize=batch['size'], mode='mean')
 
@@ -57,10 +110,37 @@ if __name__ == '__main__':
 
                 for complex, mutstr, ddg_true, ddg_pred, mse in zip(batch['complex'], batch['mutstr'], output_dict['ddG_true'], output_dict['ddG_pred'], pos_mse):
                     results.append({'complex': complex, 'mutstr': mutstr, 'num_muts': len(mutstr.split(',')), 'ddG': ddg_true.item(), 'ddG_pred': ddg_pred.item(), 'pos_mse': mse.item()})
+                if compare:
+                    for r, d in zip(results[-len(ddG_fp32):], ddG_fp32.tolist()):
+                        r['ddG_pred_fp32'] = d
+
+    if args.recycle_tol is not None:
+        total, count = sum(m.recycle_counter.total for m in cv_mgr.models), sum(m.recycle_counter.count for m in cv_mgr.models)
+        logger.info('Average recycles: %.2f (max %d)' % (total / max(count, 1), cv_mgr.models[0].recycle))
 
     results = pd.DataFrame(results)
+    corr_drop = None
+    if compare:
+        name = '+'.join(([args.precision] if args.precision != 'fp32' else []) + (['int8'] if models_fp32 is not None else []))
+        drops = []
+        for mode, corr in [('Overall', lambda df, attr: tuple(df[['ddG', attr]].corr(method).iloc[0, 1] for method in ('pearson', 'spearman'))),
+                           ('PC', lambda df, attr: per_complex_corr(df, pred_attr=attr))]:
+            pearson_q, spearman_q = corr(results, 'ddG_pred')
+            pearson_f, spearman_f = corr(results, 'ddG_pred_fp32')
+            drops += [pearson_f - pearson_q, spearman_f - spearman_q]
+            logger.info(f'[{mode}] {name} Pearson {pearson_q:.4f} Spearman {spearman_q:.4f} | fp32 Pearson {pearson_f:.4f} Spearman {spearman_f:.4f} | '
+                        f'delta {pearson_q - pearson_f:+.4f} / {spearman_q - spearman_f:+.4f}')
+        logger.info(f'{name} {time_model:.1f} s, fp32 {time_fp32:.1f} s, speedup {time_fp32 / max(time_model, 1e-6):.2f}x')
+        if torch.device(args.device).type == 'cuda':
+            logger.info(f'Peak memory {name} {mem_model:.0f} MB, fp32 {mem_fp32:.0f} MB, ratio {mem_model / max(mem_fp32, 1e-6):.2f}')
+        else:
+            logger.info('Peak memory is only reported on CUDA devices.')
+        corr_drop = max(drops)
+        logger.info(f'{name} correlations drop by up to {corr_drop:.4f} against fp32 (--corr_tol {args.corr_tol})')
     results['method'] = 'PDC-Net'
     results.to_csv(args.ckpt.split('.')[0] + args.output + '.csv', index=False)
     df_metrics = eval_skempi_three_modes(results)
     print(df_metrics)
     df_metrics.to_csv(args.ckpt.split('.')[0] + args.output + '_metrics.csv', index=False)
+    if corr_drop is not None:  # after the results are saved
+        assert corr_drop <= args.corr_tol, f'{name} correlations drop by {corr_drop:.4f} against fp32, above --corr_tol {args.corr_tol}'
@@ -11,9 +11,11 @@ from tqdm.auto import tqdm
 torch.backends.cuda.matmul.allow_tf32 = True
 torch.backends.cudnn.allow_tf32 = True
 
-from src.utils.misc import inf_iterator, load_config, seed_all, get_logger, get_new_log_dir, current_milli_time
+from src.utils.misc import inf_iterator, load_config, seed_all, get_logger, get_new_log_dir
 from src.utils.data import PaddingCollate
 from src.utils.train import *
+from src.utils.checkpoint import CheckpointManager
+from src.utils.profiling import StageTimer, ProfilerTrigger
 from src.datasets.md import get_md_dataset
 from src.models.pdc import ProbabilityDensityCloud
 
@@ -24,6 +26,11 @@ if __name__ == '__main__':
     parser.add_argument('--debug', action='store_true', default=False)
     parser.add_argument('--device', type=str, default='cuda')
     parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--keep_last', type=int, default=None, help='keep the last K checkpoints and the one with the lowest validation loss, all by default')
+    parser.add_argument('--weights_only', action='store_true', default=False, help='also write checkpoints without the optimizer state')
+    parser.add_argument('--profile_stages', action='store_true', default=False, help='time the encoder stages and synchronize CUDA at stage boundaries')
+    parser.add_argument('--profile', action='store_true', default=False, help='record a torch.profiler trace from the first iteration, `kill -USR1` records one later')
+    parser.add_argument('--profile_schedule', type=str, default='5,2,5', help='wait,warmup,active iterations of a torch.profiler trace')
     args = parser.parse_args()
 
     # Load configs
@@ -34,6 +41,8 @@ if __name__ == '__main__':
     if args.debug:
         logger = get_logger('train', None)
         writer = BlackHole()
+        ckpt_dir = None
+        profiler = None
     else:
         log_dir = get_new_log_dir(args.logdir, prefix=config_name)
         ckpt_dir = os.path.join(log_dir, 'checkpoints')
@@ -41,10 +50,13 @@ if __name__ == '__main__':
         logger = get_logger('train', log_dir)
         writer = torch.utils.tensorboard.SummaryWriter(log_dir)
         tensorboard_trace_handler = torch.profiler.tensorboard_trace_handler(log_dir)
+        wait, warmup, active = map(int, args.profile_schedule.split(','))
+        profiler = ProfilerTrigger(tensorboard_trace_handler, wait=wait, warmup=warmup, active=active, enabled=args.profile, logger=logger)
         if not os.path.exists(os.path.join(log_dir, os.path.basename(args.config))):
             shutil.copyfile(args.config, os.path.join(log_dir, os.path.basename(args.config)))
     logger.info(args)
     logger.info(config)
+    ckpt_mgr = CheckpointManager(ckpt_dir, keep_last=args.keep_last, mode='min', weights_only=args.weights_only, logger=logger)
 
     # Data
     logger.info('Loading datasets...')
@@ -66,6 +78,9 @@ if __name__ == '__main__':
         logger.info('Building model from scratch...')
         model = ProbabilityDensityCloud(config.model).to(args.device)
     logger.info('Number of parameters: %d M' % (count_parameters(model) / 1e6))
+    timer = StageTimer(args.device, sync=args.profile_stages)
+    if args.profile_stages:
+        timer.instrument(model)
 
     optimizer = get_optimizer(config.train.optimizer, model)
     scheduler = get_scheduler(config.train.scheduler, optimizer)
@@ -74,27 +89,32 @@ if __name__ == '__main__':
 
 
     def train(it):
-        time_start = current_milli_time()
         model.train()
 
-        batch = recursive_to(next(train_iterator), args.device)
-        loss_dict = model(batch)
-        loss = sum_weighted_losses(loss_dict, config.train.loss_weights)
-        time_forward_end = current_milli_time()
-        loss.backward()
-        orig_grad_norm = clip_grad_norm_(model.parameters(), config.train.max_grad_norm)
-        optimizer.step()
-        optimizer.zero_grad()
-        time_backward_end = current_milli_time()
+        with timer.stage('data'):
+            batch = next(train_iterator)
+        with timer.stage('h2d'):
+            batch = recursive_to(batch, args.device)
+        timer.count('samples', batch['size'])
+        with timer.stage('forward'):
+            loss_dict = model(batch)
+            loss = sum_weighted_losses(loss_dict, config.train.loss_weights)
+        with timer.stage('backward'):
+            loss.backward()
+        with timer.stage('optimizer'):
+            orig_grad_norm = clip_grad_norm_(model.parameters(), config.train.max_grad_norm)
+            optimizer.step()
+            optimizer.zero_grad()
 
         # Logging
-        scalar_dict = {'grad': orig_grad_norm, 'lr(1e-4)': optimizer.param_groups[0]['lr'] * 1e4, 'time_forward': (time_forward_end - time_start) / 1000,
-                       'time_backward': (time_backward_end - time_forward_end) / 1000, }
+        scalar_dict = {'grad': orig_grad_norm, 'lr(1e-4)': optimizer.param_groups[0]['lr'] * 1e4, 'time_data': timer.last('data'), 'time_forward': timer.last('forward'),
+                       'time_backward': timer.last('backward') + timer.last('optimizer'), }
         logstr = '[%s] Iter %05d' % ('train', it)
         logstr += ' | loss %.4f' % loss.item()
         for k, v in scalar_dict.items():
             logstr += ' | %s %.3f' % (k, v.item() if isinstance(v, torch.Tensor) else v)
         write_losses(loss, loss_dict, scalar_dict, it=it, tag='train', writer=writer)
+        timer.step(it, writer)
         return logstr
 
     def validate(it):
@@ -125,12 +145,20 @@ if __name__ == '__main__':
         for it in it_tqdm:
             message = train(it)
             it_tqdm.set_description(message)
+            if profiler is not None:
+                profiler.step()
 
             if it % config.train.val_freq == 0:
+                if ckpt_dir is not None:
+                    timer.save(os.path.join(log_dir, 'profile.json'))
                 avg_val_loss = validate(it)
-                if not args.debug:
-                    ckpt_path = os.path.join(ckpt_dir, '%d.pt' % it)
-                    torch.save({'config': config, 'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'iteration': it,
-                                'avg_val_loss': avg_val_loss, }, ckpt_path)
+                ckpt_mgr.save({'config': config, 'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'iteration': it,
+                               'avg_val_loss': avg_val_loss, }, it, metric=avg_val_loss)
     except KeyboardInterrupt:
         logger.info('Terminating...')
+    finally:
+        ckpt_mgr.close()
+        if profiler is not None:
+            profiler.close()
+        if ckpt_dir is not None:
+            timer.save(os.path.join(log_dir, 'profile.json'))
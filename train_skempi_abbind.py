@@ -2,19 +2,6 @@ import argparse
 import os
 import shutil
 
-import pandas as pd
-import torch.utils.tensorboard
-from torch.nn.utils import clip_grad_norm_
-from tqdm import tqdm as tq
-from tqdm.auto import tqdm
-
-torch.backends.cuda.matmul.allow_tf32 = True
-torch.backends.cudnn.allow_tf32 = True
-
-from src.utils.misc import load_config, seed_all, get_logger, get_new_log_dir, current_milli_time
-from src.utils.train import *
-from src.utils.skempi import SkempiDatasetManager, per_complex_corr
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('config', type=str)
@@ -24,17 +11,50 @@ if __name__ == '__main__':
     parser.add_argument('--device', type=str, default='cuda')
     parser.add_argument('--num_workers', type=int, default=4)
     parser.add_argument('--resume', type=str, default=None)
+    parser.add_argument('--keep_last', type=int, default=None, help='keep the last K checkpoints and the best one by per-complex Spearman, all by default')
+    parser.add_argument('--async_val', action='store_true', default=False, help='validate weight snapshots in a separate process while training continues')
+    parser.add_argument('--val_device', type=str, default=None, help='device of the asynchronous validation, defaults to --device')
+    parser.add_argument('--val_threads', type=int, default=4, help='CPU threads of the asynchronous validation')
+    parser.add_argument('--weights_only', action='store_true', default=False, help='also write inference checkpoints without the optimizer states')
+    parser.add_argument('--fold_parallel', action='store_true', default=False, help='step every fold in each iteration with a single backward pass')
+    parser.add_argument('--val_cache', type=str, default='memory', choices=['memory', 'disk', 'none'], help='materialize the deterministic validation batches once')
+    parser.add_argument('--feature_cache', type=str, default=None, choices=['memory', 'disk'], help='cache the outputs of the frozen pretrained encoder')
+    parser.add_argument('--compile', action='store_true', default=False, help='compile the encoders with torch.compile')
+    parser.add_argument('--profile_stages', action='store_true', default=False, help='time the encoder stages and synchronize CUDA at stage boundaries')
+    parser.add_argument('--profile', action='store_true', default=False, help='record a torch.profiler trace from the first iteration, `kill -USR1` records one later')
+    parser.add_argument('--profile_schedule', type=str, default='5,2,5', help='wait,warmup,active iterations of a torch.profiler trace')
+    parser.add_argument('--precision', type=str, default=None, choices=['fp32', 'bf16', 'fp16'], help='mixed precision, overrides `train.precision` of the config')
     args = parser.parse_args()
 
+    # After parsing, `--help` does not import torch
+    import torch.utils.tensorboard
+    from torch.nn.utils import clip_grad_norm_
+    from tqdm import tqdm as tq
+
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
+    from src.models import get_ddg_model
+    from src.utils.misc import load_config, seed_all, get_logger, get_new_log_dir
+    from src.utils.train import *
+    from src.utils.skempi import SkempiDatasetManager
+    from src.utils.feature_cache import get_feature_cache
+    from src.utils.checkpoint import CheckpointManager, snapshot
+    from src.utils.validation import AsyncValidator, validate_folds
+    from src.utils.profiling import StageTimer, ProfilerTrigger
+
     # Load configs
     config, config_name = load_config(args.config)
     seed_all(config.train.seed)
+    precision = args.precision or config.train.get('precision', 'fp32')
+    scaler = get_grad_scaler(precision, args.device)
 
     # Logging
     if args.debug:
         logger = get_logger('train', None)
         writer = BlackHole()
         ckpt_dir = None
+        profiler = None
     else:
         if args.resume:
             log_dir = get_new_log_dir(args.logdir, prefix='%s-resume' % config_name)
@@ -45,23 +65,19 @@ if __name__ == '__main__':
         logger = get_logger('train', log_dir)
         writer = torch.utils.tensorboard.SummaryWriter(log_dir)
         tensorboard_trace_handler = torch.profiler.tensorboard_trace_handler(log_dir)
+        wait, warmup, active = map(int, args.profile_schedule.split(','))
+        profiler = ProfilerTrigger(tensorboard_trace_handler, wait=wait, warmup=warmup, active=active, enabled=args.profile, logger=logger)
         if not os.path.exists(os.path.join(log_dir, os.path.basename(args.config))):
             shutil.copyfile(args.config, os.path.join(log_dir, os.path.basename(args.config)))
     logger.info(args)
     logger.info(config)
+    ckpt_mgr = CheckpointManager(ckpt_dir, keep_last=args.keep_last, mode='max', weights_only=args.weights_only, logger=logger)
 
     logger.info('Loading datasets...')
-    dataset_mgr = SkempiDatasetManager(config, num_cvfolds=args.num_cvfolds, num_workers=args.num_workers, logger=logger, )
+    val_cache = None if args.val_cache == 'none' else args.val_cache
+    dataset_mgr = SkempiDatasetManager(config, num_cvfolds=args.num_cvfolds, num_workers=args.num_workers, logger=logger, val_cache=val_cache)
     logger.info('Building model...')
-    if config.model.type == 'ga':
-        from src.models.rde_ddg import DDG_RDE_Network
-        cv_mgr = CrossValidation(model_factory=DDG_RDE_Network, config=config, num_cvfolds=args.num_cvfolds).to(args.device)
-    else:
-        if 'pos' in config.model:
-            from src.models.pdc_ddg_refine import DDG_PDC_Network
-        else:
-            from src.models.pdc_ddg import DDG_PDC_Network
-        cv_mgr = CrossValidation(model_factory=DDG_PDC_Network, config=config, num_cvfolds=args.num_cvfolds).to(args.device)
+    cv_mgr = CrossValidation(model_factory=get_ddg_model(config.model), config=config, num_cvfolds=args.num_cvfolds).to(args.device)
     logger.info(f'Number of parameters: {count_parameters(cv_mgr.get(0)[0]) / 1e6:.2f}M')
     it_first = 1
 
@@ -72,77 +88,96 @@ if __name__ == '__main__':
         it_first = ckpt['iteration']  # + 1
         cv_mgr.load_state_dict(ckpt['model'], )
 
+    if args.compile:
+        for model in cv_mgr.models:
+            compile_encoders(model)
+
+    timer = StageTimer(args.device, sync=args.profile_stages)
+    if args.profile_stages:
+        for model in cv_mgr.models:
+            timer.instrument(model)
+
+    # Pretrained features
+    feature_cache = get_feature_cache(config, args.feature_cache, logger=logger)
+    if feature_cache is not None:
+        for fold in range(args.num_cvfolds):
+            cv_mgr.get(fold)[0].set_feature_cache(feature_cache)  # the frozen encoder is the same checkpoint in every fold
+        for fold in range(args.num_cvfolds):  # the validation splits cover every entry once
+            feature_cache.prefill(cv_mgr.get(0)[0], dataset_mgr.get_val_loader(fold), args.device)
+        logger.info(f'Cached pretrained features of {len(feature_cache)} inputs ({feature_cache.checkpoint_hash})')
+
 
     def train(it):
-        fold = it % args.num_cvfolds
-        model, optimizer, scheduler = cv_mgr.get(fold)
-        time_start = current_milli_time()
-        model.train()
-
-        # Prepare data
-        batch = recursive_to(next(dataset_mgr.get_train_iterator(fold)), args.device)
-        loss_dict, _ = model(batch)
-        loss = sum_weighted_losses(loss_dict, config.train.loss_weights)
-        time_forward_end = current_milli_time()
-
-        # Backward
-        loss.backward()
-        orig_grad_norm = clip_grad_norm_(model.parameters(), config.train.max_grad_norm)
-        optimizer.step()
-        optimizer.zero_grad()
-        time_backward_end = current_milli_time()
-
-        # Logging
-        scalar_dict = {'grad': orig_grad_norm, 'lr(1e5)': optimizer.param_groups[0]['lr'] * 1e5, 'time_forward': (time_forward_end - time_start) / 1000,
-                       'time_backward': (time_backward_end - time_forward_end) / 1000, }
-        logstr = '[train] Iter %05d | loss_ddg %.2f | loss_pos: %.2f | fold %.0f' % (it, loss_dict['regression'].item(), loss_dict['pos_refine'].item(), fold)
+        folds = cv_mgr.train_folds(it, parallel=args.fold_parallel)
+
+        # Prepare data, one batch per fold
+        loss_dicts, losses = [], []
+        for fold in folds:
+            model, optimizer, scheduler = cv_mgr.get(fold)
+            model.train()
+            with timer.stage('data'):
+                batch = next(dataset_mgr.get_train_iterator(fold))
+            timer.count('samples', batch['size'])
+            timer.count('residues', batch['mask'].sum().item())  # on the CPU batch, no device sync
+            with timer.stage('h2d'):
+                batch = recursive_to(batch, args.device)
+            with timer.stage('forward'), autocast(precision, args.device):
+                loss_dict, _ = model(batch)
+            loss_dict = {k: v.float() for k, v in loss_dict.items()}
+            loss_dicts.append(loss_dict)
+            losses.append(sum_weighted_losses(loss_dict, config.train.loss_weights))
+
+        # Backward, fold models share no parameters so one pass yields the gradients of every fold
+        with timer.stage('backward'):
+            scaler.scale(sum(losses)).backward()
+        grad_norms = []
+        with timer.stage('optimizer'):
+            for fold in folds:
+                model, optimizer, scheduler = cv_mgr.get(fold)
+                scaler.unscale_(optimizer)
+                grad_norms.append(clip_grad_norm_(model.parameters(), config.train.max_grad_norm))
+                scaler.step(optimizer)  # skipped when the float16 gradients overflowed
+                optimizer.zero_grad()
+            scaler.update()
+
+        # Logging, averaged over the stepped folds
+        loss_ddg = sum(d['regression'].item() for d in loss_dicts) / len(folds)
+        loss_pos = sum(d['pos_refine'].item() for d in loss_dicts) / len(folds)
+        orig_grad_norm = sum(grad_norms) / len(folds)
+        scalar_dict = {'grad': orig_grad_norm, 'lr(1e5)': optimizer.param_groups[0]['lr'] * 1e5, 'time_data': timer.last('data'),
+                       'time_forward': timer.last('forward'), 'time_backward': timer.last('backward') + timer.last('optimizer'), }
+        logstr = '[train] Iter %05d | loss_ddg %.2f | loss_pos: %.2f | fold %s' % (it, loss_ddg, loss_pos, 'all' if len(folds) > 1 else folds[0])
         for k, v in scalar_dict.items():
             logstr += ' | %s %.2f' % (k, v.item() if isinstance(v, torch.Tensor) else v)
-        writer.add_scalar('train/ddg_loss', loss_dict['regression'].item(), it)
-        writer.add_scalar('train/pos_loss', loss_dict['pos_refine'].item(), it)
+        writer.add_scalar('train/ddg_loss', loss_ddg, it)
+        writer.add_scalar('train/pos_loss', loss_pos, it)
         writer.add_scalar('train/lr', optimizer.param_groups[0]['lr'], it)
         writer.add_scalar('train/grad', orig_grad_norm, it)
+        timer.step(it, writer)
         return logstr
 
 
-    def validate(it, best_it, best_spearman_val_pc):
-        scalar_accum = ScalarMetricAccumulator()
-        results, pos_rmse = [], 0.0
-        with torch.no_grad():
-            for fold in range(args.num_cvfolds):
-                model, optimizer, scheduler = cv_mgr.get(fold)
-                model.eval()
-                for i, batch in enumerate(tqdm(dataset_mgr.get_val_loader(fold), desc='Validate', dynamic_ncols=True)):
-                    batch = recursive_to(batch, args.device)
-
-                    loss_dict, output_dict = model(batch)
-                    scalar_accum.add(name='ddg_loss', value=loss_dict['regression'], batchsize=batch['size'], mode='mean')
-
-                    for complex, mutstr, ddg_true, ddg_pred in zip(batch['complex'], batch['mutstr'], output_dict['ddG_true'], output_dict['ddG_pred']):
-                        results.append({'complex': complex, 'mutstr': mutstr, 'num_muts': len(mutstr.split(',')), 'ddG': ddg_true.item(), 'ddG_pred': ddg_pred.item()})
-
-                    if 'pos' in config.model:
-                        scalar_accum.add(name='pos_loss', value=loss_dict['pos_refine'], batchsize=batch['size'], mode='mean')
-
-        results = pd.DataFrame(results)
+    def validate(it):
+        out = validate_folds([cv_mgr.get(fold)[0] for fold in range(args.num_cvfolds)], dataset_mgr, args.device, precision)
         if ckpt_dir is not None:
-            results.to_csv(os.path.join(ckpt_dir, f'results_{it}.csv'), index=False)
-        pearson_all = results[['ddG', 'ddG_pred']].corr('pearson').iloc[0, 1]
-        spearman_all = results[['ddG', 'ddG_pred']].corr('spearman').iloc[0, 1]
-        pearson_pc, spearman_pc = per_complex_corr(results)
-
-        logger.info(f'[All] Pearson {pearson_all:.6f} Spearman {spearman_all:.6f}')
-        logger.info(f'[PC]  Pearson {pearson_pc:.6f} Spearman {spearman_pc:.6f}')
-        writer.add_scalar('val/all_pearson', pearson_all, it)
-        writer.add_scalar('val/all_spearman', spearman_all, it)
-        writer.add_scalar('val/pc_pearson', pearson_pc, it)
-        writer.add_scalar('val/pc_spearman', spearman_pc, it)
-
-        avg_loss = scalar_accum.get_average('ddg_loss')
-        if spearman_pc > best_spearman_val_pc:
-            best_spearman_val_pc = spearman_pc
+            out['results'].to_csv(os.path.join(ckpt_dir, f'results_{it}.csv'), index=False)
+        return out
+
+
+    def report(it, out, best_it, best_spearman_val_pc):
+        """Logs the validation of iteration `it` and steps the schedulers, when its results are available (later than `it` with `--async_val`)."""
+        logger.info(f'[All] Pearson {out["pearson_all"]:.6f} Spearman {out["spearman_all"]:.6f}')
+        logger.info(f'[PC]  Pearson {out["pearson_pc"]:.6f} Spearman {out["spearman_pc"]:.6f}')
+        writer.add_scalar('val/all_pearson', out['pearson_all'], it)
+        writer.add_scalar('val/all_spearman', out['spearman_all'], it)
+        writer.add_scalar('val/pc_pearson', out['pearson_pc'], it)
+        writer.add_scalar('val/pc_spearman', out['spearman_pc'], it)
+
+        avg_loss = out['scalar_accum'].get_average('ddg_loss')
+        if out['spearman_pc'] > best_spearman_val_pc:
+            best_spearman_val_pc = out['spearman_pc']
             best_it = it
-        scalar_accum.log(it, 'val', best_it=best_it, best_metric=best_spearman_val_pc, logger=logger, writer=writer)
+        out['scalar_accum'].log(it, 'val', best_it=best_it, best_metric=best_spearman_val_pc, logger=logger, writer=writer)
         # Trigger scheduler
         for fold in range(args.num_cvfolds):
             _, _, scheduler = cv_mgr.get(fold)
@@ -151,19 +186,52 @@ if __name__ == '__main__':
                     scheduler.step(avg_loss)
                 else:
                     scheduler.step()
-        return avg_loss, pearson_pc, spearman_pc, pos_rmse, best_spearman_val_pc, best_it
-
+        return avg_loss, best_spearman_val_pc, best_it
+
+
+    def on_validated(validated, best_it, best_metric):
+        for it, out in validated:
+            avg_val_loss, best_metric, best_it = report(it, out, best_it, best_metric)
+            state = pending_states.pop(it)
+            if state is None:  # inline validation, the state is taken after `report` has stepped the schedulers
+                state = {'config': config, 'model': cv_mgr.state_dict(), 'iteration': it}
+            ckpt_mgr.save({**state, 'avg_val_loss': avg_val_loss, }, it, metric=out['spearman_pc'])
+        return best_it, best_metric
+
+    validator = None
+    if args.async_val:
+        validator = AsyncValidator(config, args.num_cvfolds, device=args.val_device or args.device, precision=precision, num_threads=args.val_threads, results_dir=ckpt_dir,
+                                   val_cache=val_cache)
+    pending_states = {}  # checkpoint states of the iterations being validated, None for inline validation
     try:
         best_metric, best_i = 0.0, 0
         it_tqdm = tq(range(it_first, config.train.max_iters + 1))
         for i in it_tqdm:
             message = train(i)
             it_tqdm.set_description(message)
+            if profiler is not None:
+                profiler.step()
 
             if i % config.train.val_freq == 0:
-                avg_val_loss, pearson_val_pc, spearman_val_pc, pos_val_rmse, best_metric, best_i = validate(i, best_i, best_metric)
-                if not args.debug:
-                    ckpt_path = os.path.join(ckpt_dir, '%d.pt' % i)
-                    torch.save({'config': config, 'model': cv_mgr.state_dict(), 'iteration': i, 'avg_val_loss': avg_val_loss, }, ckpt_path)
+                if ckpt_dir is not None:
+                    timer.save(os.path.join(log_dir, 'profile.json'))
+                if validator is None:
+                    pending_states[i] = None
+                    best_i, best_metric = on_validated([(i, validate(i))], best_i, best_metric)
+                else:  # the weights keep changing, validate and checkpoint a snapshot
+                    pending_states[i] = snapshot({'config': config, 'model': cv_mgr.state_dict(), 'iteration': i})
+                    best_i, best_metric = on_validated(validator.submit(i, pending_states[i]['model']['models']), best_i, best_metric)
+            elif validator is not None:
+                best_i, best_metric = on_validated(validator.poll(), best_i, best_metric)
+        if validator is not None:
+            best_i, best_metric = on_validated(validator.drain(), best_i, best_metric)
     except KeyboardInterrupt:
         logger.info('Terminating...')
+    finally:
+        if validator is not None:
+            validator.close()
+        ckpt_mgr.close()
+        if profiler is not None:
+            profiler.close()
+        if ckpt_dir is not None:
+            timer.save(os.path.join(log_dir, 'profile.json'))
@@ -7,6 +7,7 @@ from tqdm.auto import tqdm
 torch.backends.cuda.matmul.allow_tf32 = True
 torch.backends.cudnn.allow_tf32 = True
 
+from src.models import get_ddg_model, get_model_class
 from src.utils.train import *
 from src.utils.skempi import SkempiDatasetManager
 from src.datasets.pdbredo_chain import get_pdbredo_chain_dataset
@@ -75,15 +76,8 @@ else:
     dataset_mgr = SkempiDatasetManager(config, num_cvfolds=num_cvfolds, num_workers=args.num_workers, logger=logger, )
 
     logger.info('Building model...')
-    if args.backbone == 'ga':
-        from src.models.rde_ddg import DDG_RDE_Network
-        cv_mgr = CrossValidation(model_factory=DDG_RDE_Network, config=config, num_cvfolds=num_cvfolds).to(args.device)
-    else:
-        if 'pos' in config.model:
-            from src.models.pdc_ddg_refine import DDG_PDC_Network
-        else:
-            from src.models.pdc_ddg import DDG_PDC_Network
-        cv_mgr = CrossValidation(model_factory=DDG_PDC_Network, config=config, num_cvfolds=num_cvfolds).to(args.device)
+    model_factory = get_model_class('ddg_rde') if args.backbone == 'ga' else get_ddg_model(config.model)
+    cv_mgr = CrossValidation(model_factory=model_factory, config=config, num_cvfolds=num_cvfolds).to(args.device)
     logger.info('Loading state dict...')
     cv_mgr.load_state_dict(ckpt['model'])
 